@@ -16,7 +16,8 @@ import os, json, requests, pandas as pd
 from pathlib import Path
 from tqdm import tqdm
 
-BASE = "https://wits.worldbank.org/API/V1/SDMX/V21/datasource/TRN"
+# WITS_BASE_URL points the fetcher at standin_server.py instead of the live API
+BASE = os.environ.get("WITS_BASE_URL", "https://wits.worldbank.org").rstrip("/") + "/API/V1/SDMX/V21/datasource/TRN"
 CACHE = Path("data/raw")
 OUT   = Path("data/processed/wits_mfn_tariffs.csv")
 CACHE.mkdir(parents=True, exist_ok=True)
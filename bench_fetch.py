@@ -0,0 +1,147 @@
+"""
+Throughput and resume benchmark for fetch_trade.py against the local stand-in.
+Starts standin_server.py with injected quota errors, None responses and
+latency, runs the fetcher in a scratch directory, kills it part-way, resumes
+it, and reports requests/sec, quota utilisation and whether the final
+trade_flows.csv holds exactly the rows the stand-in served. With `--keys N`
+the fetcher runs sharded over N stand-in keys, each with its own quota.
+`--rerelease R` then re-releases reporter R on the stand-in (revising its
+values) and checks that a `--refresh` run replaces every superseded row.
+
+    python bench_fetch.py --reporters 842,156 --quota 30 --window 5 --kill-after 8
+    python bench_fetch.py --reporters 842,156,276,392 --keys 4 --rerelease 156
+"""
+import argparse
+import os
+import signal
+import subprocess
+import sys
+import tempfile
+import time
+import pandas as pd
+import requests
+from standin_server import StandinState, serve, comtrade_rows
+
+HERE = os.path.dirname(os.path.abspath(__file__))
+
+
+def run_fetcher(workdir, env, args=(), kill_after=None):
+    """Run fetch_trade.py once; returns (seconds, killed)."""
+    start = time.time()
+    with open(os.path.join(workdir, 'fetch.log'), 'a') as log:
+        # Own process group, so a kill also takes down --shards worker processes
+        proc = subprocess.Popen([sys.executable, os.path.join(HERE, 'fetch_trade.py'), *args],
+                                cwd=workdir, env=env, stdout=log, stderr=subprocess.STDOUT,
+                                start_new_session=True)
+        try:
+            proc.wait(timeout=kill_after)
+            killed = False
+        except subprocess.TimeoutExpired:
+            os.killpg(proc.pid, signal.SIGKILL)
+            proc.wait()
+            killed = True
+    if not killed and proc.returncode != 0:
+        raise RuntimeError(f"fetch_trade.py exited with {proc.returncode}; see {workdir}/fetch.log")
+    return time.time() - start, killed
+
+
+def expected_rows(state, reporters, partners, hs_groups, flows, periods):
+    rows = []
+    for reporter in reporters:
+        for period in periods:
+            rows.extend(comtrade_rows(state, reporter, partners, hs_groups, flows, period, include_desc=False))
+    return pd.DataFrame(rows)
+
+
+def check_resume(out_csv, expected):
+    """
+    Compare the fetched CSV with what the stand-in serves: missing, duplicate,
+    unexpected rows, and stale ones (a value the stand-in no longer serves).
+    """
+    key = ['reporterCode', 'partnerCode', 'cmdCode', 'flowCode', 'period', 'motCode']
+    got = pd.read_csv(out_csv, usecols=key + ['primaryValue'], dtype={'cmdCode': str, 'period': str})
+    expected = expected[key + ['primaryValue']].astype({'cmdCode': str, 'period': str})
+    got_keys = set(map(tuple, got[key].values.tolist()))
+    want_keys = set(map(tuple, expected[key].values.tolist()))
+    both = got.merge(expected, on=key, suffixes=('', '_served'))
+    return {
+        'rows': len(got),
+        'expected_rows': len(expected),
+        'missing': len(want_keys - got_keys),
+        'unexpected': len(got_keys - want_keys),
+        'duplicates': int(got[key].duplicated().sum()),
+        'stale': int(((both['primaryValue'] - both['primaryValue_served']).abs() > 0.01).sum()),
+    }
+
+
+def main():
+    parser = argparse.ArgumentParser(description=__doc__, formatter_class=argparse.RawDescriptionHelpFormatter)
+    parser.add_argument('--reporters', default='842,156,276')
+    parser.add_argument('--quota', type=int, default=30, help="stand-in calls allowed per window")
+    parser.add_argument('--window', type=float, default=5)
+    parser.add_argument('--none-rate', type=float, default=0.02)
+    parser.add_argument('--latency', default='0.02,0.2')
+    parser.add_argument('--max-records', type=int, default=500)
+    parser.add_argument('--concurrency', type=int, default=4)
+    parser.add_argument('--rate', type=float, default=10.0)
+    parser.add_argument('--keys', type=int, default=1,
+                        help="subscription keys; more than one runs fetch_trade.py --shards")
+    parser.add_argument('--kill-after', type=float, default=5.0,
+                        help="seconds before the first run is killed to test resume (0 = no kill)")
+    parser.add_argument('--rerelease', type=int,
+                        help="reporter to re-release after the runs, followed by a --refresh run")
+    parser.add_argument('--workdir', help="scratch directory (default: a fresh temp dir)")
+    args = parser.parse_args()
+
+    reporters = [int(r) for r in args.reporters.split(',')]
+    state = StandinState(reporters=reporters, quota=args.quota, window=args.window, none_rate=args.none_rate,
+                         latency=tuple(map(float, args.latency.split(','))))
+    server, base = serve(state)
+    workdir = args.workdir or tempfile.mkdtemp(prefix='bench_fetch_')
+    os.makedirs(workdir, exist_ok=True)
+    keys = [f'standin{i}' for i in range(args.keys)]
+    fetch_args = ['--shards'] if args.keys > 1 else []
+    env = dict(os.environ, COMTRADE_BASE_URL=base, COMTRADE_KEY=keys[0], COMTRADE_KEYS=','.join(keys),
+               COMTRADE_LEASE_TTL='10', COMTRADE_MAX_RECORDS=str(args.max_records), COMTRADE_MIN_WAIT='1',
+               COMTRADE_CONCURRENCY=str(args.concurrency), COMTRADE_RATE=str(args.rate),
+               PYTHONUNBUFFERED='1')
+    print(f"⇢ Stand-in at {base}, scratch dir {workdir}")
+
+    runs = []
+    if args.kill_after:
+        runs.append(run_fetcher(workdir, env, fetch_args, kill_after=args.kill_after))
+        print(f"✓ Run 1 {'killed' if runs[-1][1] else 'finished'} after {runs[-1][0]:.1f}s")
+    runs.append(run_fetcher(workdir, env, fetch_args))
+    print(f"✓ Run {len(runs)} finished after {runs[-1][0]:.1f}s")
+    if args.rerelease:
+        state.releases[args.rerelease] = '2025-06-01T00:00:00'
+        runs.append(run_fetcher(workdir, env, fetch_args + ['--refresh']))
+        print(f"✓ Refresh run after re-releasing {args.rerelease} finished after {runs[-1][0]:.1f}s")
+    stats = requests.get(f"{base}/_stats", timeout=10).json()
+    server.shutdown()
+
+    sys.path.insert(0, HERE)
+    os.chdir(workdir)  # fetch_trade creates its cache relative to the working directory
+    import fetch_trade
+    expected = expected_rows(state, reporters, fetch_trade.PARTNERS, fetch_trade.HS_GROUPS,
+                             list(fetch_trade.FLOWS), fetch_trade.get_periods())
+    result = check_resume(os.path.join(workdir, fetch_trade.OUT_CSV), expected)
+
+    busy = (stats['last'] - stats['first']) if stats['first'] else 0.0
+    allowed = args.keys * args.quota * max(busy, args.window) / args.window if args.quota else None
+    print("\n── Fetcher benchmark ─────────────────────────────")
+    print(f"   Wall time:           {sum(r[0] for r in runs):.1f}s over {len(runs)} run(s)")
+    print(f"   API calls:           {stats['calls']} (ok {stats['ok']}, quota {stats['quota']}, none {stats['none']})")
+    print(f"   Successful req/s:    {stats['ok'] / busy if busy else 0:.2f}")
+    if allowed:
+        print(f"   Quota utilisation:   {stats['ok'] / allowed:.0%} of {args.quota} calls per {args.window:g}s "
+              f"x {args.keys} key(s)")
+    print(f"   Rows served:         {stats['rows']}")
+    print(f"   Resume correctness:  {result}")
+    ok = not (result['missing'] or result['unexpected'] or result['duplicates'] or result['stale'])
+    print("✓ Resume correct" if ok else "✗ Resume produced missing, unexpected, duplicate or stale rows")
+    sys.exit(0 if ok else 1)
+
+
+if __name__ == '__main__':
+    main()
@@ -0,0 +1,85 @@
+"""
+Benchmark of the WITS SDMX-JSON decoders on synthetic tariff schedules from
+standin_server.wits_message: the original per-series loop in
+archive/wits_fetch.py against sdmx_decode.decode_series (parsed message) and
+sdmx_decode.decode_stream (incremental, from a compressed raw cache entry).
+Checks that all three produce the same rows.
+
+    python bench_sdmx.py --products 5000 --messages 20
+"""
+import argparse
+import os
+import sys
+import tempfile
+import time
+import tracemalloc
+import pandas as pd
+from standin_server import wits_message
+from raw_cache import RawCache
+import sdmx_decode
+
+HERE = os.path.dirname(os.path.abspath(__file__))
+sys.path.insert(0, os.path.join(HERE, 'archive'))
+from wits_fetch import decode_series as decode_series_loop  # noqa: E402
+
+
+def timed(fn, messages):
+    start = time.perf_counter()
+    frames = [fn(m) for m in messages]
+    return time.perf_counter() - start, pd.concat(frames, ignore_index=True)
+
+
+def peak_mb(fn):
+    """Peak Python heap while decoding one message."""
+    tracemalloc.start()
+    fn()
+    peak = tracemalloc.get_traced_memory()[1]
+    tracemalloc.stop()
+    return peak / 1e6
+
+
+def canonical(df):
+    return df.astype(str).sort_values(list(df.columns)).reset_index(drop=True)
+
+
+def main():
+    parser = argparse.ArgumentParser(description=__doc__, formatter_class=argparse.RawDescriptionHelpFormatter)
+    parser.add_argument('--products', type=int, default=5000, help="HS6 lines per message")
+    parser.add_argument('--messages', type=int, default=20, help="reporter schedules to decode")
+    args = parser.parse_args()
+
+    messages = [wits_message(reporter, '000', 2023, n_products=args.products) for reporter in range(args.messages)]
+    cache = RawCache(tempfile.mkdtemp(prefix='bench_sdmx_'))
+    for i, msg in enumerate(messages):
+        cache.put('wits', {'i': i}, msg)
+
+    loop_s, loop_df = timed(decode_series_loop, messages)
+    vec_s, vec_df = timed(sdmx_decode.decode_series, messages)
+    stream_s, stream_df = timed(
+        lambda i: sdmx_decode.decode_stream(lambda: cache.open('wits', {'i': i}), prefix='payload'),
+        range(len(messages)))
+
+    # Whole path from the cache: decompress + json parse + decode
+    loop_cached_s, _ = timed(lambda i: decode_series_loop(cache.get('wits', {'i': i})), range(len(messages)))
+    vec_cached_s, _ = timed(lambda i: sdmx_decode.decode_series(cache.get('wits', {'i': i})), range(len(messages)))
+
+    rows = len(loop_df)
+    same = canonical(loop_df).equals(canonical(vec_df)) and canonical(loop_df).equals(canonical(stream_df))
+    print(f"── SDMX decode: {args.messages} messages x {args.products} series ({rows} rows) ──")
+    print(f"   per-series loop:       {loop_s:.2f}s  ({rows / loop_s:,.0f} rows/s)")
+    print(f"   vectorised:            {vec_s:.2f}s  ({rows / vec_s:,.0f} rows/s, {loop_s / vec_s:.1f}x)")
+    print(f"   from cache, loop:      {loop_cached_s:.2f}s  ({rows / loop_cached_s:,.0f} rows/s)")
+    print(f"   from cache, vectorised: {vec_cached_s:.2f}s  ({rows / vec_cached_s:,.0f} rows/s)")
+    print(f"   from cache, streamed ({'ijson' if sdmx_decode.ijson else 'json.load fallback'}): "
+          f"{stream_s:.2f}s  ({rows / stream_s:,.0f} rows/s)")
+    print(f"   loop frame memory:     {loop_df.memory_usage(deep=True).sum() / 1e6:.1f} MB")
+    print(f"   vectorised memory:     {vec_df.memory_usage(deep=True).sum() / 1e6:.1f} MB")
+    parsed_peak = peak_mb(lambda: sdmx_decode.decode_series(cache.get('wits', {'i': 0})))
+    stream_peak = peak_mb(lambda: sdmx_decode.decode_stream(lambda: cache.open('wits', {'i': 0}), prefix='payload'))
+    print(f"   peak heap, one message: {parsed_peak:.1f} MB parsed vs {stream_peak:.1f} MB streamed")
+    print("✓ Outputs identical" if same else "✗ Decoders disagree")
+    sys.exit(0 if same else 1)
+
+
+if __name__ == '__main__':
+    main()
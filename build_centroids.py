@@ -0,0 +1,65 @@
+# build_centroids.py
+"""
+Regenerates trade-viz/src/iso_centroids.json ({ISO3: [lng, lat]}) against the
+shared country code table (country_codes.py), so the map uses the same ISO3
+codes as trade_flows.csv and flows_with_mfn.csv.
+Coordinates come from a CSV with iso3 (or an ISO numeric / Comtrade `code`
+column), lng and lat, or from the current JSON when no CSV is given. Codes
+the table does not know are dropped, and reporters/partners in the flows that
+still have no centroid are listed.
+
+    python build_centroids.py                       # re-validate the current file
+    python build_centroids.py --csv centroids.csv   # rebuild from a centroid list
+"""
+import argparse
+import json
+import os
+import pandas as pd
+from country_codes import code_table, to_iso3
+
+CENTROIDS_JSON = 'trade-viz/src/iso_centroids.json'
+TRADE_FLOWS_CSV = 'data/processed/trade_flows.csv'
+
+
+def load_points(csv_path=None, json_path=CENTROIDS_JSON):
+    """Centroids as a DataFrame with iso3, lng, lat."""
+    if csv_path is None:
+        with open(json_path) as f:
+            points = json.load(f)
+        return pd.DataFrame([(k, *v) for k, v in points.items()], columns=['iso3', 'lng', 'lat'])
+    df = pd.read_csv(csv_path)
+    if 'iso3' not in df.columns:
+        df['iso3'] = to_iso3(df['code'], 'comtrade')
+    return df[['iso3', 'lng', 'lat']]
+
+
+def main(csv_path=None, out=CENTROIDS_JSON):
+    points = load_points(csv_path)
+    points['iso3'] = to_iso3(points['iso3'], 'iso3')
+    unknown = points['iso3'].isna().sum()
+    points = points.dropna().drop_duplicates('iso3')
+
+    centroids = {iso3: [float(lng), float(lat)]
+                 for iso3, lng, lat in points.itertuples(index=False)}
+    tmp = out + '.tmp'
+    with open(tmp, 'w') as f:
+        # one country per line, as the file has always been laid out
+        f.write('{\n' + ',\n'.join(f'    "{k}": {json.dumps(v)}' for k, v in centroids.items()) + '\n}\n')
+    os.replace(tmp, out)
+    print(f"✓ Wrote {len(centroids)} centroids → {out}  ({unknown} unknown codes dropped)")
+
+    if os.path.exists(TRADE_FLOWS_CSV):
+        flows = pd.read_csv(TRADE_FLOWS_CSV, usecols=['reporterISO', 'partnerISO'], dtype=str)
+        used = set(flows['reporterISO'].dropna()) | set(flows['partnerISO'].dropna())
+        known = set(code_table()['iso3'])
+        missing = sorted((used & known) - set(centroids))
+        if missing:
+            print(f"⚠️  {len(missing)} countries in {TRADE_FLOWS_CSV} have no centroid: {', '.join(missing)}")
+
+
+if __name__ == '__main__':
+    parser = argparse.ArgumentParser(description=__doc__, formatter_class=argparse.RawDescriptionHelpFormatter)
+    parser.add_argument('--csv', help="centroid list with iso3 (or code), lng, lat columns")
+    parser.add_argument('--out', default=CENTROIDS_JSON)
+    args = parser.parse_args()
+    main(csv_path=args.csv, out=args.out)
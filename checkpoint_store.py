@@ -0,0 +1,194 @@
+"""
+Append-only checkpoint store for fetched trade flows.
+Each checkpoint is written as an immutable CSV segment next to the output CSV
+and recorded in a JSON manifest, so saving a batch costs O(batch) instead of
+rewriting the whole file. Segments are folded into the output CSV by a
+background compaction that only ever appends to it. Rows are copied as text
+(every column read as a string), so codes such as cmdCode '01' keep their
+leading zeros.
+"""
+import json
+import os
+import threading
+import time
+import pandas as pd
+
+# Read segments verbatim: no type inference, empty fields stay empty
+AS_TEXT = dict(dtype=str, keep_default_na=False)
+
+
+class SegmentStore:
+    def __init__(self, out_csv, segment_dir=None, compact_every=20):
+        self.out_csv = out_csv
+        self.segment_dir = segment_dir or os.path.splitext(out_csv)[0] + '_segments'
+        self.manifest_path = os.path.join(self.segment_dir, 'manifest.json')
+        self.compact_every = compact_every
+        self.lock = threading.Lock()
+        self.compactor = None
+        os.makedirs(self.segment_dir, exist_ok=True)
+        self.manifest = self._load_manifest()
+        self._recover()
+
+    # ------------------------------------------------------------
+    # manifest helpers
+    def _load_manifest(self):
+        if os.path.exists(self.manifest_path):
+            with open(self.manifest_path) as f:
+                return json.load(f)
+        return {'next_id': 1, 'segments': [], 'compacting': None}
+
+    def _write_manifest(self):
+        tmp = self.manifest_path + '.tmp'
+        with open(tmp, 'w') as f:
+            json.dump(self.manifest, f, indent=1)
+        os.replace(tmp, self.manifest_path)
+
+    def _recover(self):
+        """Undo a compaction that was interrupted half-way through appending."""
+        pending = self.manifest.get('compacting')
+        if not pending:
+            return
+        if os.path.exists(self.out_csv):
+            with open(self.out_csv, 'r+b') as f:
+                f.truncate(pending['base_bytes'])
+        print(f"⇢ Rolled back interrupted compaction of {len(pending['segments'])} segments")
+        self.manifest['compacting'] = None
+        self._write_manifest()
+
+    # ------------------------------------------------------------
+    def append(self, df):
+        """Write `df` as a new immutable segment and return its row count."""
+        if df is None or len(df) == 0:
+            return 0
+        with self.lock:
+            seg_id = self.manifest['next_id']
+            self.manifest['next_id'] = seg_id + 1
+        name = f'part-{seg_id:06d}.csv'
+        path = os.path.join(self.segment_dir, name)
+        df.to_csv(path + '.tmp', index=False)
+        os.replace(path + '.tmp', path)
+        with self.lock:
+            self.manifest['segments'].append({'id': seg_id, 'file': name, 'rows': len(df), 'created': time.time()})
+            self._write_manifest()
+            backlog = len(self.manifest['segments'])
+        if backlog >= self.compact_every:
+            self.compact_async()
+        return len(df)
+
+    def segment_paths(self):
+        with self.lock:
+            return [os.path.join(self.segment_dir, s['file']) for s in self.manifest['segments']]
+
+    def row_count(self):
+        """Rows held in uncompacted segments."""
+        with self.lock:
+            return sum(s['rows'] for s in self.manifest['segments'])
+
+    def total_rows(self):
+        """
+        Rows held by the output CSV plus outstanding segments. The CSV's count
+        is kept in the manifest and only recounted when its size changed
+        behind our back (a rebuild, a migration, a rolled-back compaction).
+        """
+        size = os.path.getsize(self.out_csv) if os.path.exists(self.out_csv) else 0
+        with self.lock:
+            counted = self.manifest.get('compacted')
+        if not counted or counted['bytes'] != size:
+            rows = sum(len(c) for c in pd.read_csv(self.out_csv, chunksize=200000, usecols=[0], **AS_TEXT)) if size else 0
+            with self.lock:
+                self.manifest['compacted'] = counted = {'bytes': size, 'rows': rows}
+                self._write_manifest()
+        return counted['rows'] + self.row_count()
+
+    def chunks(self, chunksize=200000):
+        """Stream the compacted CSV and then each outstanding segment as text frames."""
+        if os.path.exists(self.out_csv):
+            yield from pd.read_csv(self.out_csv, chunksize=chunksize, **AS_TEXT)
+        for path in self.segment_paths():
+            yield from pd.read_csv(path, chunksize=chunksize, **AS_TEXT)
+
+    def _set_compacted(self, rows):
+        """Record the output CSV's row count (caller holds the lock)."""
+        size = os.path.getsize(self.out_csv) if os.path.exists(self.out_csv) else 0
+        self.manifest['compacted'] = {'bytes': size, 'rows': rows}
+
+    def read_all(self, **read_kwargs):
+        """Load the compacted CSV plus all outstanding segments as one frame."""
+        paths = ([self.out_csv] if os.path.exists(self.out_csv) else []) + self.segment_paths()
+        if not paths:
+            return None
+        return pd.concat([pd.read_csv(p, **read_kwargs) for p in paths], ignore_index=True)
+
+    def drop_rows(self, mask_fn, chunksize=200000):
+        """
+        Remove rows for which `mask_fn(chunk)` is True from the output CSV,
+        streaming it in chunks. Segments are compacted first so nothing is missed.
+        """
+        self.close()
+        if not os.path.exists(self.out_csv) or os.path.getsize(self.out_csv) == 0:
+            return 0
+        tmp = self.out_csv + '.tmp'
+        dropped = kept = 0
+        # header first, so a CSV without data rows still yields a file to replace it with
+        pd.read_csv(self.out_csv, nrows=0, **AS_TEXT).to_csv(tmp, index=False)
+        for chunk in pd.read_csv(self.out_csv, chunksize=chunksize, **AS_TEXT):
+            mask = mask_fn(chunk)
+            dropped += int(mask.sum())
+            kept += len(chunk) - int(mask.sum())
+            chunk[~mask].to_csv(tmp, mode='a', header=False, index=False)
+        os.replace(tmp, self.out_csv)
+        with self.lock:
+            self._set_compacted(kept)
+            self._write_manifest()
+        return dropped
+
+    # ------------------------------------------------------------
+    # compaction
+    def compact(self):
+        """Append all current segments to the output CSV and drop them."""
+        with self.lock:
+            segments = list(self.manifest['segments'])
+            if not segments:
+                return 0
+            base_bytes = os.path.getsize(self.out_csv) if os.path.exists(self.out_csv) else 0
+            self.manifest['compacting'] = {'segments': [s['id'] for s in segments], 'base_bytes': base_bytes}
+            self._write_manifest()
+
+        columns = None
+        if base_bytes:
+            columns = list(pd.read_csv(self.out_csv, nrows=0).columns)
+        rows = 0
+        for seg in segments:
+            df = pd.read_csv(os.path.join(self.segment_dir, seg['file']), **AS_TEXT)
+            if columns is None:
+                columns = list(df.columns)
+                df.to_csv(self.out_csv, index=False)
+            else:
+                df.reindex(columns=columns).to_csv(self.out_csv, mode='a', header=False, index=False)
+            rows += len(df)
+
+        done = {s['id'] for s in segments}
+        with self.lock:
+            counted = self.manifest.get('compacted')
+            if counted and counted['bytes'] == base_bytes:
+                self._set_compacted(counted['rows'] + rows)
+            self.manifest['segments'] = [s for s in self.manifest['segments'] if s['id'] not in done]
+            self.manifest['compacting'] = None
+            self._write_manifest()
+        for seg in segments:
+            os.remove(os.path.join(self.segment_dir, seg['file']))
+        print(f"✓ Compacted {len(segments)} segments ({rows} rows) into {self.out_csv}")
+        return rows
+
+    def compact_async(self):
+        """Start a background compaction unless one is already running."""
+        if self.compactor is not None and self.compactor.is_alive():
+            return
+        self.compactor = threading.Thread(target=self.compact, daemon=True)
+        self.compactor.start()
+
+    def close(self):
+        """Wait for background work and fold any remaining segments in."""
+        if self.compactor is not None:
+            self.compactor.join()
+        self.compact()
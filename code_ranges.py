@@ -0,0 +1,16 @@
+"""
+Command-line lists of numeric codes, shared by fetch_trade.py and
+wits_fetch.py: '2019-2023', '2021,2023' or '840,156'.
+"""
+
+
+def parse_codes(spec):
+    """'2019-2023' or '2021,2023' → [2019, ..., 2023]; '840,156' → [156, 840]"""
+    codes = []
+    for part in spec.split(','):
+        if '-' in part:
+            start, end = map(int, part.split('-'))
+            codes.extend(range(start, end + 1))
+        else:
+            codes.append(int(part))
+    return sorted(set(codes))
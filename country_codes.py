@@ -0,0 +1,122 @@
+"""
+Shared country code table: ISO numeric, ISO3, Comtrade reporter/partner codes
+and WITS codes, one row per (scheme, code) → ISO3.
+Built once from pycountry plus the places Comtrade and WITS depart from ISO
+(842 for the USA, 251 for France, WITS' 918 for the EU, ...), extended with
+Comtrade's own reporter reference when fetch_trade.py downloads it, and cached
+at data/processed/country_codes.csv. Translation factorises the input and maps
+only the distinct codes, so millions of rows cost a few hundred lookups.
+"""
+import os
+import numpy as np
+import pandas as pd
+import pycountry
+
+CODES_CSV = 'data/processed/country_codes.csv'
+SCHEMES = ('iso_numeric', 'iso3', 'comtrade', 'wits')
+
+# Comtrade reporter codes that differ from ISO 3166-1 numeric
+COMTRADE_CODES = {842: 'USA', 251: 'FRA', 579: 'NOR', 699: 'IND', 757: 'CHE'}
+# WITS reporters that are not ISO countries
+WITS_CODES = {918: 'EUN'}
+EXTRA_NAMES = {'EUN': 'European Union'}
+
+_table = None
+
+
+def build_table(comtrade_reference=None):
+    """
+    Code table as a DataFrame with columns scheme, code, iso3, name.
+    `comtrade_reference` is an optional list of Comtrade reference items
+    (id plus reporterCodeIsoAlpha3) that overrides the built-in Comtrade codes.
+    """
+    rows = []
+    for c in pycountry.countries:
+        name = getattr(c, 'common_name', None) or c.name
+        rows.append(('iso_numeric', str(int(c.numeric)), c.alpha_3, name))
+        rows.append(('iso3', c.alpha_3, c.alpha_3, name))
+        # Comtrade and WITS use the ISO numeric code unless listed otherwise
+        rows.append(('comtrade', str(int(c.numeric)), c.alpha_3, name))
+        rows.append(('wits', str(int(c.numeric)), c.alpha_3, name))
+    names = {r[2]: r[3] for r in rows}
+    names.update(EXTRA_NAMES)
+    for code, iso3 in COMTRADE_CODES.items():
+        rows.append(('comtrade', str(code), iso3, names.get(iso3)))
+    for code, iso3 in WITS_CODES.items():
+        rows.append(('wits', str(code), iso3, names.get(iso3)))
+        rows.append(('iso3', iso3, iso3, names.get(iso3)))
+    for item in comtrade_reference or []:
+        iso3 = item.get('reporterCodeIsoAlpha3')
+        if item.get('id') is not None and iso3:
+            rows.append(('comtrade', str(int(item['id'])), iso3, item.get('text') or names.get(iso3)))
+    table = pd.DataFrame(rows, columns=['scheme', 'code', 'iso3', 'name'])
+    # later rows (explicit overrides, Comtrade's reference) win
+    return table.drop_duplicates(['scheme', 'code'], keep='last').reset_index(drop=True)
+
+
+def save_table(table, path=CODES_CSV):
+    os.makedirs(os.path.dirname(path) or '.', exist_ok=True)
+    table.to_csv(path + '.tmp', index=False)
+    os.replace(path + '.tmp', path)
+
+
+def code_table(path=CODES_CSV):
+    """The cached table, built and saved on first use."""
+    global _table
+    if _table is None:
+        if os.path.exists(path):
+            _table = pd.read_csv(path, dtype=str, keep_default_na=False)
+        else:
+            _table = build_table()
+            save_table(_table, path)
+    return _table
+
+
+def update_comtrade_reference(items, path=CODES_CSV):
+    """Rebuild the cached table with Comtrade's reporter reference (list of dicts)."""
+    global _table
+    _table = build_table(items)
+    save_table(_table, path)
+    return _table
+
+
+def _normalise(values, scheme):
+    """Codes as the strings used in the table: '842' for 842 / 842.0 / '0842', upper-case ISO3."""
+    s = pd.Series(values)
+    if scheme == 'iso3':
+        return s.astype('string').str.strip().str.upper()
+    numeric = pd.to_numeric(s, errors='coerce')
+    return numeric.astype('Int64').astype('string')
+
+
+def _translate(values, scheme, lookup):
+    """Map `values` through a {code: result} dict, normalising and looking up each distinct value once."""
+    codes, uniques = pd.factorize(pd.Series(values), use_na_sentinel=True)
+    keys = _normalise(uniques, scheme)
+    mapped = np.array([None if pd.isna(k) else lookup.get(k) for k in keys] + [None], dtype=object)
+    return mapped[codes]  # the -1 NA sentinel picks the trailing None
+
+
+def to_iso3(values, scheme='iso_numeric'):
+    """ISO3 codes (None where unknown) for a sequence of codes in `scheme`, aligned with `values`."""
+    assert scheme in SCHEMES, scheme
+    table = code_table()
+    lookup = dict(zip(*table.loc[table['scheme'] == scheme, ['code', 'iso3']].values.T))
+    index = values.index if isinstance(values, pd.Series) else None
+    return pd.Series(_translate(values, scheme, lookup), index=index, dtype=object)
+
+
+def from_iso3(values, scheme='iso_numeric'):
+    """
+    Codes in `scheme` for a sequence of ISO3 codes (None where unknown).
+    Where several codes map to one country, the ISO numeric one is preferred.
+    """
+    assert scheme in SCHEMES, scheme
+    table = code_table()
+    rows = table[table['scheme'] == scheme]
+    iso_numeric = set(table.loc[table['scheme'] == 'iso_numeric', 'code'])
+    # ISO numeric codes last so they win in the dict
+    rows = rows.assign(iso=rows['code'].isin(iso_numeric)).sort_values('iso', kind='stable')
+    lookup = dict(zip(rows['iso3'], rows['code']))
+    index = values.index if isinstance(values, pd.Series) else None
+    return pd.Series(_translate(values, 'iso3', lookup), index=index, dtype=object)
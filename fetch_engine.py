@@ -0,0 +1,170 @@
+"""
+Concurrent fetch engine for the Comtrade downloader.
+Keeps a bounded number of API calls in flight and budgets them with a token
+bucket that is re-synchronised from the API's "replenished in HH:MM:SS" quota
+messages, so a 403 pauses new dispatches without stalling calls already running.
+"""
+import threading
+import time
+from concurrent.futures import ThreadPoolExecutor, FIRST_COMPLETED, wait
+
+
+class QuotaExceeded(Exception):
+    """Raised by a fetch function when the API reports the call quota is used up."""
+
+    def __init__(self, wait_seconds, message=""):
+        super().__init__(message or f"quota exceeded, replenished in {wait_seconds}s")
+        self.wait_seconds = wait_seconds
+
+
+class TokenBucket:
+    """Thread-safe token bucket: `rate` tokens per second, at most `capacity` banked."""
+
+    def __init__(self, rate, capacity):
+        self.rate = float(rate)
+        self.capacity = float(capacity)
+        self.tokens = float(capacity)
+        self.updated = time.monotonic()
+        self.resume_at = 0.0
+        self.lock = threading.Lock()
+
+    def _refill(self, now):
+        if now < self.resume_at:
+            return
+        start = max(self.updated, self.resume_at)
+        self.tokens = min(self.capacity, self.tokens + (now - start) * self.rate)
+        self.updated = now
+
+    def acquire(self):
+        """
+        Block until a token is available, then take it.
+        Returns (seconds waited on a quota pause, seconds waited on the rate).
+        """
+        paused = throttled = 0.0
+        while True:
+            with self.lock:
+                now = time.monotonic()
+                self._refill(now)
+                if now >= self.resume_at and self.tokens >= 1:
+                    self.tokens -= 1
+                    return paused, throttled
+                quota_pause = now < self.resume_at
+                if quota_pause:
+                    delay = self.resume_at - now
+                else:
+                    delay = (1 - self.tokens) / self.rate
+            delay = min(delay, 1.0)
+            time.sleep(delay)
+            if quota_pause:
+                paused += delay
+            else:
+                throttled += delay
+
+    def pause(self, seconds):
+        """Empty the bucket and hold it closed until the quota window replenishes."""
+        with self.lock:
+            now = time.monotonic()
+            self.tokens = 0.0
+            self.resume_at = max(self.resume_at, now + seconds)
+            self.updated = now
+
+    def paused_for(self):
+        """Seconds left before the bucket reopens (0 when open)."""
+        with self.lock:
+            return max(0.0, self.resume_at - time.monotonic())
+
+
+class FetchEngine:
+    """
+    Runs `fetch_fn(request)` for many requests on a bounded thread pool.
+
+    `fetch_fn` returns the response (any object) or raises QuotaExceeded; the
+    request is then re-queued and the shared bucket paused for the quota window
+    while calls already in flight finish normally. Any other exception is
+    reported as a failed request. `on_result(request, response, error)` is
+    always invoked on the calling thread, so it can safely touch shared state
+    such as checkpoint buffers. It may return further requests (e.g. the halves
+    of a truncated batch), which are fetched next.
+
+    `lookup(request)`, if given, is tried first and may return a cached
+    response; cache hits do not consume a token.
+
+    `metrics`, an optional fetch_metrics.FetchMetrics, receives call
+    latencies, quota/rate sleep time and retry, error and cache-hit counts.
+    """
+
+    def __init__(self, fetch_fn, workers=4, rate=1.0, burst=None, max_retries=60, min_wait=60, lookup=None,
+                 metrics=None):
+        self.fetch_fn = fetch_fn
+        self.lookup = lookup
+        self.metrics = metrics
+        self.workers = workers
+        self.bucket = TokenBucket(rate, burst or workers)
+        self.max_retries = max_retries
+        self.min_wait = min_wait
+
+    def _call(self, request):
+        if self.lookup is not None:
+            cached = self.lookup(request)
+            if cached is not None:
+                if self.metrics is not None:
+                    self.metrics.count('cache_hits')
+                return cached
+        paused, throttled = self.bucket.acquire()
+        if self.metrics is None:
+            return self.fetch_fn(request)
+        self.metrics.add_seconds('quota_sleep', paused)
+        self.metrics.add_seconds('rate_sleep', throttled)
+        start = time.monotonic()
+        try:
+            return self.fetch_fn(request)
+        finally:
+            self.metrics.observe_call(time.monotonic() - start)
+
+    def run(self, requests, on_result):
+        """Fetch every request in `requests`; returns the number that completed."""
+        pending = list(requests)
+        pending.reverse()  # pop() from the end keeps the caller's order
+        retries = {}
+        completed = 0
+
+        with ThreadPoolExecutor(max_workers=self.workers) as pool:
+            in_flight = {}
+            while pending or in_flight:
+                while pending and len(in_flight) < self.workers:
+                    request = pending.pop()
+                    in_flight[pool.submit(self._call, request)] = request
+
+                done, _ = wait(in_flight, return_when=FIRST_COMPLETED)
+                for future in done:
+                    request = in_flight.pop(future)
+                    try:
+                        response = future.result()
+                    except QuotaExceeded as e:
+                        count = retries.get(request, 0) + 1
+                        retries[request] = count
+                        if self.metrics is not None:
+                            self.metrics.count('retries')
+                        if count >= self.max_retries:
+                            print(f"Maximum retries ({self.max_retries}) exceeded for {request}. Moving on.")
+                            on_result(request, None, e)
+                            completed += 1
+                            continue
+                        wait_seconds = max(e.wait_seconds, self.min_wait)
+                        if self.bucket.paused_for() < wait_seconds:
+                            print(f"\n⏱️ RATE LIMIT REACHED: pausing new requests for {wait_seconds} seconds "
+                                  f"at {time.strftime('%H:%M:%S')} ({len(in_flight)} still in flight)")
+                        self.bucket.pause(wait_seconds)
+                        pending.append(request)
+                        continue
+                    except Exception as e:
+                        if self.metrics is not None:
+                            self.metrics.count('errors')
+                        on_result(request, None, e)
+                        completed += 1
+                        continue
+                    follow_up = on_result(request, response, None)
+                    completed += 1
+                    if follow_up:
+                        pending.extend(reversed(list(follow_up)))
+        return completed
@@ -0,0 +1,193 @@
+"""
+Run metrics for the Comtrade fetcher.
+Collects per-call latency and rows-per-call histograms, error counters, time
+spent waiting on the quota versus fetching, checkpoint write durations and
+progress, and periodically writes them as JSON and Prometheus text so a slow
+run can be diagnosed as quota-, latency- or checkpoint-bound while it runs.
+"""
+import json
+import os
+import threading
+import time
+from contextlib import contextmanager
+
+LATENCY_BUCKETS = (0.1, 0.25, 0.5, 1, 2.5, 5, 10, 30, 60)
+ROWS_BUCKETS = (0, 10, 100, 1000, 5000, 10000, 25000, 50000, 100000)
+CHECKPOINT_BUCKETS = (0.01, 0.05, 0.1, 0.5, 1, 5, 10, 30)
+
+
+class Histogram:
+    """Cumulative-bucket histogram in the Prometheus style (not thread-safe on its own)."""
+
+    def __init__(self, buckets):
+        self.buckets = tuple(buckets)
+        self.counts = [0] * (len(self.buckets) + 1)  # last slot is +Inf
+        self.sum = 0.0
+        self.count = 0
+
+    def observe(self, value):
+        for i, bound in enumerate(self.buckets):
+            if value <= bound:
+                self.counts[i] += 1
+                break
+        else:
+            self.counts[-1] += 1
+        self.sum += value
+        self.count += 1
+
+    def cumulative(self):
+        total, out = 0, []
+        for bound, n in zip(self.buckets + ('+Inf',), self.counts):
+            total += n
+            out.append((bound, total))
+        return out
+
+    def as_dict(self):
+        return {
+            'count': self.count,
+            'sum': round(self.sum, 4),
+            'mean': round(self.sum / self.count, 4) if self.count else None,
+            'buckets': {str(b): n for b, n in self.cumulative()},
+        }
+
+
+class FetchMetrics:
+    """
+    Thread-safe metrics for one fetcher process. `path` is a file stem;
+    `<path>.json` and `<path>.prom` are rewritten every `interval` seconds
+    while `start()`ed, and once more on `stop()`.
+    """
+
+    def __init__(self, path=None, interval=15):
+        self.path = path
+        self.interval = interval
+        self.lock = threading.Lock()
+        self.started = None  # set by start(), so setup before fetching is not timed
+        self.histograms = {
+            'call_latency_seconds': Histogram(LATENCY_BUCKETS),
+            'rows_per_call': Histogram(ROWS_BUCKETS),
+            'checkpoint_seconds': Histogram(CHECKPOINT_BUCKETS),
+        }
+        self.counters = {
+            'calls': 0, 'cache_hits': 0, 'http_403': 0, 'none_responses': 0,
+            'api_errors': 0, 'errors': 0, 'retries': 0, 'splits': 0, 'rows': 0,
+            'duplicate_rows': 0, 'conflicting_rows': 0,
+        }
+        # Thread-seconds: fetching and sleeping are summed over the engine's worker threads
+        self.seconds = {'fetching': 0.0, 'quota_sleep': 0.0, 'rate_sleep': 0.0, 'checkpoint': 0.0}
+        self.progress = {'done': 0, 'total': 0}
+        self.stop_event = threading.Event()
+        self.writer = None
+
+    # ------------------------------------------------------------
+    # recording
+    def count(self, name, n=1):
+        with self.lock:
+            self.counters[name] = self.counters.get(name, 0) + n
+
+    def add_seconds(self, name, seconds):
+        with self.lock:
+            self.seconds[name] = self.seconds.get(name, 0.0) + seconds
+
+    def observe_call(self, seconds):
+        with self.lock:
+            self.counters['calls'] += 1
+            self.seconds['fetching'] += seconds
+            self.histograms['call_latency_seconds'].observe(seconds)
+
+    def observe_rows(self, rows):
+        with self.lock:
+            self.counters['rows'] += rows
+            self.histograms['rows_per_call'].observe(rows)
+
+    @contextmanager
+    def checkpoint(self):
+        """Time a checkpoint write."""
+        start = time.monotonic()
+        try:
+            yield
+        finally:
+            elapsed = time.monotonic() - start
+            with self.lock:
+                self.seconds['checkpoint'] += elapsed
+                self.histograms['checkpoint_seconds'].observe(elapsed)
+
+    def set_progress(self, done, total):
+        with self.lock:
+            self.progress = {'done': done, 'total': total}
+
+    # ------------------------------------------------------------
+    # reporting
+    def snapshot(self):
+        with self.lock:
+            elapsed = time.time() - self.started if self.started else 0.0
+            done, total = self.progress['done'], self.progress['total']
+            rate = done / elapsed if elapsed > 0 else 0.0
+            eta = (total - done) / rate if rate > 0 else None
+            return {
+                'updated_at': time.strftime('%Y-%m-%dT%H:%M:%S'),
+                'elapsed_seconds': round(elapsed, 1),
+                'progress': {'done': done, 'total': total, 'requests_per_second': round(rate, 4),
+                             'eta_seconds': round(eta, 1) if eta is not None else None},
+                'counters': dict(self.counters),
+                'seconds': {k: round(v, 3) for k, v in self.seconds.items()},
+                'histograms': {name: h.as_dict() for name, h in self.histograms.items()},
+            }
+
+    def prometheus(self, snap=None):
+        """Render a snapshot in the Prometheus text exposition format."""
+        snap = snap or self.snapshot()
+        lines = []
+        for name, value in snap['counters'].items():
+            lines += [f"# TYPE comtrade_fetch_{name}_total counter", f"comtrade_fetch_{name}_total {value}"]
+        lines.append("# TYPE comtrade_fetch_seconds_total counter")
+        for kind, value in snap['seconds'].items():
+            lines.append(f'comtrade_fetch_seconds_total{{kind="{kind}"}} {value}')
+        with self.lock:
+            for name, h in self.histograms.items():
+                lines.append(f"# TYPE comtrade_fetch_{name} histogram")
+                for bound, n in h.cumulative():
+                    lines.append(f'comtrade_fetch_{name}_bucket{{le="{bound}"}} {n}')
+                lines += [f"comtrade_fetch_{name}_sum {h.sum}", f"comtrade_fetch_{name}_count {h.count}"]
+        progress = snap['progress']
+        lines += [
+            "# TYPE comtrade_fetch_requests_done gauge", f"comtrade_fetch_requests_done {progress['done']}",
+            "# TYPE comtrade_fetch_requests_total gauge", f"comtrade_fetch_requests_total {progress['total']}",
+        ]
+        if progress['eta_seconds'] is not None:
+            lines += ["# TYPE comtrade_fetch_eta_seconds gauge", f"comtrade_fetch_eta_seconds {progress['eta_seconds']}"]
+        return '\n'.join(lines) + '\n'
+
+    def write(self):
+        """Atomically rewrite `<path>.json` and `<path>.prom`."""
+        if not self.path:
+            return
+        snap = self.snapshot()
+        os.makedirs(os.path.dirname(self.path) or '.', exist_ok=True)
+        for ext, text in (('.json', json.dumps(snap, indent=1)), ('.prom', self.prometheus(snap))):
+            tmp = f"{self.path}{ext}.tmp"
+            with open(tmp, 'w') as f:
+                f.write(text)
+            os.replace(tmp, self.path + ext)
+
+    def _run(self):
+        while not self.stop_event.wait(self.interval):
+            try:
+                self.write()
+            except OSError as e:
+                print(f"⚠️ Could not write metrics to {self.path}: {e}")
+
+    def start(self):
+        """Start the clock and write metrics every `interval` seconds from a background thread."""
+        self.started = self.started or time.time()
+        if self.path and self.writer is None:
+            self.writer = threading.Thread(target=self._run, daemon=True)
+            self.writer.start()
+
+    def stop(self):
+        """Stop the background writer and write a final snapshot."""
+        self.stop_event.set()
+        if self.writer is not None:
+            self.writer.join()
+            self.writer = None
+        self.write()
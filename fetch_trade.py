@@ -1,23 +1,74 @@
 """
 Downloads and caches UN Comtrade flow data by reporter, partner, HS6 group, and flow (M/X).
-Resumes from previous runs by appending to existing data.
-Auto-retries when hitting API rate limits.
+Resumes from previous runs by appending checkpoint segments to existing data.
+Auto-retries when hitting API rate limits, keeping several requests in flight
+under a quota-aware token bucket (see fetch_engine.py).
+Every raw response is kept in the shared raw cache, so `--offline` can rebuild
+trade_flows.csv without calling the API.
+Covers a range of years (annual or monthly periods); `--refresh` asks Comtrade
+which (reporter, period) slices were re-released since our last pull and only
+re-fetches those, swapping each into trade_flows.csv once its re-fetch is complete.
+Requests run highest expected trade value first; `--plan` writes the remaining
+plan with call, time and row estimates without fetching anything.
+With several subscription keys in COMTRADE_KEYS, `--shards` runs one worker
+process per key over leased (reporter, period) slices (see lease_store.py)
+and merges their output shards into trade_flows.csv.
+Run metrics (latency and rows-per-call histograms, error counts, quota sleep
+versus fetch time, checkpoint durations, ETA) are written periodically to
+data/processed/fetch_metrics.json and .prom (see fetch_metrics.py).
 """
 import os
+import argparse
+import math
+import numpy as np
 import pandas as pd
 import requests
 import comtradeapicall
 import re
 import time
-from tqdm import tqdm
+import json
+import shutil
+import subprocess
+import sys
+from collections import Counter, defaultdict
+from fetch_engine import FetchEngine, QuotaExceeded
+from checkpoint_store import SegmentStore, AS_TEXT
+from request_manifest import RequestManifest
+from request_planner import plan_batches, split_results, split_batch, is_truncated
+from raw_cache import RawCache
+from lease_store import LeaseStore, LeaseLost
+from fetch_metrics import FetchMetrics
+from country_codes import update_comtrade_reference
+import flow_schema
+from flow_schema import SchemaDrift, Descriptions
+from row_index import RowIndex
+from code_ranges import parse_codes
 
 # Configuration
 COMTRADE_KEY = os.environ.get('COMTRADE_KEY')  # Get API key from environment variable
-if not COMTRADE_KEY:
-    raise ValueError("COMTRADE_KEY environment variable is not set")
+# Comma-separated subscription keys for --shards, one worker process each
+COMTRADE_KEYS = [k.strip() for k in os.environ.get('COMTRADE_KEYS', COMTRADE_KEY or '').split(',') if k.strip()]
 OUT_CSV = 'data/processed/trade_flows.csv'
-YEAR = 2023
+# Point at standin_server.py (e.g. http://127.0.0.1:8765) to run without the live API
+COMTRADE_BASE_URL = os.environ.get('COMTRADE_BASE_URL', '').rstrip('/')
+HS_REFERENCE_URL = f"{COMTRADE_BASE_URL or 'https://comtradeapi.un.org'}/files/v1/app/reference/HS.json"
+HS_REFERENCE_CACHE = 'data/raw/hs_reference.json'
+MANIFEST_DB = 'data/processed/trade_flows_manifest.sqlite'
+DRIFT_JSON = 'data/processed/trade_flows.drift.json'  # schema drift seen in API responses
+YEARS = [2023]  # Overridden by --years
+FREQ = 'A'  # 'A' = annual periods (2023), 'M' = monthly periods (202301..202312)
 REPORTERS = [842]  # Will be replaced with all available reporters
+CONCURRENCY = int(os.environ.get('COMTRADE_CONCURRENCY', 4))  # Requests kept in flight
+RATE = float(os.environ.get('COMTRADE_RATE', 1.0))  # Sustained calls per second
+DAILY_QUOTA = int(os.environ.get('COMTRADE_DAILY_QUOTA', 500))  # Calls allowed per day
+PLAN_CSV = 'data/processed/fetch_plan.csv'
+SHARD_DIR = 'data/processed/shards'  # per-worker output of --shards, merged into OUT_CSV
+REFRESH_DIR = 'data/processed/refresh'  # re-released slices being re-fetched, swapped into OUT_CSV when complete
+LEASE_DB = 'data/processed/fetch_leases.sqlite'
+CHECKPOINT_ROWS = 5000  # buffered rows that trigger a checkpoint segment
+WORKER_RESTARTS = 3  # times --shards restarts a worker that exits with an error
+METRICS_PATH = os.environ.get('COMTRADE_METRICS', 'data/processed/fetch_metrics')  # writes .json and .prom
+METRICS_INTERVAL = float(os.environ.get('COMTRADE_METRICS_INTERVAL', 15))  # seconds between metrics writes
 
 # Top 50 U.S. goods trading partners by total trade in 2023 (ISO 3166-1 numeric codes)
 PARTNERS = [
@@ -31,23 +82,75 @@ PARTNERS = [
 # All HS chapter codes from '01' through '99'
 HS_GROUPS = [f"{i:02d}" for i in range(1, 99)] # HS chapters 1 to 99 due to API limits
 
+# Largest HS chapters by U.S. goods trade value, used for ordering until we have fetched values
+HS_PRIORITY = ['84', '85', '87', '27', '30', '90', '71', '39', '29', '88',
+               '94', '73', '40', '38', '61', '62', '64', '95', '72', '22']
+
 FLOWS = {'M': 'M', 'X': 'X'}  # M=import, X=export
+MAX_RECORDS = int(os.environ.get('COMTRADE_MAX_RECORDS', 50000))  # Record cap per call; batches are planned to stay below it
+MIN_WAIT = int(os.environ.get('COMTRADE_MIN_WAIT', 60))  # Shortest pause after a quota error
+CACHE_SOURCE = 'comtrade'
+# Columns that identify one Comtrade record; rows repeating one are rejected by the row index
+RECORD_KEY_COLUMNS = ['reporterCode', 'partnerCode', 'partner2Code', 'cmdCode', 'flowCode',
+                      'period', 'customsCode', 'motCode']
+
+raw_cache = RawCache()
+metrics = FetchMetrics(METRICS_PATH, METRICS_INTERVAL)
+RELEASES = {}  # {(reporter, period): (lastReleased, checksum)} being fetched, filled from the manifest
+schema_drift = SchemaDrift()
+_descriptions = {}
+_row_indexes = {}
 
 # Helper function to create a unique key for each request
-def create_key(reporter, partner, hs, flow_code):
-    return f"{reporter}_{partner}_{hs}_{flow_code}"
+def create_key(reporter, partner, hs, flow_code, period):
+    return f"{reporter}_{partner}_{hs}_{flow_code}_{period}"
+
+def get_periods(years=None, freq=None):
+    """Comtrade period codes for the configured years: '2023' or '202301'..'202312'"""
+    years = years or YEARS
+    if (freq or FREQ) == 'M':
+        return [f"{y}{m:02d}" for y in years for m in range(1, 13)]
+    return [str(y) for y in years]
+
+def get_availability(periods):
+    """
+    Ask Comtrade which (reporter, period) slices exist and when each was last released.
+    Returns {(reporter, period): (lastReleased, datasetChecksum)}.
+    """
+    print(f"Fetching data availability for {len(periods)} periods...")
+    if COMTRADE_BASE_URL:
+        data = requests.get(f"{COMTRADE_BASE_URL}/data/v1/getDA/C/{FREQ}/HS",
+                            params={'period': ','.join(periods)}, timeout=60).json()
+        df = pd.DataFrame(data.get('data', []))
+    else:
+        df = comtradeapicall.getFinalDataAvailability(
+            COMTRADE_KEY, typeCode='C', freqCode=FREQ, clCode='HS',
+            period=','.join(periods), reporterCode=None
+        )
+    if not isinstance(df, pd.DataFrame) or df.empty:
+        raise RuntimeError(f"Could not fetch data availability: {df}")
+    df = df[df['classificationSearchCode'] == 'HS'] if 'classificationSearchCode' in df.columns else df
+    return {
+        (int(r), str(p)): (str(released), str(checksum))
+        for r, p, released, checksum in zip(
+            df['reporterCode'], df['period'], df['lastReleased'], df.get('datasetChecksum', df['lastReleased'])
+        )
+    }
 
 def get_all_reporters():
     """Get all available reporter countries from the Comtrade API"""
     try:
         print("Fetching all available reporters from Comtrade API...")
         # Use a longer timeout for this request
-        response = requests.get("https://comtradeapi.un.org/data/v1/getReferences/reporters", timeout=30)
+        base = COMTRADE_BASE_URL or "https://comtradeapi.un.org"
+        response = requests.get(f"{base}/data/v1/getReferences/reporters", timeout=30)
         data = response.json()
         
         if 'data' in data:
             # Extract reporter IDs and sort them
             reporters = [int(item['id']) for item in data['data'] if item.get('id')]
+            # Comtrade's own code → ISO3 assignments (842 → USA, ...) for the shared table
+            update_comtrade_reference(data['data'])
             print(f"Found {len(reporters)} reporters available in the API")
             return sorted(reporters)
         else:
@@ -58,41 +161,47 @@ def get_all_reporters():
         print("Using default reporter list")
         return REPORTERS
 
-def find_last_position(df):
-    """Find the last position in the dataframe to resume processing from"""
+_hs_children = None
+
+def hs_children(code):
+    """Return the HS codes one level below `code` (e.g. '85' → ['8501', ...]), or [] if unknown"""
+    global _hs_children
+    if _hs_children is None:
+        _hs_children = defaultdict(list)
+        try:
+            if os.path.exists(HS_REFERENCE_CACHE):
+                with open(HS_REFERENCE_CACHE) as f:
+                    reference = json.load(f)
+            else:
+                print("Fetching HS code reference from Comtrade...")
+                reference = requests.get(HS_REFERENCE_URL, timeout=60).json()
+                os.makedirs(os.path.dirname(HS_REFERENCE_CACHE), exist_ok=True)
+                with open(HS_REFERENCE_CACHE, 'w') as f:
+                    json.dump(reference, f)
+            for item in reference.get('results', []):
+                if item.get('parent'):
+                    _hs_children[str(item['parent'])].append(str(item['id']))
+        except Exception as e:
+            print(f"Error loading HS reference, cannot split below current HS level: {e}")
+    return sorted(_hs_children.get(code, []))
+
+def bootstrap_manifest(manifest, store):
+    """
+    One-off migration for runs that predate the manifest: mark every
+    reporter/partner/HS/flow/period combination already present in the CSV as done.
+    """
+    df = store.read_all(usecols=['reporterCode', 'partnerCode', 'cmdCode', 'flowCode', 'period'])
     if df is None or len(df) == 0:
-        return None
-    
-    # Get unique combinations from the dataframe
-    combos = df[['reporterCode', 'partnerCode', 'cmdCode', 'flowCode']].drop_duplicates()
+        return 0
     
-    # Make sure cmdCode is a string with at least 2 characters (HS chapter)
-    combos['cmdCode'] = combos['cmdCode'].astype(str)
-    combos['cmdCode'] = combos['cmdCode'].apply(lambda x: x.zfill(2)[:2])
-    
-    # Get the last combination based on our iteration order
-    last_reporter = combos['reporterCode'].max()
-    
-    # For this reporter, get the last partner
-    reporter_combos = combos[combos['reporterCode'] == last_reporter]
-    last_partner = reporter_combos['partnerCode'].max()
-    
-    # For this reporter+partner, get the last HS code
-    partner_combos = reporter_combos[reporter_combos['partnerCode'] == last_partner]
-    last_hs = partner_combos['cmdCode'].max()
-    
-    # For this reporter+partner+hs, get the last flow
-    hs_combos = partner_combos[partner_combos['cmdCode'] == last_hs]
-    last_flow = hs_combos['flowCode'].max()
-    
-    print(f"Resuming from last position: Reporter={last_reporter}, Partner={last_partner}, HS={last_hs}, Flow={last_flow}")
-    
-    return {
-        'reporter': int(last_reporter),
-        'partner': int(last_partner),
-        'hs': last_hs,
-        'flow': last_flow
-    }
+    df['hs'] = df['cmdCode'].astype(str).str.zfill(2).str[:2]
+    df['period'] = df['period'].astype(str)
+    counts = df.groupby(['reporterCode', 'partnerCode', 'hs', 'flowCode', 'period']).size()
+    manifest.record_many([
+        (create_key(r, p, hs, f, per), int(r), int(p), hs, f, per, 'ok', int(n), None, 'bootstrapped from CSV')
+        for (r, p, hs, f, per), n in counts.items()
+    ])
+    return len(counts)
 
 def parse_wait_time(error_msg):
     """Extract wait time from API error message or default to 60 seconds"""
@@ -105,343 +214,846 @@ def parse_wait_time(error_msg):
         # Default to 60 seconds if we can't parse the time
         return 60
 
-def main():
+def is_quota_error(error_str):
+    """True if an API error message means the call volume quota is exhausted"""
+    return "Out of call volume quota" in error_str or ("403" in error_str and "quota" in error_str.lower())
+
+def batch_params(batch):
+    """getFinalData/previewFinalData arguments for one planned batch (also the raw cache key)"""
+    return dict(
+        typeCode='C', 
+        freqCode=FREQ,
+        clCode='HS', 
+        period=str(batch.period),
+        reporterCode=str(batch.reporter), 
+        partnerCode=','.join(str(p) for p in batch.partners),
+        cmdCode=','.join(batch.hs_codes), 
+        flowCode=','.join(FLOWS[f] for f in batch.flows),
+        partner2Code=None,
+        customsCode=None,
+        motCode=None,
+        maxRecords=MAX_RECORDS,
+        format_output='JSON',
+        aggregateBy=None,
+        breakdownMode='classic',
+        countOnly=None,
+        includeDesc=True
+    )
+
+_session = None
+
+def final_data(**params):
+    """
+    comtradeapicall.getFinalData with this process's COMTRADE_KEY (so each key
+    spends its own quota), or the same request against COMTRADE_BASE_URL.
+    Without a key it falls back to the public preview endpoint. Mirrors the
+    library's behaviour: DataFrame on success, the error dict on a 403, None
+    on any other HTTP failure.
+    """
+    global _session
+    if not COMTRADE_BASE_URL:
+        if COMTRADE_KEY:
+            return comtradeapicall.getFinalData(COMTRADE_KEY, **params)
+        return comtradeapicall.previewFinalData(**params)
+    if _session is None:
+        _session = requests.Session()
+        if COMTRADE_KEY:
+            _session.headers['Ocp-Apim-Subscription-Key'] = COMTRADE_KEY
+    endpoint = 'data/v1/get' if COMTRADE_KEY else 'public/v1/preview'
+    url = f"{COMTRADE_BASE_URL}/{endpoint}/{params['typeCode']}/{params['freqCode']}/{params['clCode']}"
+    query = {k: v for k, v in params.items()
+             if v is not None and k not in ('typeCode', 'freqCode', 'clCode', 'format_output')}
+    r = _session.get(url, params=query, timeout=60)
+    if r.status_code == 403:
+        return r.json()
+    if not r.ok:
+        return None
+    return pd.DataFrame(r.json().get('data', []))
+
+def cache_params(batch):
+    """Raw cache key: the API arguments plus the release they were fetched from, when known"""
+    params = batch_params(batch)
+    release = RELEASES.get((int(batch.reporter), str(batch.period)))
+    if release is not None:
+        params['release'] = list(release)
+    return params
+
+def cached_batch(batch):
+    """Return the cached response for a batch as a DataFrame, or None (no quota spent)"""
+    records = raw_cache.get(CACHE_SOURCE, cache_params(batch))
+    if records is None:
+        return None
+    print(f"⇢ {batch.describe()} (cached)")
+    return flow_schema.conform(pd.DataFrame.from_records(records), schema_drift)
+
+def fetch_one(batch):
+    """
+    Fetch one planned batch: a reporter against comma-separated partner,
+    HS chapter and flow lists.
+    Raises QuotaExceeded when the API reports a rate limit so the engine can
+    pause new dispatches and retry the request later.
+    """
+    print(f"→ {batch.describe()}")
+    try:
+        df = final_data(**batch_params(batch))
+    except Exception as e:
+        if is_quota_error(str(e)):
+            raise QuotaExceeded(parse_wait_time(str(e)), str(e))
+        raise
+
+    # Check if response is a rate limit error dict
+    if isinstance(df, dict) and df.get('statusCode') == 403 and "quota" in str(df.get('message', '')).lower():
+        print(f"{df}")  # Print the error message for debugging
+        metrics.count('http_403')
+        raise QuotaExceeded(parse_wait_time(str(df.get('message', ''))), str(df.get('message', '')))
+    # Also treat None responses as rate limit errors
+    if df is None:
+        print("Received None response - likely a rate limit error")
+        metrics.count('none_responses')
+        raise QuotaExceeded(MIN_WAIT, "None response")
+    if isinstance(df, pd.DataFrame):
+        metrics.observe_rows(len(df))
+        raw_cache.put(CACHE_SOURCE, cache_params(batch), df.to_dict('records'))
+        # The cache keeps the response verbatim; from here on it has the declared schema
+        df = flow_schema.conform(df, schema_drift)
+    return df
+
+def descriptions_for(store):
+    """Description lookups kept next to a store's CSV (one per process and file)"""
+    path = flow_schema.lookups_path(store.out_csv)
+    if path not in _descriptions:
+        _descriptions[path] = Descriptions(path)
+    return _descriptions[path]
+
+def report_drift(path=DRIFT_JSON):
+    """Write the schema drift seen this run, if any"""
+    if schema_drift.total():
+        schema_drift.write(path)
+        print(f"⚠️ Schema drift in {schema_drift.total()} values/columns → {path}")
+
+def row_index_for(store):
+    """Row-hash index of a store's rows (one per process and file), rebuilt if out of step with the store"""
+    if store.out_csv not in _row_indexes:
+        index = RowIndex(store.out_csv, RECORD_KEY_COLUMNS)
+        index.sync(store)
+        _row_indexes[store.out_csv] = index
+    return _row_indexes[store.out_csv]
+
+def append_rows(store, df):
+    """
+    Append stored-layout rows to `store` through its row index: rows already
+    held are dropped, conflicting revisions set aside. Returns (rows written, rejected).
+    """
+    index = row_index_for(store)
+    conflicts = index.conflicts
+    fresh = index.admit(df)
+    rows = store.append(fresh)
+    index.commit()
+    rejected = len(df) - len(fresh)
+    new_conflicts = index.conflicts - conflicts
+    if rejected:
+        metrics.count('duplicate_rows', rejected - new_conflicts)
+        metrics.count('conflicting_rows', new_conflicts)
+    if new_conflicts:
+        print(f"⚠️ {new_conflicts} rows revise an already stored record with different values; "
+              f"kept the stored one, new ones → {index.conflicts_path}")
+    return rows, rejected
+
+def rebuild_from_cache():
+    """
+    Rebuild OUT_CSV purely from cached Comtrade responses.
+    Overlapping batches (split parents, re-planned blocks) are de-duplicated
+    through a fresh row index, streaming one response at a time. Responses
+    from a release older than the one recorded in the manifest are skipped.
+    If keys the manifest has rows for are no longer cached (evicted from the
+    raw cache), the existing OUT_CSV is kept and the missing keys are listed.
+    """
+    manifest = RequestManifest(MANIFEST_DB)
+    current = manifest.releases()
+    expected = manifest.keys_with_rows()
+    manifest.close()
     os.makedirs(os.path.dirname(OUT_CSV), exist_ok=True)
+    tmp = OUT_CSV + '.rebuild'
+    descriptions = Descriptions(flow_schema.lookups_path(OUT_CSV))
+    index = RowIndex(tmp, RECORD_KEY_COLUMNS)
+    index.discard()
+    header = True
+    responses = rows = 0
+    covered = set()
+    for params, records in raw_cache.entries(CACHE_SOURCE):
+        release = current.get((int(params['reporterCode']), str(params['period'])))
+        if not records or (release is not None and params.get('release') != list(release)):
+            continue
+        df = flow_schema.conform(pd.DataFrame.from_records(records), schema_drift)
+        keys = df[['reporterCode', 'partnerCode', 'cmdCode', 'flowCode', 'period']].astype(str)
+        keys['cmdCode'] = keys['cmdCode'].str.zfill(2).str[:2]
+        covered.update(map(create_key, *keys.drop_duplicates().to_numpy().T))
+        df = index.admit(flow_schema.stored(df, descriptions, schema_drift))
+        responses += 1
+        if df.empty:
+            continue
+        df.to_csv(tmp, mode='w' if header else 'a', header=header, index=False)
+        index.commit()
+        header = False
+        rows += len(df)
+    missing = sorted(expected - covered)
+    if header or (missing and os.path.exists(OUT_CSV)):
+        if os.path.exists(tmp):
+            os.remove(tmp)
+        index.discard()
+        if os.path.exists(index.conflicts_path):
+            os.remove(index.conflicts_path)
+    if header:
+        print("No cached Comtrade responses found - nothing to rebuild")
+        return
+    if missing and os.path.exists(OUT_CSV):
+        # e.g. evicted from the raw cache (RAW_CACHE_MAX_BYTES): replacing OUT_CSV would lose their rows
+        print(f"✗ {len(missing)} of {len(expected)} keys with rows in {OUT_CSV} are no longer in the raw cache, "
+              f"e.g. {', '.join(missing[:10])}")
+        print(f"   Kept {OUT_CSV} as it is; re-fetch those keys (or remove {OUT_CSV}) to rebuild offline")
+        raise SystemExit(1)
+    descriptions.save()
+    os.replace(tmp, OUT_CSV)
+    index.rename(OUT_CSV)
+    report_drift()
+    print(f"✓ Rebuilt {OUT_CSV} offline from {responses} cached responses ({rows} rows)")
+    if index.conflicts:
+        print(f"⚠️ {index.conflicts} conflicting revisions left out → {index.conflicts_path}")
+
+def rank_weights(ranked, fetched):
+    """
+    Weight per code: its fetched trade value share when we have one, otherwise
+    a rank-based prior (1, 1/2, 1/3, ...) from the static ordering.
+    """
+    weights = {code: 1.0 / (rank + 1) for rank, code in enumerate(ranked)}
+    total = sum(fetched.values())
+    if total:
+        weights.update({code: len(ranked) * value / total for code, value in fetched.items()})
+    return weights
+
+def prioritise(pending, manifest):
+    """
+    Order pending keys by expected trade value (reporter × partner × HS weight),
+    so a partially finished run already covers most of the dollar volume.
+    Returns (ordered keys, {key: score}).
+    """
+    reporter_w = rank_weights([842] + PARTNERS, manifest.value_by('reporter'))
+    partner_w = rank_weights(PARTNERS, manifest.value_by('partner'))
+    hs_w = rank_weights(HS_PRIORITY, manifest.value_by('hs'))
+    floor = 1.0 / 1000  # unknown codes go last, still in their original order
+    scores = {
+        k: reporter_w.get(k[0], floor) * partner_w.get(k[1], floor) * hs_w.get(k[2], floor)
+        for k in pending
+    }
+    return sorted(pending, key=scores.get, reverse=True), scores
+
+def estimate_seconds(calls):
+    """Wall-clock seconds for `calls` under the rate limit and daily quota"""
+    if calls <= DAILY_QUOTA:
+        return calls / RATE
+    full_days = math.ceil(calls / DAILY_QUOTA) - 1
+    return full_days * 86400 + (calls - full_days * DAILY_QUOTA) / RATE
+
+def write_plan(batches, scores, pending_keys, manifest):
+    """Write the ordered fetch plan with per-batch estimates and print a summary"""
+    rows_per_key = manifest.rows_per_key() or 1.0
+    total_score = sum(scores.values()) or 1.0
+    plan = []
+    covered = 0.0
+    for i, batch in enumerate(batches):
+        keys = [k for k in batch.keys() if k in pending_keys]
+        covered += sum(scores[k] for k in keys)
+        plan.append({
+            'order': i + 1,
+            'reporter': batch.reporter,
+            'period': batch.period,
+            'partners': ','.join(map(str, batch.partners)),
+            'hs_codes': ','.join(batch.hs_codes),
+            'flows': ','.join(batch.flows),
+            'keys': len(keys),
+            'expected_rows': round(len(keys) * rows_per_key),
+            'cumulative_value_share': round(covered / total_score, 4),
+            'eta_hours': round(estimate_seconds(i + 1) / 3600, 2),
+        })
+    pd.DataFrame(plan).to_csv(PLAN_CSV, index=False)
     
-    # Get all reporters instead of using the fixed list
-    global REPORTERS
-    REPORTERS = get_all_reporters()
+    seconds = estimate_seconds(len(batches))
+    print(f"✓ Wrote fetch plan → {PLAN_CSV}")
+    print(f"   Calls:          {len(batches)} ({len(pending_keys)} reporter-partner-HS-flow-period keys)")
+    print(f"   Expected rows:  {round(len(pending_keys) * rows_per_key)} ({rows_per_key:.2f} per key)")
+    print(f"   Wall clock:     {seconds / 3600:.1f} h at {RATE} calls/s and {DAILY_QUOTA} calls/day")
+    for share in (0.5, 0.9):
+        first = next((p for p in plan if p['cumulative_value_share'] >= share), None)
+        if first:
+            print(f"   {int(share * 100)}% of expected value after {first['order']} calls (~{first['eta_hours']} h)")
+
+def refresh_changed_slices(manifest, available):
+    """
+    Compare Comtrade's release metadata with what we last pulled and start
+    re-fetching the (reporter, period) slices that changed into REFRESH_DIR.
+    Their old rows stay in OUT_CSV until the re-fetch is complete (see
+    swap_refreshed). Returns (reporters with data, {slice: release} changed).
+    """
+    known = manifest.releases()
+    changed = {s: release for s, release in available.items() if known.get(s) != release}
+    print(f"✓ {len(available)} reporter-period slices available, {len(changed)} new or re-released since last pull")
     
-    # Check for existing data and track what's already been fetched
-    completed_requests = set()
-    existing_data = None
-    last_position = None
+    refreshing = manifest.refreshing()
+    for (reporter, period), release in changed.items():
+        if refreshing.get((reporter, period)) == release:
+            continue  # an interrupted refresh already started on this release
+        manifest.start_refresh(reporter, period, *release)
+        for staging in refresh_stores(reporter, period):
+            remove_store(staging)  # rows of an earlier release
     
-    if os.path.exists(OUT_CSV):
-        print(f"⇢ {OUT_CSV} exists - loading to resume from last checkpoint")
+    RELEASES.update(changed)
+    reporters = sorted({r for r, _ in changed})
+    return reporters, changed
+
+def open_manifest(store):
+    """Open the request manifest, migrating or bootstrapping it from older runs where needed"""
+    store.close()  # fold leftover segments in before checking the CSV layout
+    if flow_schema.migrate(store.out_csv, descriptions_for(store), schema_drift):
+        print(f"✓ Rewrote {store.out_csv} in the compact schema (descriptions → "
+              f"{flow_schema.lookups_path(store.out_csv)})")
+        RowIndex(store.out_csv, RECORD_KEY_COLUMNS).discard()  # hashed the old layout
+    row_index_for(store)
+    if store_names(SHARD_DIR):
+        # A sharded run died before merging: its workers already marked these keys ok
+        print(f"⇢ Found unmerged shards in {SHARD_DIR} from an interrupted sharded run")
+        merge_shards(store)
+    manifest = RequestManifest(MANIFEST_DB)
+    swapped = {refresh_slice(name) for name in store_names(REFRESH_DIR)} - set(manifest.refreshing())
+    if swapped:
+        # A swap died after recording these slices' releases: finish moving their rows in
+        print(f"⇢ Found {len(swapped)} refreshed slices in {REFRESH_DIR} from an interrupted swap")
+        for reporter, period in sorted(swapped):
+            for staging in refresh_stores(reporter, period):
+                absorb_store(store, staging)
+        descriptions_for(store).save()
+    migrated = manifest.migrate_periods('2023')  # keys written before periods were tracked
+    if migrated:
+        print(f"✓ Tagged {migrated} pre-existing manifest entries with period 2023")
+    
+    if len(manifest) == 0 and (os.path.exists(OUT_CSV) or store.segment_paths()):
+        print(f"⇢ {OUT_CSV} exists but no manifest yet - indexing existing rows once")
         try:
-            existing_data = pd.read_csv(OUT_CSV)
-            
-            # Find the last position in the CSV to resume from
-            last_position = find_last_position(existing_data)
-            
-            # Extract unique combinations that have already been processed
-            for _, row in existing_data.iterrows():
-                reporter = row.get('reporterCode')
-                partner = row.get('partnerCode')
-                hs = str(row.get('cmdCode')).zfill(2)[:2]  # Get first 2 digits and ensure it's padded
-                flow_code = row.get('flowCode')
-                
-                if all(x is not None for x in [reporter, partner, hs, flow_code]):
-                    completed_requests.add(create_key(reporter, partner, hs, flow_code))
-            
-            print(f"✓ Found {len(completed_requests)} already completed reporter-partner-HS-flow combinations")
+            indexed = bootstrap_manifest(manifest, store)
+            print(f"✓ Indexed {indexed} completed combinations into {MANIFEST_DB}")
         except Exception as e:
-            print(f"Error reading existing CSV: {e}")
+            print(f"Error indexing existing CSV: {e}")
             print("Will start fresh but append to the file")
-    
-    # Calculate total operations and remaining ones for progress tracking
-    total_requests = len(REPORTERS) * len(PARTNERS) * len(HS_GROUPS) * len(FLOWS)
-    remaining_requests = total_requests - len(completed_requests)
-    
-    print(f"Starting fetch of remaining {remaining_requests} API requests out of {total_requests} total...")
+    RELEASES.update(manifest.releases())
+    RELEASES.update(manifest.refreshing())
+    return manifest
+
+def select_reporters(manifest, periods, refresh):
+    """
+    Fill REPORTERS for this run and RELEASES for the slices it fetches;
+    when refreshing, returns the {slice: release} that changed
+    """
+    global REPORTERS
+    changed = {}
+    if refresh:
+        # Only reporters with re-released data in the requested periods
+        REPORTERS, changed = refresh_changed_slices(manifest, get_availability(periods))
+    else:
+        # Get all reporters instead of using the fixed list
+        REPORTERS = get_all_reporters()
+        try:
+            available = get_availability(periods)
+        except Exception as e:
+            print(f"Error fetching data availability: {e}")
+            print("Slices fetched this run will be treated as new by the next --refresh")
+            available = {}
+        # Slices we hold keep their release until --refresh re-fetches them
+        for s, release in available.items():
+            RELEASES.setdefault(s, release)
+    return changed
+
+def plan_run(pending, manifest):
+    """Order pending keys by value and pack them into batches; returns (batches, scores)"""
+    pending, scores = prioritise(pending, manifest)
+    densities, levels = manifest.split_hints()
+    batches = plan_batches(pending, MAX_RECORDS, densities=densities, levels=levels, children_of=hs_children)
+    # Calls covering the most expected value go first
+    batches.sort(key=lambda b: sum(scores.get(k, 0) for k in b.keys()), reverse=True)
+    return batches, scores
+
+def record_release(manifest, reporter, period):
+    """Remember the release a slice was pulled at, once all of its keys are in"""
+    release = RELEASES.get((reporter, period))
+    if release is not None:
+        manifest.set_release(reporter, period, *release)
+
+def gather_rows(parts):
+    """One frame from (response, row positions) parts, taking each response's rows at once"""
+    by_source = {}
+    for src, positions in parts:
+        by_source.setdefault(id(src), (src, []))[1].append(positions)
+    return pd.concat([src.take(np.concatenate(pos)) for src, pos in by_source.values()], ignore_index=True)
+
+def fetch_batches(batches, pending_keys, manifest, store, lost=None, staged=False):
+    """
+    Fetch planned batches through the engine, checkpointing rows to `store`
+    and then the keys they cover to `manifest`. Returns the number of new rows.
+    Each slice's release is recorded as its last key comes in, unless `store`
+    is a refresh staging store (the release is recorded when it is swapped in).
+    Raises LeaseLost once the Event `lost` is set (a sharded worker's lease
+    was taken over), after saving what has been fetched.
+    """
+    # A key may be covered by several HS sub-slices; it is only recorded once all have returned
+    outstanding = Counter(k for batch in batches for k in batch.keys() if k in pending_keys)
+    slice_left = Counter((reporter, period) for reporter, _, _, _, period in outstanding)
+    partial = defaultdict(list)
+    failed = {}
+    remaining_requests = len(batches)
+    # Progress accumulates across calls (one per lease in a sharded worker)
+    base_done, base_total = metrics.progress['done'], metrics.progress['total']
 
     frames = []
+    records = []  # manifest entries waiting for their rows to hit disk
     completed = 0
+    new_rows = 0
     last_percentage = 0
     # Save much more frequently - every 10 requests instead of every 5%
     save_checkpoint_every = 10
     
-    # Helper function to save checkpoint data
-    def save_checkpoint(frames_to_save, existing_df=None):
-        if not frames_to_save:
-            return existing_df
-        
-        checkpoint_df = pd.concat(frames_to_save, ignore_index=True)
-        
-        if existing_df is not None:
-            combined_df = pd.concat([existing_df, checkpoint_df], ignore_index=True)
-            combined_df.to_csv(OUT_CSV, index=False)
-            print(f"✓ Checkpoint saved: combined {len(existing_df)} existing + {len(checkpoint_df)} new rows")
-            return combined_df
-        else:
-            checkpoint_df.to_csv(OUT_CSV, index=False)
-            print(f"✓ Initial checkpoint saved with {len(checkpoint_df)} rows")
-            return checkpoint_df
+    # Helper function to save checkpoint data as a new segment (cost is O(batch)),
+    # then mark the requests it covers in the manifest
+    def save_checkpoint(frames_to_save):
+        nonlocal new_rows, records
+        with metrics.checkpoint():
+            if frames_to_save:
+                descriptions = descriptions_for(store)
+                rows, rejected = append_rows(
+                    store, flow_schema.stored(gather_rows(frames_to_save), descriptions, schema_drift))
+                descriptions.save()
+                new_rows += rows
+                print(f"✓ Checkpoint saved: {rows} new rows ({new_rows} this run)"
+                      + (f", {rejected} already stored" if rejected else ""))
+            if records:
+                manifest.record_many(records)
+                done = Counter((reporter, period) for _, reporter, _, _, _, period, status, *_ in records
+                               if status != 'error')
+                records = []
+                for s, n in done.items():
+                    slice_left[s] -= n
+                    if slice_left[s] == 0 and not staged:
+                        record_release(manifest, *s)
     
-    # Determine starting positions based on last_position
-    reporter_start_idx = 0
-    if last_position:
-        # Find the index of the last reporter
-        try:
-            reporter_start_idx = REPORTERS.index(last_position['reporter'])
-        except ValueError:
-            print(f"Warning: Last reporter {last_position['reporter']} not found in REPORTERS list. Starting from beginning.")
-            reporter_start_idx = 0
+    # Mark one slice of a key as returned; record the key once its last slice is in.
+    # A part is (response frame, row positions of this key in it).
+    def finish_slice(key, part=None, error=None):
+        if error is not None:
+            failed[key] = error
+        elif part is not None and len(part[1]):
+            partial[key].append(part)
+        outstanding[key] -= 1
+        if outstanding[key] > 0:
+            return
+        parts = partial.pop(key, [])
+        if key in failed:
+            records.append((create_key(*key), *key, 'error', 0, None, failed.pop(key)))
+        elif parts:
+            frames.extend(parts)
+            value = sum(float(src['primaryValue'].to_numpy()[pos].sum())
+                        for src, pos in parts if 'primaryValue' in src.columns)
+            records.append((create_key(*key), *key, 'ok', sum(len(pos) for _, pos in parts), value, None))
+        else:
+            # Record empty responses so they are not requested again
+            records.append((create_key(*key), *key, 'empty', 0, 0.0, None))
     
-    # Loop through reporters, starting from the last one
-    for reporter_idx in range(reporter_start_idx, len(REPORTERS)):
-        reporter = REPORTERS[reporter_idx]
+    # Runs on the main thread as each batch finishes; returns follow-up batches to fetch
+    def on_result(batch, df, error):
+        nonlocal frames, completed, last_percentage, remaining_requests
+        if lost is not None and lost.is_set():
+            raise LeaseLost(f"lease on {batch.reporter}/{batch.period} was taken over")
+        # Only keys still pending are recorded; a batch block may overlap finished ones
+        keys = [k for k in batch.keys() if k in pending_keys]
+        children = []
         
-        # Determine partner starting position for this reporter
-        partner_start_idx = 0
-        if last_position and reporter == last_position['reporter']:
-            try:
-                partner_start_idx = PARTNERS.index(last_position['partner'])
-            except ValueError:
-                print(f"Warning: Last partner {last_position['partner']} not found in PARTNERS list. Starting from first partner for reporter {reporter}.")
+        if error is not None:
+            print(f"Skipping {batch.describe()} due to error: {error}")
+            for k in keys:
+                finish_slice(k, error=str(error))
+        elif isinstance(df, dict) and 'statusCode' in df:
+            # Other API error, not rate-limit related
+            print(f"API returned error: {df}")
+            print("Skipping due to API error")
+            metrics.count('api_errors')
+            for k in keys:
+                finish_slice(k, error=str(df))
+        elif isinstance(df, pd.DataFrame) and is_truncated(df, MAX_RECORDS):
+            children, reason = split_batch(batch, hs_children)
+            if children:
+                # Response hit the record cap: re-fetch it as smaller slices
+                print(f"⚠️ {batch.describe()} hit maxRecords={MAX_RECORDS}; splitting by {reason} into {len(children)}")
+                manifest.record_split(batch, children, reason, len(df))
+                metrics.count('splits')
+                child_keys = [set(c.keys()) for c in children]
+                for k in keys:
+                    outstanding[k] += sum(k in ck for ck in child_keys) - 1
+                remaining_requests += len(children)
+            else:
+                print(f"⚠️ {batch.describe()} hit maxRecords={MAX_RECORDS} at HS6 level; keeping truncated rows")
+                parts = split_results(batch, df)
+                for k in keys:
+                    finish_slice(k, (df, parts[k]))
+        elif isinstance(df, pd.DataFrame):
+            # Split the batch back out into per-key slices
+            parts = split_results(batch, df)
+            for k in keys:
+                finish_slice(k, (df, parts[k]))
+        else:
+            print(f"Unexpected response type: {type(df)}")
+            for k in keys:
+                finish_slice(k, error=f"unexpected {type(df).__name__}")
         
-        for partner_idx in range(partner_start_idx, len(PARTNERS)):
-            partner = PARTNERS[partner_idx]
-            
-            # Determine HS starting position for this reporter+partner
-            hs_start_idx = 0
-            if last_position and reporter == last_position['reporter'] and partner == last_position['partner']:
-                try:
-                    hs_start_idx = HS_GROUPS.index(last_position['hs'])
-                except ValueError:
-                    print(f"Warning: Last HS code {last_position['hs']} not found. Starting from first HS code for reporter {reporter}, partner {partner}.")
-            
-            for hs_idx in range(hs_start_idx, len(HS_GROUPS)):
-                hs = HS_GROUPS[hs_idx]
-                
-                # Determine flow starting position
-                flow_start_idx = 0
-                if last_position and reporter == last_position['reporter'] and partner == last_position['partner'] and hs == last_position['hs']:
-                    # Find the starting flow
-                    flow_keys = list(FLOWS.keys())
-                    try:
-                        flow_start_idx = flow_keys.index(last_position['flow'])
-                        # Move to the next flow (we've already done this one)
-                        flow_start_idx += 1
-                    except ValueError:
-                        print(f"Warning: Last flow {last_position['flow']} not found. Starting from first flow for this combination.")
-                
-                # If we've already processed all flows for the last position, move to next HS code
-                if last_position and flow_start_idx >= len(FLOWS):
-                    continue
-                
-                flow_keys = list(FLOWS.keys())
-                for flow_idx in range(flow_start_idx, len(flow_keys)):
-                    flow_code = flow_keys[flow_idx]
-                    flow = FLOWS[flow_code]
-                    
-                    # After the first iteration, we don't need to use last_position anymore
-                    # We'll be continuing the regular iteration pattern
-                    last_position = None
-                    
-                    # Skip if this combination has already been fetched
-                    request_key = create_key(reporter, partner, hs, flow_code)
-                    if request_key in completed_requests:
-                        continue
-                    
-                    # Keep trying until we get data or encounter a non-rate-limit error
-                    success = False
-                    max_retries = 60  # Safety limit to prevent infinite loops
-                    retries = 0
-                    
-                    while not success and retries < max_retries:
-                        print(f"→ {reporter}->{partner}  HS{hs} {YEAR} flow:{flow_code}")
-                        try:
-                            df = comtradeapicall.previewFinalData(
-                                typeCode='C', 
-                                freqCode='A',
-                                clCode='HS', 
-                                period=str(YEAR),
-                                reporterCode=str(reporter), 
-                                partnerCode=str(partner),
-                                cmdCode=hs, 
-                                flowCode=flow,
-                                partner2Code=None,
-                                customsCode=None,
-                                motCode=None,
-                                maxRecords=50000,
-                                format_output='JSON',
-                                aggregateBy=None,
-                                breakdownMode='classic',
-                                countOnly=None,
-                                includeDesc=True
-                            )
-                            
-                            # Check if response is a rate limit error dict
-                            if isinstance(df, dict) and 'statusCode' in df and df.get('statusCode') == 403 and "quota" in str(df.get('message', '')).lower():
-                                print(f"{df}")  # Print the error message for debugging
-                                
-                                # This is a rate limit error - handle it properly
-                                retries += 1
-                                wait_seconds = parse_wait_time(str(df.get('message', '')))
-                                
-                                print(f"\n⏱️ RATE LIMIT REACHED: API quota exceeded. Waiting {wait_seconds} seconds before retry {retries}/{max_retries}...")
-                                
-                                # Checkpoint save if we have data so far
-                                if frames:
-                                    print("Saving checkpoint before waiting...")
-                                    checkpoint_df = pd.concat(frames, ignore_index=True)
-                                    
-                                    if existing_data is not None:
-                                        combined_df = pd.concat([existing_data, checkpoint_df], ignore_index=True)
-                                        combined_df.to_csv(OUT_CSV, index=False)
-                                        print(f"✓ Checkpoint saved: combined {len(existing_data)} existing + {len(checkpoint_df)} new rows")
-                                        existing_data = combined_df
-                                    else:
-                                        checkpoint_df.to_csv(OUT_CSV, index=False)
-                                        existing_data = checkpoint_df
-                                        print(f"✓ Initial checkpoint saved with {len(checkpoint_df)} rows")
-                                    
-                                    frames = []
-                                
-                                # Wait for the quota to replenish - force at least 60 seconds
-                                wait_seconds = max(wait_seconds, 60)
-                                print(f"⏱️ Starting wait of {wait_seconds} seconds at {time.strftime('%H:%M:%S')}...")
-                                time.sleep(wait_seconds)  # Simple sleep instead of countdown
-                                print(f"⏱️ Wait completed at {time.strftime('%H:%M:%S')}, now retrying...")
-                                continue  # Skip the rest of this iteration and retry
-                            # Also check for None responses which could be rate limit errors
-                            elif df is None:
-                                print("Received None response - likely a rate limit error")
-                                retries += 1
-                                # Default wait time of 60 seconds if we can't determine from the response
-                                wait_seconds = 60
-                                
-                                print(f"\n⏱️ RATE LIMIT SUSPECTED: Waiting {wait_seconds} seconds before retry {retries}/{max_retries}...")
-                                
-                                # Checkpoint save if we have data so far (same as above)
-                                if frames:
-                                    print("Saving checkpoint before waiting...")
-                                    checkpoint_df = pd.concat(frames, ignore_index=True)
-                                    
-                                    if existing_data is not None:
-                                        combined_df = pd.concat([existing_data, checkpoint_df], ignore_index=True)
-                                        combined_df.to_csv(OUT_CSV, index=False)
-                                        print(f"✓ Checkpoint saved: combined {len(existing_data)} existing + {len(checkpoint_df)} new rows")
-                                        existing_data = combined_df
-                                    else:
-                                        checkpoint_df.to_csv(OUT_CSV, index=False)
-                                        existing_data = checkpoint_df
-                                        print(f"✓ Initial checkpoint saved with {len(checkpoint_df)} rows")
-                                    
-                                    frames = []
-                                
-                                # Wait for the quota to replenish
-                                for remaining in range(wait_seconds, 0, -1):
-                                    print(f"\rWaiting {remaining} seconds for API quota to replenish...", end="")
-                                    time.sleep(1)
-                                print("\nRetrying request...")
-                                continue  # Skip the rest of this iteration and retry
-                            elif isinstance(df, dict) and 'statusCode' in df:
-                                # Other API error, not rate-limit related
-                                print(f"API returned error: {df}")
-                                print(f"Skipping due to API error")
-                                success = True  # Mark as "successful" to exit retry loop
-                                continue
-                            
-                            # Only process as DataFrame if we actually got valid data
-                            if isinstance(df, pd.DataFrame):
-                                df['flowCode'] = flow_code
-                                frames.append(df)
-                                completed_requests.add(request_key)
-                                success = True
-                                
-                                # Save after every successful API request that returns data
-                                if len(frames) >= 5:  # Save after collecting just 5 dataframes
-                                    existing_data = save_checkpoint(frames, existing_data)
-                                    frames = []  # Clear frames after saving
-                            else:
-                                print(f"Unexpected response type: {type(df)}")
-                                success = True  # Exit the retry loop
-                                
-                        except Exception as e:
-                            error_str = str(e)
-                            print(f"Error fetching data: {e}")
-                            
-                            # Check if this is a rate limit error
-                            if "Out of call volume quota" in error_str or ("403" in error_str and "quota" in error_str.lower()):
-                                retries += 1
-                                if retries >= max_retries:
-                                    print(f"Maximum retries ({max_retries}) exceeded. Moving to next request.")
-                                    break
-                                
-                                wait_seconds = parse_wait_time(error_str)
-                                print(f"\n⏱️ RATE LIMIT REACHED: API quota exceeded. Waiting {wait_seconds} seconds before retry {retries}/{max_retries}...")
-                                
-                                # Checkpoint save before waiting
-                                if frames:
-                                    print("Saving checkpoint before waiting...")
-                                    checkpoint_df = pd.concat(frames, ignore_index=True)
-                                    
-                                    if existing_data is not None:
-                                        combined_df = pd.concat([existing_data, checkpoint_df], ignore_index=True)
-                                        combined_df.to_csv(OUT_CSV, index=False)
-                                        print(f"✓ Checkpoint saved: combined {len(existing_data)} existing + {len(checkpoint_df)} new rows")
-                                        existing_data = combined_df
-                                    else:
-                                        checkpoint_df.to_csv(OUT_CSV, index=False)
-                                        existing_data = checkpoint_df
-                                        print(f"✓ Initial checkpoint saved with {len(checkpoint_df)} rows")
-                                    
-                                    frames = []
-                                
-                                # Wait for the quota to replenish
-                                for remaining in range(wait_seconds, 0, -1):
-                                    print(f"\rWaiting {remaining} seconds for API quota to replenish...", end="")
-                                    time.sleep(1)
-                                print("\nRetrying request...")
-                            else:
-                                # Non-rate-limit error, skip after logging
-                                print(f"Skipping due to non-rate-limit error: {e}")
-                                success = True  # Mark as "successful" to exit retry loop
-                    
-                    # Only increment counters if we actually completed the request
-                    # (either successfully or with a non-rate-limit error)
-                    if success:
-                        # Update progress tracking
-                        completed += 1
-                        percentage = int((completed / remaining_requests) * 100)
-                        
-                        # Log every 5% change
-                        if percentage >= last_percentage + 5 or percentage == 100:
-                            last_percentage = percentage
-                            print(f"✓ Progress: {percentage}% complete ({completed}/{remaining_requests} remaining requests)")
-                        
-                        # Periodic checkpoint saving
-                        if frames and completed % save_checkpoint_every == 0:
-                            print(f"Creating checkpoint after {completed} requests...")
-                            checkpoint_df = pd.concat(frames, ignore_index=True)
-                            
-                            if existing_data is not None:
-                                # Combine with existing data
-                                combined_df = pd.concat([existing_data, checkpoint_df], ignore_index=True)
-                                combined_df.to_csv(OUT_CSV, index=False)
-                                print(f"✓ Checkpoint saved: combined {len(existing_data)} existing + {len(checkpoint_df)} new rows")
-                                # Update existing data for next checkpoint
-                                existing_data = combined_df
-                            else:
-                                # First checkpoint with no existing data
-                                checkpoint_df.to_csv(OUT_CSV, index=False)
-                                existing_data = checkpoint_df
-                                print(f"✓ Initial checkpoint saved with {len(checkpoint_df)} rows")
-                            
-                            # Clear frames to free memory
-                            frames = []
+        # Save once a few thousand rows are buffered (frames hold one slice per key)
+        if sum(len(pos) for _, pos in frames) >= CHECKPOINT_ROWS:
+            save_checkpoint(frames)
+            frames = []  # Clear frames after saving
+        
+        # Update progress tracking
+        completed += 1
+        metrics.set_progress(base_done + completed, base_total + remaining_requests)
+        percentage = int((completed / remaining_requests) * 100)
+        
+        # Log every 5% change
+        if percentage >= last_percentage + 5 or percentage == 100:
+            last_percentage = percentage
+            eta = metrics.snapshot()['progress']['eta_seconds']
+            print(f"✓ Progress: {percentage}% complete ({completed}/{remaining_requests} remaining requests"
+                  f"{f', ETA {eta / 60:.0f} min' if eta is not None else ''})")
+        
+        # Periodic checkpoint saving
+        if (frames or records) and completed % save_checkpoint_every == 0:
+            print(f"Creating checkpoint after {completed} requests...")
+            save_checkpoint(frames)
+            frames = []
+        
+        return children
+    
+    engine = FetchEngine(fetch_one, workers=CONCURRENCY, rate=RATE, min_wait=MIN_WAIT, lookup=cached_batch,
+                         metrics=metrics)
+    try:
+        engine.run(batches, on_result)
+    except LeaseLost:
+        # Keys already returned are kept; the new holder skips them
+        save_checkpoint(frames)
+        raise
 
     # Final save for any remaining data
-    if frames:
+    if frames or records:
         print("Processing final data...")
-        final_df = pd.concat(frames, ignore_index=True)
-        
-        if existing_data is not None:
-            # Combine with existing data for final save
-            combined_df = pd.concat([existing_data, final_df], ignore_index=True)
-            combined_df.to_csv(OUT_CSV, index=False)
-            print(f"✓ Saved final CSV → {OUT_CSV}  ({len(combined_df)} total rows)")
-        else:
-            # No existing data (shouldn't happen at this point but handling it)
-            final_df.to_csv(OUT_CSV, index=False)
-            print(f"✓ Saved final CSV → {OUT_CSV}  ({len(final_df)} rows)")
-    elif existing_data is not None:
-        print(f"✓ No new data to add. Current CSV has {len(existing_data)} rows")
+        save_checkpoint(frames)
+    return new_rows
+
+def main(refresh=False, plan_only=False):
+    if not COMTRADE_KEY and not plan_only:
+        raise ValueError("COMTRADE_KEY environment variable is not set")
+    os.makedirs(os.path.dirname(OUT_CSV), exist_ok=True)
+    periods = get_periods()
+    
+    # Check the request manifest to see what's already been fetched
+    store = SegmentStore(OUT_CSV)
+    manifest = open_manifest(store)
+    changed = select_reporters(manifest, periods, refresh)
+    
+    completed_requests = manifest.completed_keys()
+    if completed_requests:
+        print(f"✓ Found {len(completed_requests)} already completed reporter-partner-HS-flow combinations "
+              f"({manifest.status_counts()})")
+    
+    # Build the remaining request grid in iteration order
+    total_requests = len(REPORTERS) * len(periods) * len(PARTNERS) * len(HS_GROUPS) * len(FLOWS)
+    pending = [
+        (reporter, partner, hs, flow_code, period)
+        for reporter in REPORTERS
+        for period in periods
+        if not refresh or (reporter, period) in changed
+        for partner in PARTNERS
+        for hs in HS_GROUPS
+        for flow_code in FLOWS
+        if create_key(reporter, partner, hs, flow_code, period) not in completed_requests
+    ]
+    pending_keys = set(pending)
+    batches, scores = plan_run(pending, manifest)
+    
+    if plan_only:
+        write_plan(batches, scores, pending_keys, manifest)
+        manifest.close()
+        return
+    
+    # Slices with nothing left to fetch that were pulled before releases were tracked
+    staged = manifest.refreshing()
+    skip = manifest.releases().keys() | staged.keys() | {(reporter, period) for reporter, _, _, _, period in pending}
+    for reporter in REPORTERS:
+        for period in periods:
+            if (reporter, period) not in skip:
+                record_release(manifest, reporter, period)
+    
+    print(f"Starting fetch of remaining {len(pending)} combinations out of {total_requests} total "
+          f"as {len(batches)} batched API requests ({CONCURRENCY} in flight, {RATE} calls/s)...")
+    metrics.start()
+    try:
+        direct = [b for b in batches if (b.reporter, b.period) not in staged]
+        new_rows = fetch_batches(direct, pending_keys, manifest, store)
+        # Re-released slices go to their own stores, leaving their old rows in OUT_CSV until complete
+        for s in dict.fromkeys((b.reporter, b.period) for b in batches if (b.reporter, b.period) in staged):
+            staging = refresh_store(*s)
+            new_rows += fetch_batches([b for b in batches if (b.reporter, b.period) == s],
+                                      pending_keys, manifest, staging, staged=True)
+            staging.close()
+    finally:
+        metrics.stop()
+    print(f"✓ Metrics → {METRICS_PATH}.json / .prom")
+    report_drift()
+    swap_refreshed(manifest, store)
+    # Fold all segments into OUT_CSV
+    store.close()
+    
+    print(f"✓ Manifest: {manifest.status_counts()}")
+    manifest.close()
+    if new_rows:
+        print(f"✓ Saved final CSV → {OUT_CSV}  ({new_rows} new rows)")
+    elif completed_requests:
+        print(f"✓ No new data to add to {OUT_CSV}")
     else:
         print("No data was retrieved. Please check your parameters and API key.")
 
+def shard_store(worker):
+    return SegmentStore(os.path.join(SHARD_DIR, f"trade_flows.{worker}.csv"))
+
+def run_worker(worker):
+    """
+    Sharded worker: claim (reporter, period) leases one at a time and fetch
+    their remaining keys with this process's COMTRADE_KEY into its own shard.
+    When nothing is claimable but other workers still hold leases, wait for
+    the earliest one to expire in case its holder has died.
+    """
+    if not COMTRADE_KEY:
+        raise ValueError("COMTRADE_KEY environment variable is not set")
+    metrics.path = f"{METRICS_PATH}.{worker}"
+    metrics.start()
+    leases = LeaseStore(LEASE_DB)
+    store = shard_store(worker)
+    manifest = RequestManifest(MANIFEST_DB)
+    RELEASES.update(leases.releases())  # the release the coordinator fetches each slice at
+    staged = manifest.refreshing()
+    new_rows = 0
+    while True:
+        lease = leases.claim(worker)
+        if lease is None:
+            expiry = leases.next_expiry()
+            if expiry is None:
+                break
+            time.sleep(min(max(expiry - time.time(), 1), 60))
+            continue
+        reporter, period = lease
+        # A re-released slice goes to its own store, swapped into OUT_CSV once complete
+        target = refresh_store(reporter, period, worker) if (reporter, period) in staged else store
+        with leases.held(reporter, period, worker) as lost:
+            completed_requests = manifest.completed_keys(reporter, period)
+            pending = [
+                (reporter, partner, hs, flow_code, period)
+                for partner in PARTNERS
+                for hs in HS_GROUPS
+                for flow_code in FLOWS
+                if create_key(reporter, partner, hs, flow_code, period) not in completed_requests
+            ]
+            if pending:
+                batches, _ = plan_run(pending, manifest)
+                print(f"[{worker}] {reporter}/{period}: {len(pending)} keys as {len(batches)} requests")
+                try:
+                    new_rows += fetch_batches(batches, set(pending), manifest, target, lost,
+                                              staged=target is not store)
+                except LeaseLost as e:
+                    print(f"⚠️ [{worker}] {e}; leaving the rest of the slice to its new holder")
+            elif target is store and (reporter, period) not in manifest.releases():
+                record_release(manifest, reporter, period)  # pulled before releases were tracked
+        if target is not store:
+            target.close()
+        if lost.is_set():
+            continue  # not ours to mark done
+        leases.complete(reporter, period, worker)
+    metrics.stop()
+    report_drift(os.path.join(SHARD_DIR, f"drift.{worker}.json"))
+    store.close()
+    manifest.close()
+    leases.close()
+    print(f"✓ [{worker}] no leases left ({new_rows} new rows)")
+
+def store_names(directory):
+    """Stores (CSV or segments) left in `directory`, e.g. {'trade_flows.w0'}"""
+    return {
+        re.sub(r'(_segments|\.csv)$', '', name)
+        for name in os.listdir(directory)
+        if name.startswith('trade_flows.') and name.endswith(('.csv', '_segments'))
+    } if os.path.isdir(directory) else set()
+
+def remove_store(other):
+    """Delete a shard or staging store with its lookups, row index and conflicts"""
+    lookups = flow_schema.lookups_path(other.out_csv)
+    for path in (other.out_csv, lookups, RowIndex(other.out_csv, RECORD_KEY_COLUMNS).conflicts_path):
+        if os.path.exists(path):
+            os.remove(path)
+    RowIndex(other.out_csv, RECORD_KEY_COLUMNS).discard()
+    shutil.rmtree(other.segment_dir, ignore_errors=True)
+    _row_indexes.pop(other.out_csv, None)
+    _descriptions.pop(lookups, None)
+
+def absorb_store(store, other):
+    """
+    Append the rows of a shard or staging store to OUT_CSV through `store`
+    and delete it. Rows OUT_CSV already holds (e.g. from a lease re-claimed
+    while its first holder was still running) are rejected by its row index.
+    Returns (rows written, rejected).
+    """
+    other.close()  # fold its own segments into its CSV first
+    descriptions_for(store).update(Descriptions(flow_schema.lookups_path(other.out_csv)))
+    rows = dupes = 0
+    if os.path.exists(other.out_csv):
+        for chunk in pd.read_csv(other.out_csv, chunksize=200000, **AS_TEXT):
+            written, rejected = append_rows(store, chunk)
+            rows += written
+            dupes += rejected
+    other_index = RowIndex(other.out_csv, RECORD_KEY_COLUMNS)
+    if os.path.exists(other_index.conflicts_path):
+        # Conflicts set aside while fetching are kept with OUT_CSV's
+        conflicts = row_index_for(store).conflicts_path
+        pd.read_csv(other_index.conflicts_path, **AS_TEXT).to_csv(
+            conflicts, mode='a', header=not os.path.exists(conflicts), index=False)
+    remove_store(other)
+    return rows, dupes
+
+def merge_shards(store):
+    """Append every worker shard to OUT_CSV through `store` and delete it"""
+    names = store_names(SHARD_DIR)
+    rows = dupes = 0
+    for name in sorted(names):
+        written, rejected = absorb_store(store, shard_store(name.split('.', 1)[1]))
+        rows += written
+        dupes += rejected
+    descriptions_for(store).save()
+    print(f"✓ Merged {len(names)} shards into {OUT_CSV}: {rows} rows, {dupes} duplicates dropped")
+    return rows
+
+def refresh_store(reporter, period, worker=None):
+    """Staging store for a re-released slice (one per sharded worker that fetches it)"""
+    name = f"trade_flows.{reporter}_{period}" + (f".{worker}" if worker else '')
+    return SegmentStore(os.path.join(REFRESH_DIR, f"{name}.csv"))
+
+def refresh_slice(name):
+    """(reporter, period) of a staging store name, e.g. 'trade_flows.842_2023.w0' -> (842, '2023')"""
+    reporter, period = name.split('.')[1].split('_')
+    return int(reporter), period
+
+def refresh_stores(reporter, period):
+    """Staging stores left in REFRESH_DIR for a slice"""
+    return [SegmentStore(os.path.join(REFRESH_DIR, f"{name}.csv"))
+            for name in sorted(store_names(REFRESH_DIR)) if refresh_slice(name) == (reporter, period)]
+
+def swap_refreshed(manifest, store):
+    """
+    Replace the old rows of each re-released slice whose re-fetch has completed
+    with the rows staged in REFRESH_DIR, and record the release now held.
+    Slices with keys still pending or failed keep their old rows for now.
+    """
+    grid = len(PARTNERS) * len(HS_GROUPS) * len(FLOWS)
+    done = [s for s in manifest.refreshing() if len(manifest.completed_keys(*s)) >= grid]
+    if not done:
+        return 0
+    stale = set(done)
+    dropped = store.drop_rows(lambda chunk: pd.Series(
+        [(int(r), str(p)) in stale for r, p in zip(chunk['reporterCode'], chunk['period'])],
+        index=chunk.index))
+    row_index_for(store).sync(store)
+    rows = 0
+    for reporter, period in sorted(done):
+        # Once recorded, an interrupted swap is finished by open_manifest
+        manifest.finish_refresh(reporter, period)
+        for staging in refresh_stores(reporter, period):
+            rows += absorb_store(store, staging)[0]
+    descriptions_for(store).save()
+    print(f"✓ Swapped {len(done)} re-fetched slices into {OUT_CSV}: {dropped} superseded rows out, {rows} in")
+    return rows
+
+def run_sharded(refresh=False):
+    """
+    Split the reporter × period grid into leases and run one worker process per
+    key in COMTRADE_KEYS, each under its own quota. Workers that die are
+    restarted while leases remain; their leases expire and are re-claimed.
+    Once all workers finish, the shards are merged into OUT_CSV.
+    """
+    if not COMTRADE_KEYS:
+        raise ValueError("COMTRADE_KEYS (or COMTRADE_KEY) environment variable is not set")
+    os.makedirs(SHARD_DIR, exist_ok=True)
+    periods = get_periods()
+    store = SegmentStore(OUT_CSV)
+    manifest = open_manifest(store)
+    changed = select_reporters(manifest, periods, refresh)
+    
+    weights = rank_weights([842] + PARTNERS, manifest.value_by('reporter'))
+    slices = [(r, p, weights.get(r, 0.0)) for r in REPORTERS for p in periods
+              if not refresh or (r, p) in changed]
+    leases = LeaseStore(LEASE_DB)
+    # Workers key the raw cache by these releases and record them as slices complete
+    leases.seed(slices, RELEASES)
+    print(f"Sharding {len(slices)} reporter-period leases across {len(COMTRADE_KEYS)} keys...")
+    
+    def spawn(i):
+        cmd = [sys.executable, os.path.abspath(__file__), '--worker', f"w{i}",
+               '--years', ','.join(map(str, YEARS)), '--freq', FREQ]
+        return subprocess.Popen(cmd, env=dict(os.environ, COMTRADE_KEY=COMTRADE_KEYS[i]))
+    
+    workers = {i: spawn(i) for i in range(len(COMTRADE_KEYS))}
+    restarts = Counter()
+    while workers:
+        time.sleep(1)
+        for i, proc in list(workers.items()):
+            code = proc.poll()
+            if code is None:
+                continue
+            del workers[i]
+            left = leases.status_counts()
+            if code != 0 and (left.get('open') or left.get('claimed')) and restarts[i] < WORKER_RESTARTS:
+                restarts[i] += 1
+                print(f"⚠️ Worker w{i} exited with {code}; restarting ({restarts[i]}/{WORKER_RESTARTS})")
+                workers[i] = spawn(i)
+    print(f"✓ Leases: {leases.status_counts()}")
+    leases.close()
+    
+    merge_shards(store)
+    swap_refreshed(manifest, store)
+    store.close()
+    print(f"✓ Manifest: {manifest.status_counts()}")
+    manifest.close()
+
 if __name__ == '__main__':
-    main()
+    parser = argparse.ArgumentParser(description=__doc__, formatter_class=argparse.RawDescriptionHelpFormatter)
+    parser.add_argument('--offline', action='store_true',
+                        help="rebuild trade_flows.csv from the raw response cache without calling the API")
+    parser.add_argument('--years', default=','.join(map(str, YEARS)),
+                        help="years to cover, e.g. 2023 or 2019-2023 (default: %(default)s)")
+    parser.add_argument('--freq', choices=['A', 'M'], default=FREQ,
+                        help="annual or monthly periods (default: %(default)s)")
+    parser.add_argument('--refresh', action='store_true',
+                        help="only re-fetch reporter-period slices Comtrade has re-released since the last pull")
+    parser.add_argument('--plan', action='store_true',
+                        help=f"dry run: write the remaining request plan and cost estimate to {PLAN_CSV}")
+    parser.add_argument('--shards', action='store_true',
+                        help="run one worker process per key in COMTRADE_KEYS over leased reporter-period slices")
+    parser.add_argument('--worker', help=argparse.SUPPRESS)  # set by --shards for each worker process
+    args = parser.parse_args()
+    YEARS = parse_codes(args.years)
+    FREQ = args.freq
+    if args.offline:
+        rebuild_from_cache()
+    elif args.worker:
+        run_worker(args.worker)
+    elif args.shards:
+        run_sharded(refresh=args.refresh)
+    else:
+        main(refresh=args.refresh, plan_only=args.plan)
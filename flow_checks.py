@@ -0,0 +1,238 @@
+"""
+Data-quality checks for the merged flows, run by merge.py as each
+reporter/year partition is written. `partition_stats` reduces a merged
+partition and its HS cube slice to a handful of counts while they are still
+in memory; merge.py keeps those in its manifest, so partitions skipped as
+unchanged are never re-read. `validate` combines the stats of every partition
+into a compact JSON report and names the checks that breach their threshold:
+
+  mfn_coverage, tau_coverage  share of trade value with an mfnRate / tau_mean
+  nonpositive                 share of rows with primaryValue <= 0, or a negative
+                              quantity, weight, customs value or MFN rate
+  unknown_iso                 share of rows whose reporter or partner ISO3 is not
+                              in country_codes.py (nor a Comtrade aggregate)
+  mirror_asymmetry            share of mirrored trade value (A's exports to B
+                              against B's imports from A) in pairs that differ
+                              by more than ASYMMETRY of the larger side; also
+                              lists partitions with no X/M totals to mirror
+  year_gaps                   years missing inside a reporter's range
+"""
+import json
+import os
+import numpy as np
+import pandas as pd
+from country_codes import code_table
+
+# Breached when a share (year_gaps: a count) is below a min_ or above a max_ threshold
+THRESHOLDS = {
+    "min_mfn_coverage": 0.5,
+    "min_tau_coverage": 0.5,
+    "max_nonpositive": 0.01,
+    "max_unknown_iso": 0.001,
+    "max_mirror_asymmetry": 0.5,
+    "max_year_gaps": 0,
+}
+ASYMMETRY = 0.5  # |exports - mirror imports| / max of the two above which a pair is asymmetric
+AGGREGATES = {"W00"}  # Comtrade partner codes that are not countries
+NONNEGATIVE = ["qty", "altQty", "netWgt", "grossWgt", "cifvalue", "fobvalue", "mfnRate"]
+WORST = 5  # partitions / pairs listed per check
+
+_known = None
+
+
+class ValidationFailed(Exception):
+    """Raised by merge.py after writing its outputs when a check breaches its threshold."""
+
+    def __init__(self, report):
+        super().__init__(f"data-quality checks failed: {', '.join(report['failed'])}")
+        self.report = report
+
+
+def known_iso3():
+    global _known
+    if _known is None:
+        _known = set(code_table()["iso3"]) | AGGREGATES
+    return _known
+
+
+def partition_stats(merged, cube, reporter):
+    """Counts for one merged reporter/year partition (JSON-serialisable)."""
+    value = merged["primaryValue"].astype(float).fillna(0).to_numpy()
+    has_mfn = merged["mfnRate"].notna().to_numpy()
+    has_tau = merged["tau_mean"].notna().to_numpy()
+
+    bad = (merged["primaryValue"] <= 0).fillna(False).to_numpy()
+    by_column = {"primaryValue": int(bad.sum())}
+    for col in NONNEGATIVE:
+        neg = (merged[col] < 0).fillna(False).to_numpy()
+        by_column[col] = int(neg.sum())
+        bad = bad | neg
+
+    partners = merged["partnerISO"].astype("string")
+    unknown = partners[~partners.isin(known_iso3())].fillna("<missing>").value_counts()
+    if reporter not in known_iso3():
+        unknown[reporter] = unknown.get(reporter, 0) + len(merged)
+
+    # X and M totals per partner, from the cube's all-products cells (no HS level counted twice)
+    total = cube[(cube["hsLevel"] == 0) & cube["flowCode"].isin(["X", "M"])]
+    mirror = total.pivot_table(index="partnerISO", columns="flowCode", values="value",
+                               aggfunc="sum", observed=True).reindex(columns=["X", "M"]).fillna(0)
+    return {
+        "rows": len(merged),
+        "value": float(value.sum()),
+        "mfn_rows": int(has_mfn.sum()), "mfn_value": float(value[has_mfn].sum()),
+        "tau_rows": int(has_tau.sum()), "tau_value": float(value[has_tau].sum()),
+        "nonpositive": int(bad.sum()),
+        "nonpositive_by_column": {col: n for col, n in by_column.items() if n},
+        "unknown_iso": {str(code): int(n) for code, n in unknown.items()},
+        "partners": {str(p): [float(x), float(m)] for p, (x, m) in mirror.iterrows()},
+    }
+
+
+def _share(num, den):
+    return float(num / den) if den else None
+
+
+def _worst(series, ascending):
+    return {k: round(v, 4) for k, v in series.sort_values(ascending=ascending).head(WORST).items()}
+
+
+def mirror_pairs(stats):
+    """
+    One row per (exporter, importer, year) that both report: exports as the
+    exporter reports them, imports as the importer reports them.
+    """
+    rows = [(reporter, partner, year, x, m)
+            for (reporter, year), s in stats.items()
+            for partner, (x, m) in s.get("partners", {}).items()]
+    df = pd.DataFrame(rows, columns=["reporter", "partner", "year", "X", "M"]).astype(
+        {"reporter": "string", "partner": "string", "year": "int64", "X": "float64", "M": "float64"})
+    exports = df[df["X"] > 0][["reporter", "partner", "year", "X"]]
+    exports.columns = ["exporter", "importer", "year", "exports"]
+    imports = df[df["M"] > 0][["reporter", "partner", "year", "M"]]
+    imports.columns = ["importer", "exporter", "year", "imports"]
+    pairs = exports.merge(imports, on=["exporter", "importer", "year"], how="inner")
+    pairs["asymmetry"] = (pairs["exports"] - pairs["imports"]).abs() / pairs[["exports", "imports"]].max(axis=1)
+    return pairs
+
+
+def year_gaps(partitions):
+    """{reporter: [missing years]} for years missing between a reporter's first and last."""
+    years = {}
+    for reporter, year in partitions:
+        years.setdefault(reporter, set()).add(int(year))
+    return {r: sorted(set(range(min(ys), max(ys) + 1)) - ys)
+            for r, ys in sorted(years.items()) if len(ys) < max(ys) - min(ys) + 1}
+
+
+def validate(stats, thresholds=THRESHOLDS):
+    """
+    Report for {(reporter, year): partition_stats}. report['failed'] lists
+    the checks that breach `thresholds`.
+    """
+    thresholds = {**THRESHOLDS, **thresholds}
+    table = pd.DataFrame.from_dict({f"{r}/{y}": s for (r, y), s in stats.items()}, orient="index")
+    rows, value = int(table["rows"].sum()), float(table["value"].sum())
+    checks = {}
+
+    for name in ("mfn", "tau"):
+        per_partition = table[f"{name}_value"] / table["value"].where(table["value"] > 0)
+        checks[f"{name}_coverage"] = {
+            "share": _share(table[f"{name}_value"].sum(), value),
+            "row_share": _share(table[f"{name}_rows"].sum(), rows),
+            "worst": _worst(per_partition[per_partition < 1], ascending=True),
+        }
+
+    by_column = {}
+    for counts in table["nonpositive_by_column"]:
+        for col, n in counts.items():
+            by_column[col] = by_column.get(col, 0) + n
+    checks["nonpositive"] = {
+        "share": _share(table["nonpositive"].sum(), rows),
+        "rows": int(table["nonpositive"].sum()),
+        "by_column": by_column,
+        "worst": _worst((table["nonpositive"] / table["rows"])[table["nonpositive"] > 0], ascending=False),
+    }
+
+    codes = {}
+    for counts in table["unknown_iso"]:
+        for code, n in counts.items():
+            codes[code] = codes.get(code, 0) + n
+    unknown_rows = sum(codes.values())
+    checks["unknown_iso"] = {
+        "share": _share(unknown_rows, rows),
+        "rows": unknown_rows,
+        "codes": dict(sorted(codes.items(), key=lambda kv: -kv[1])[:20]),
+    }
+
+    pairs = mirror_pairs(stats)
+    flagged = pairs[pairs["asymmetry"] > ASYMMETRY]
+    mirrored = float(pairs[["exports", "imports"]].to_numpy().sum())
+    worst = flagged.assign(gap=(flagged["exports"] - flagged["imports"]).abs()).nlargest(WORST, "gap")
+    checks["mirror_asymmetry"] = {
+        "share": _share(float(flagged[["exports", "imports"]].to_numpy().sum()), mirrored),
+        "pairs": len(pairs),
+        "asymmetric_pairs": len(flagged),
+        # no all-products X or M cell in the HS cube, so nothing to compare
+        "unmirrored_partitions": sorted(f"{r}/{y}" for (r, y), s in stats.items() if not s.get("partners")),
+        "worst": [
+            {"exporter": e, "importer": i, "year": int(y), "exports": round(x), "imports": round(m),
+             "asymmetry": round(a, 3)}
+            for e, i, y, x, m, a in worst[["exporter", "importer", "year", "exports", "imports", "asymmetry"]]
+            .itertuples(index=False)
+        ],
+    }
+
+    gaps = year_gaps(stats)
+    checks["year_gaps"] = {"missing": sum(len(g) for g in gaps.values()), "reporters": gaps}
+
+    failed = []
+    for name, check in checks.items():
+        measured = check["missing"] if name == "year_gaps" else check["share"]
+        if measured is None:
+            continue
+        low, high = thresholds.get(f"min_{name}"), thresholds.get(f"max_{name}")
+        if (low is not None and measured < low) or (high is not None and measured > high):
+            failed.append(name)
+    return {
+        "ok": not failed,
+        "failed": failed,
+        "thresholds": thresholds,
+        "partitions": len(table),
+        "rows": rows,
+        "value": value,
+        "reporters": int(table.index.str.split("/").str[0].nunique()),
+        "partners": len(set().union(*(s.get("partners", {}) for s in stats.values()))),
+        "checks": checks,
+    }
+
+
+def write_report(report, path):
+    tmp = path + ".tmp"
+    with open(tmp, "w") as f:
+        json.dump(report, f, indent=1, default=lambda v: v.item() if isinstance(v, np.generic) else str(v))
+    os.replace(tmp, path)
+
+
+def summary(report):
+    """One line per check, for the merge log."""
+    lines = []
+    for name, check in report["checks"].items():
+        mark = "✗" if name in report["failed"] else "✓"
+        if name == "year_gaps":
+            shown = f"{check['missing']} missing years"
+        else:
+            shown = "n/a" if check["share"] is None else f"{check['share']:.2%}"
+        lines.append(f"{mark} {name}: {shown}")
+    return lines
+
+
+def parse_thresholds(pairs):
+    """['min_mfn_coverage=0.8', ...] → {name: float}, checked against THRESHOLDS."""
+    out = {}
+    for pair in pairs or []:
+        name, _, value = pair.partition("=")
+        if name not in THRESHOLDS:
+            raise ValueError(f"unknown threshold {name!r}; expected one of {', '.join(THRESHOLDS)}")
+        out[name] = float(value)
+    return out
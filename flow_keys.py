@@ -0,0 +1,127 @@
+"""
+Integer surrogate keys for merged flows.
+A flowKey packs the Comtrade reporter and partner codes, the HS code, the
+flow code and the period (year and month) into one int64, so joins and lookups
+compare machine words instead of "USA_CHN_85_M_2023" strings; timeKey is the
+period as int32 YYYYMM, with month 00 for annual data (2023 → 202300).
+merge.py ships a dictionary table (data/processed/flow_keys/) mapping each
+flowKey back to its human-readable flowID.
+
+    bits:  reporterCode 10 | partnerCode 10 | cmdCode 20 | flow 4 | year-1900 8 | month 4
+"""
+import numpy as np
+import pandas as pd
+
+KEYS_DIR = "data/processed/flow_keys"
+
+# Comtrade flow codes; position + 1 is the packed value (0 is unused)
+FLOW_CODES = ["M", "X", "RM", "RX", "MIP", "XIP", "MOP", "XOP", "DX", "FM", "MTP", "XTP", "MG", "XG"]
+YEAR_BASE = 1900
+
+# (name, bits), most significant first
+FIELDS = [("reporterCode", 10), ("partnerCode", 10), ("cmdCode", 20), ("flow", 4), ("year", 8), ("month", 4)]
+
+
+def _shifts():
+    shifts, offset = {}, 0
+    for name, bits in reversed(FIELDS):
+        shifts[name] = (offset, bits)
+        offset += bits
+    return shifts
+
+
+SHIFTS = _shifts()
+
+
+def _field(values, name):
+    """Validated int64 array for one packed field."""
+    arr = pd.to_numeric(pd.Series(values)).to_numpy()
+    if pd.isna(arr).any():
+        raise ValueError(f"{name} has missing values; cannot build flow keys")
+    arr = arr.astype(np.int64)
+    bits = SHIFTS[name][1]
+    if (arr < 0).any() or (arr >= 1 << bits).any():
+        raise ValueError(f"{name} out of range for a {bits}-bit key field")
+    return arr
+
+
+def flow_codes(values):
+    """Flow codes ('M', 'X', ...) → small ints."""
+    codes = pd.Categorical(pd.Series(values).astype("string"), categories=FLOW_CODES).codes
+    if (codes < 0).any():
+        unknown = sorted(set(pd.Series(values)[codes < 0].astype(str)))
+        raise ValueError(f"unknown flow codes: {', '.join(unknown)}")
+    return codes.astype(np.int64) + 1
+
+
+def pack(reporter_code, partner_code, cmd_code, flow_code, year, month=None):
+    """int64 flowKeys for aligned sequences of the key fields; month 0 (or None) is annual."""
+    year = _field(pd.to_numeric(pd.Series(year)) - YEAR_BASE, "year")
+    fields = {
+        "reporterCode": _field(reporter_code, "reporterCode"),
+        "partnerCode": _field(partner_code, "partnerCode"),
+        "cmdCode": _field(cmd_code, "cmdCode"),
+        "flow": flow_codes(flow_code),
+        "year": year,
+        "month": np.zeros(len(year), dtype=np.int64) if month is None else _field(month, "month"),
+    }
+    keys = np.zeros(len(fields["year"]), dtype=np.int64)
+    for name, arr in fields.items():
+        keys |= arr << SHIFTS[name][0]
+    return keys
+
+
+def unpack(keys):
+    """DataFrame of reporterCode, partnerCode, cmdCode, flowCode, year and month for flowKeys."""
+    keys = np.asarray(keys, dtype=np.int64)
+    out = {name: (keys >> shift) & ((1 << bits) - 1) for name, (shift, bits) in SHIFTS.items()}
+    return pd.DataFrame({
+        "reporterCode": out["reporterCode"],
+        "partnerCode": out["partnerCode"],
+        "cmdCode": out["cmdCode"],
+        "flowCode": np.array(FLOW_CODES, dtype=object)[out["flow"] - 1],
+        "year": out["year"] + YEAR_BASE,
+        "month": out["month"],
+    })
+
+
+def period_label(year, month):
+    """"2023" for annual periods (month 0), "2023-01" for monthly ones."""
+    year, month = pd.Series(year).astype(int).astype(str), pd.Series(month).astype(int)
+    return year.where(month.to_numpy() == 0, year + "-" + month.astype(str).str.zfill(2).to_numpy())
+
+
+def flow_ids(df):
+    """Human-readable flowIDs ("USA_CHN_85_M_2023", "..._2023-01" if monthly) for merged rows."""
+    month = df["month"] if "month" in df.columns else pd.Series(0, index=df.index)
+    return (
+        df["reporterISO3"].astype(str) + "_" +
+        df["partnerISO"].astype(str) + "_" +
+        df["cmdCode"].astype(str) + "_" +
+        df["flowCode"].astype(str) + "_" +
+        period_label(df["year"], month).to_numpy()
+    )
+
+
+def time_keys(year, month=None):
+    """int32 timeKeys (YYYYMM, month 00 for annual data)."""
+    year = pd.to_numeric(pd.Series(year)).to_numpy(dtype=np.int64)
+    month = 0 if month is None else pd.to_numeric(pd.Series(month)).to_numpy(dtype=np.int64)
+    return (year * 100 + month).astype(np.int32)
+
+
+def time_ids(keys):
+    """timeID strings ("time_2023", "time_2023-01") for timeKeys."""
+    keys = pd.Series(keys).astype(int)
+    return "time_" + period_label(keys // 100, keys % 100)
+
+
+def read_flow_ids(years=None, reporters=None, path=KEYS_DIR):
+    """flowKey → flowID dictionary (Series), for the year/reporter partitions asked for."""
+    filters = []
+    if years is not None:
+        filters.append(("year", "in", [int(y) for y in years]))
+    if reporters is not None:
+        filters.append(("reporterISO3", "in", list(reporters)))
+    df = pd.read_parquet(path, columns=["flowKey", "flowID"], filters=filters or None)
+    return df.set_index("flowKey")["flowID"]
@@ -0,0 +1,256 @@
+"""
+Declared schema for Comtrade flow records.
+Frames from getFinalData/previewFinalData arrive with ~50 object and float64
+columns; `conform` casts them on arrival to the declared compact types (codes
+as small nullable ints, flags as booleans, repeated codes as categoricals) and
+checks them against the schema: unexpected or missing columns, values that do
+not parse and constants that differ are recorded in a `SchemaDrift` log
+instead of being carried silently.
+
+What trade_flows.csv stores is narrower still: columns fixed by the request
+(typeCode, classificationSearchCode) are dropped, and descriptions
+(reporterDesc, cmdDesc, motDesc, ...) move to a code → text lookup kept next
+to it (trade_flows.lookups.json). `read_flows` puts both back.
+"""
+import json
+import os
+import threading
+import numpy as np
+import pandas as pd
+
+# Column → dtype, in Comtrade's column order
+SCHEMA = {
+    'typeCode': 'category', 'freqCode': 'category', 'refPeriodId': 'Int32', 'refYear': 'Int16',
+    'refMonth': 'Int8', 'period': 'Int32', 'reporterCode': 'Int16', 'reporterISO': 'category',
+    'reporterDesc': 'category', 'flowCode': 'category', 'flowDesc': 'category', 'partnerCode': 'Int16',
+    'partnerISO': 'category', 'partnerDesc': 'category', 'partner2Code': 'Int16', 'partner2ISO': 'category',
+    'partner2Desc': 'category', 'classificationCode': 'category', 'classificationSearchCode': 'category',
+    'isOriginalClassification': 'boolean', 'cmdCode': 'string', 'cmdDesc': 'category', 'aggrLevel': 'Int8',
+    'isLeaf': 'boolean', 'customsCode': 'category', 'customsDesc': 'category', 'mosCode': 'Int16',
+    'motCode': 'Int32', 'motDesc': 'category', 'qtyUnitCode': 'Int16', 'qtyUnitAbbr': 'category',
+    'qty': 'float64', 'isQtyEstimated': 'boolean', 'altQtyUnitCode': 'Int16', 'altQtyUnitAbbr': 'category',
+    'altQty': 'float64', 'isAltQtyEstimated': 'boolean', 'netWgt': 'float64', 'isNetWgtEstimated': 'boolean',
+    'grossWgt': 'float64', 'isGrossWgtEstimated': 'boolean', 'cifvalue': 'float64', 'fobvalue': 'float64',
+    'primaryValue': 'float64', 'legacyEstimationFlag': 'Int8', 'isReported': 'boolean', 'isAggregate': 'boolean',
+}
+# Fixed by batch_params in fetch_trade.py, so not stored per row
+CONSTANTS = {'typeCode': 'C', 'classificationSearchCode': 'HS'}
+# Description column → the code column it describes
+DESCRIPTIONS = {
+    'reporterDesc': 'reporterCode', 'flowDesc': 'flowCode', 'partnerDesc': 'partnerCode',
+    'partner2Desc': 'partner2Code', 'cmdDesc': 'cmdCode', 'customsDesc': 'customsCode',
+    'motDesc': 'motCode', 'qtyUnitAbbr': 'qtyUnitCode', 'altQtyUnitAbbr': 'altQtyUnitCode',
+}
+STORED_COLUMNS = [c for c in SCHEMA if c not in CONSTANTS and c not in DESCRIPTIONS]
+
+FLAG_VALUES = {'True': True, 'False': False, 'true': True, 'false': False, '1': True, '0': False}
+
+
+class SchemaDrift:
+    """Thread-safe tally of schema deviations; each new kind of drift is printed once."""
+
+    def __init__(self):
+        self.lock = threading.Lock()
+        self.counts = {}
+
+    def record(self, kind, column, n=1, detail=None):
+        with self.lock:
+            key = f"{kind}:{column}"
+            first = key not in self.counts
+            self.counts[key] = self.counts.get(key, 0) + n
+        if first:
+            print(f"⚠️ Schema drift: {kind} {column}" + (f" ({detail})" if detail else ""))
+
+    def total(self):
+        with self.lock:
+            return sum(self.counts.values())
+
+    def report(self):
+        with self.lock:
+            return dict(sorted(self.counts.items()))
+
+    def write(self, path):
+        tmp = path + '.tmp'
+        with open(tmp, 'w') as f:
+            json.dump({'total': self.total(), 'drift': self.report()}, f, indent=1)
+        os.replace(tmp, path)
+
+
+def _text(values):
+    """Values as nullable strings, with empty fields as nulls."""
+    return values.astype('string').str.strip().replace('', pd.NA)
+
+
+def _cast(col, values, dtype, drift):
+    """Cast one column to its declared dtype, recording values that do not fit."""
+    if dtype == 'boolean':
+        if pd.api.types.is_bool_dtype(values):
+            return values.astype('boolean')
+        text = _text(values)
+        mapped = text.map(FLAG_VALUES, na_action='ignore')
+        bad = int((mapped.isna() & text.notna()).sum())
+        if bad:
+            drift.record('unparsed', col, bad, "not a flag")
+        return mapped.astype('boolean')
+    if dtype.startswith(('Int', 'float')):
+        if pd.api.types.is_numeric_dtype(values) and not pd.api.types.is_bool_dtype(values):
+            numeric = values
+        else:
+            text = _text(values)
+            numeric = pd.to_numeric(text, errors='coerce')
+            bad = int((numeric.isna() & text.notna()).sum())
+            if bad:
+                drift.record('unparsed', col, bad, "not a number")
+        if dtype == 'float64':
+            return numeric.astype('float64')
+        info = np.iinfo(dtype.lower())
+        whole = numeric.dropna()
+        if ((whole % 1) != 0).any():
+            drift.record('out_of_range', col, len(whole), f"fractional values in a {dtype} column; kept as float")
+            return numeric.astype('float64')
+        if (whole < info.min).any() or (whole > info.max).any():
+            drift.record('out_of_range', col, len(whole), f"does not fit {dtype}; kept as Int64")
+            return numeric.astype('Int64')
+        return numeric.astype(dtype)
+    text = _text(values)
+    return text.astype('category') if dtype == 'category' else text
+
+
+def conform(df, drift):
+    """
+    Cast a Comtrade frame to SCHEMA: columns in schema order, missing ones as
+    nulls, unexpected ones dropped, all of it recorded in `drift`. Declared
+    constants are checked and dropped.
+    """
+    extra = [c for c in df.columns if c not in SCHEMA]
+    for col in extra:
+        drift.record('unexpected_column', col, len(df))
+    for col in SCHEMA:
+        if col not in df.columns and col not in CONSTANTS:
+            drift.record('missing_column', col, len(df))
+    out = {}
+    for col, dtype in SCHEMA.items():
+        if col in CONSTANTS:
+            if col in df.columns:
+                differs = int((df[col].astype('string') != CONSTANTS[col]).sum())
+                if differs:
+                    drift.record('constant_changed', col, differs, f"expected {CONSTANTS[col]!r}")
+            continue
+        values = df[col] if col in df.columns else pd.Series(pd.NA, index=df.index, dtype=object)
+        out[col] = _cast(col, values, dtype, drift)
+    return pd.DataFrame(out, index=df.index)
+
+
+class Descriptions:
+    """
+    code → text lookups for the DESCRIPTIONS columns, persisted as JSON.
+    `absorb` moves description columns out of a frame, `restore` puts them back.
+    """
+
+    def __init__(self, path):
+        self.path = path
+        self.lock = threading.Lock()
+        self.tables = {col: {} for col in DESCRIPTIONS}
+        self.dirty = False
+        if os.path.exists(path):
+            with open(path) as f:
+                self.tables.update(json.load(f).get('descriptions', {}))
+
+    def absorb(self, df, drift=None):
+        """`df` without description columns, remembering each code's text."""
+        present = [c for c in DESCRIPTIONS if c in df.columns]
+        with self.lock:
+            for col in present:
+                pairs = pd.DataFrame({'code': df[DESCRIPTIONS[col]].astype('string'),
+                                      'text': df[col].astype('string')}).dropna().drop_duplicates('code', keep='last')
+                table = self.tables.setdefault(col, {})
+                for code, text in zip(pairs['code'], pairs['text']):
+                    old = table.get(code)
+                    if old != text:
+                        if old is not None and drift is not None:
+                            drift.record('description_changed', col, 1, f"{code}: {old!r} → {text!r}")
+                        table[code] = text
+                        self.dirty = True
+        return df.drop(columns=present)
+
+    def update(self, other):
+        """Take in the lookups of another Descriptions (e.g. a worker shard's)."""
+        with self.lock:
+            for col, table in other.tables.items():
+                mine = self.tables.setdefault(col, {})
+                if any(mine.get(code) != text for code, text in table.items()):
+                    mine.update(table)
+                    self.dirty = True
+
+    def restore(self, df):
+        """Add the description columns (as categoricals) to a stored frame."""
+        for col, code_col in DESCRIPTIONS.items():
+            if col not in df.columns and code_col in df.columns:
+                df[col] = df[code_col].astype('string').map(self.tables.get(col, {})).astype('category')
+        return df
+
+    def save(self):
+        with self.lock:
+            if not self.dirty:
+                return
+            os.makedirs(os.path.dirname(self.path) or '.', exist_ok=True)
+            tmp = self.path + '.tmp'
+            with open(tmp, 'w') as f:
+                json.dump({'constants': CONSTANTS, 'descriptions': self.tables}, f, indent=1, sort_keys=True)
+            os.replace(tmp, self.path)
+            self.dirty = False
+
+
+def lookups_path(csv_path):
+    return os.path.splitext(csv_path)[0] + '.lookups.json'
+
+
+def stored(df, descriptions, drift=None):
+    """A conformed frame as trade_flows.csv stores it."""
+    return descriptions.absorb(df, drift).reindex(columns=STORED_COLUMNS)
+
+
+def migrate(csv_path, descriptions, drift, chunksize=200000):
+    """Rewrite a trade_flows.csv written before this schema into the stored layout. Returns True if it did."""
+    if not os.path.exists(csv_path) or list(pd.read_csv(csv_path, nrows=0).columns) == STORED_COLUMNS:
+        return False
+    tmp = csv_path + '.migrate'
+    header = True
+    for chunk in pd.read_csv(csv_path, chunksize=chunksize, dtype=str, keep_default_na=False):
+        stored(conform(chunk, drift), descriptions, drift).to_csv(
+            tmp, mode='w' if header else 'a', header=header, index=False)
+        header = False
+    descriptions.save()
+    os.replace(tmp, csv_path)
+    return True
+
+
+def read_flows(csv_path, chunksize=None, columns=None):
+    """
+    Read trade_flows.csv with declared dtypes, and the constants and
+    descriptions it does not store put back. `columns` limits what is read
+    (code columns are read as needed to restore descriptions). With
+    `chunksize`, yields frames.
+    """
+    columns = list(columns or SCHEMA)
+    header = set(pd.read_csv(csv_path, nrows=0).columns)
+    # Files written before the schema still hold descriptions and constants
+    restored = [c for c in columns if c not in header and (c in DESCRIPTIONS or c in CONSTANTS)]
+    need = [c for c in columns if c in header]
+    need += [DESCRIPTIONS[c] for c in restored if c in DESCRIPTIONS and DESCRIPTIONS[c] not in need]
+    descriptions = Descriptions(lookups_path(csv_path)) if restored else None
+    drift = SchemaDrift()
+
+    def typed(chunk):
+        df = pd.DataFrame({c: _cast(c, chunk[c], SCHEMA.get(c, 'string'), drift) for c in need}, index=chunk.index)
+        for col in restored:
+            if col in CONSTANTS:
+                df[col] = pd.Categorical([CONSTANTS[col]] * len(df))
+        if descriptions is not None:
+            descriptions.restore(df)
+        return df[[c for c in columns if c in df.columns]]
+
+    reader = pd.read_csv(csv_path, chunksize=chunksize, usecols=need, dtype=str, keep_default_na=False)
+    if chunksize is None:
+        return typed(reader)
+    return (typed(chunk) for chunk in reader)
@@ -0,0 +1,134 @@
+"""
+HS rollup cube for the merged flows: reporter × partner × flow × year × HS
+level (HS6, HS4, HS2 and the all-products total), holding the summed trade
+value, the trade-weighted and simple-average MFN rate, and the value-weighted
+elasticity. merge.py builds it one reporter/year partition at a time next to
+flows_with_mfn/, so dashboards and the simulator read a cell instead of
+grouping flows.
+
+Each flow row counts once per level: within a reporter/partner/flow/HS2
+chapter only the finest level Comtrade reported is used, and coarser levels
+are summed from it. A row's MFN rate is the simple average of the reporter's
+WITS tariff lines under its own HS code; the simple-average column at each
+cell is the same average over the lines under the cell's code.
+"""
+import os
+import numpy as np
+import pandas as pd
+
+CUBE_DIR = "data/processed/hs_cube"
+LEVELS = (6, 4, 2, 0)  # 0 = all products
+TOTAL = "TOTAL"
+DIMS = ["partnerISO", "flowCode"]  # within a reporter/year partition
+
+
+def tariff_levels(wits_partition):
+    """
+    Simple-average MFN per HS level for one reporter-year WITS partition:
+    {level: Series indexed by HS code}, level 0 indexed by 'TOTAL'.
+    Empty Series when WITS has no schedule.
+    """
+    if not os.path.isdir(wits_partition):
+        return {level: pd.Series(dtype=float) for level in LEVELS}
+    df = pd.read_parquet(wits_partition, columns=["PRODUCT", "VALUE"]).dropna()
+    hs6 = df["PRODUCT"].astype(str).str.zfill(6)
+    rates = df["VALUE"].astype(float)
+    levels = {level: rates.groupby(hs6.str[:level]).mean() for level in LEVELS if level}
+    levels[0] = pd.Series({TOTAL: rates.mean()}) if len(rates) else pd.Series(dtype=float)
+    return levels
+
+
+def hs_codes(cmd_code, aggr_level=None):
+    """
+    (HS codes zero-padded to their own level, levels): "101" at aggrLevel 4 is
+    "0101", chapter 01. Rows without an aggrLevel take it from the code's length.
+    """
+    cmd = pd.Series(cmd_code).astype("string").str.strip()
+    width = cmd.str.len() + cmd.str.len() % 2
+    level = width if aggr_level is None else pd.to_numeric(pd.Series(aggr_level, index=cmd.index)).astype("Int64")
+    level = level.fillna(width)
+    code = cmd.copy()
+    for n in (2, 4, 6):
+        mask = (level == n).fillna(False)
+        code[mask] = cmd[mask].str.zfill(n)
+    return code, level
+
+
+def _ratio(num, den):
+    num, den = np.asarray(num, dtype=float), np.asarray(den, dtype=float)
+    return np.divide(num, den, out=np.full(len(num), np.nan), where=den > 0)
+
+
+def base_rows(merged, tariffs):
+    """
+    The flow rows the cube is summed from, with their HS code at their own
+    level, MFN rate, and value weights for the MFN and elasticity averages.
+    """
+    df = merged[DIMS + ["cmdCode", "aggrLevel", "primaryValue", "tau_mean"]].copy()
+    # rows without an aggrLevel are placed by the length of their code
+    code, level = hs_codes(df["cmdCode"].astype("Int64"), df["aggrLevel"])
+    df["hsCode"], df["level"] = code, level
+    df = df[df["level"].isin([2, 4, 6]).fillna(False)]
+    df["level"] = df["level"].astype(int)
+    code = df["hsCode"]
+
+    # finest level reported within each partner/flow/chapter, so nothing is counted twice
+    df["chapter"] = code.str[:2]
+    finest = df.groupby(DIMS + ["chapter"], observed=True)["level"].transform("max")
+    df = df[df["level"] == finest]
+
+    mfn = np.full(len(df), np.nan)
+    for n in (2, 4, 6):
+        mask = (df["level"] == n).to_numpy()
+        mfn[mask] = tariffs[n].reindex(df["hsCode"][mask]).to_numpy(dtype=float)
+    value = df["primaryValue"].astype(float).fillna(0).to_numpy()
+    tau = df["tau_mean"].astype(float).to_numpy()
+    df["mfn_num"] = np.where(np.isnan(mfn), 0, mfn * value)
+    df["mfn_den"] = np.where(np.isnan(mfn), 0, value)
+    df["tau_num"] = np.where(np.isnan(tau), 0, tau * value)
+    df["tau_den"] = np.where(np.isnan(tau), 0, value)
+    df["value"] = value
+    return df
+
+
+def build_cube(merged, tariffs):
+    """Cube rows for one reporter/year partition of merged flows."""
+    base = base_rows(merged, tariffs)
+    cells = []
+    for level in LEVELS:
+        rows = base[base["level"] >= level]
+        key = rows["hsCode"].str[:level] if level else TOTAL
+        agg = (
+            rows.assign(hsCode=key)
+            .groupby(DIMS + ["hsCode"], observed=True, as_index=False)
+            .agg(value=("value", "sum"), flows=("value", "size"),
+                 mfn_num=("mfn_num", "sum"), mfn_den=("mfn_den", "sum"),
+                 tau_num=("tau_num", "sum"), tau_den=("tau_den", "sum"))
+        )
+        agg["hsLevel"] = np.int8(level)
+        agg["mfnTradeWeighted"] = _ratio(agg["mfn_num"], agg["mfn_den"])
+        agg["mfnSimple"] = tariffs[level].reindex(agg["hsCode"].astype(str)).to_numpy(dtype=float)
+        agg["tauWeighted"] = _ratio(agg["tau_num"], agg["tau_den"])
+        cells.append(agg)
+    cube = pd.concat(cells, ignore_index=True)
+    cube = cube[DIMS + ["hsLevel", "hsCode", "value", "flows", "mfnTradeWeighted", "mfnSimple", "tauWeighted"]]
+    for col in DIMS:
+        cube[col] = cube[col].astype("string").astype("category")
+    cube["hsCode"] = cube["hsCode"].astype("string")
+    cube["flows"] = cube["flows"].astype("int32")
+    return cube
+
+
+def read_cube(levels=None, years=None, reporters=None, columns=None, path=CUBE_DIR):
+    """
+    Load cube cells, reading only the HS `levels` (6, 4, 2, 0) and the
+    year/reporter partitions asked for.
+    """
+    filters = []
+    if levels is not None:
+        filters.append(("hsLevel", "in", [int(level) for level in levels]))
+    if years is not None:
+        filters.append(("year", "in", [int(y) for y in years]))
+    if reporters is not None:
+        filters.append(("reporterISO3", "in", list(reporters)))
+    return pd.read_parquet(path, columns=columns, filters=filters or None)
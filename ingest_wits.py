@@ -1,45 +1,221 @@
-
 # ingest_wits.py
 """
 Scans a directory of WITS offline ZIP exports (H6 MFN):
-unzips each, reads its CSV, tags reporter/year, and concatenates into one table.
+streams each archive's CSV in chunks and writes it straight to a Parquet
+dataset partitioned by reporter and year, one archive per worker process,
+so peak memory is about one chunk per worker.
+
+    data/processed/wits_mfn_h6/reporter=USA/year=2023/AVEMFN_H6_USA_2023_U2-00000.parquet
+
+Ingest is incremental: a manifest of archives (path, size, hash, partition)
+means re-runs only process new or changed ZIPs and drop the files of ZIPs
+that were deleted. `--full` re-ingests every archive.
+wits_fetch.py writes API downloads into the same dataset; this script is
+only needed for schedules that are only available as offline exports. A
+partition holds one source only: the API schedule wins, so archives for a
+reporter-year wits_fetch.py has downloaded are skipped.
 """
+import argparse
+import hashlib
+import json
 import os
+import time
 import zipfile
 import pandas as pd
+import pyarrow as pa
+import pyarrow.parquet as pq
+from concurrent.futures import ProcessPoolExecutor, as_completed
 from glob import glob
 
 ZIP_DIR = 'data/raw/wits_h6_offline'
-OUT_CSV = 'data/processed/wits_mfn_h6_offline.csv'
+OUT_DIR = 'data/processed/wits_mfn_h6'
+# Leading underscore: ignored by Parquet dataset readers
+MANIFEST = os.path.join(OUT_DIR, '_ingest_manifest.json')
+CHUNK_ROWS = 250_000  # rows read from a CSV at a time
+API_STEM = 'TRN'  # file prefix of wits_fetch.py's API downloads
+WORKERS = int(os.environ.get('WITS_INGEST_WORKERS', os.cpu_count() or 1))
+
+# Fixed types for the columns merge.py relies on, so every chunk and
+# archive writes the same Parquet schema
+COLUMN_TYPES = {'REPORTER': 'Int32', 'YEAR': 'Int16', 'PRODUCT': 'string', 'VALUE': 'float64'}
+
+
+def parse_zip_name(zippath):
+    """AVEMFN_H6_USA_2023_U2.zip → ('USA', 2023)"""
+    parts = os.path.basename(zippath).replace('.zip', '').split('_')
+    _, nomen, reporter, year, _ = parts
+    return reporter, int(year)
+
+
+def partition_dir(out_dir, reporter, year):
+    return os.path.join(out_dir, f"reporter={reporter}", f"year={year}")
+
+
+def file_hash(path, block=1 << 20):
+    h = hashlib.sha256()
+    with open(path, 'rb') as f:
+        for data in iter(lambda: f.read(block), b''):
+            h.update(data)
+    return h.hexdigest()
+
+
+def load_manifest(path=MANIFEST):
+    """{zip path: {'size', 'mtime', 'sha256', 'partition', 'rows', 'files', 'ingested_at'}}"""
+    if os.path.exists(path):
+        with open(path) as f:
+            return json.load(f)
+    return {}
+
+
+def save_manifest(manifest, path=MANIFEST):
+    tmp = path + '.tmp'
+    with open(tmp, 'w') as f:
+        json.dump(manifest, f, indent=1, sort_keys=True)
+    os.replace(tmp, path)
+
+
+def is_unchanged(zippath, entry):
+    """
+    Same size and mtime as when ingested; if only the mtime moved, compare
+    content hashes (and adopt the new mtime when they match).
+    """
+    if entry is None:
+        return False
+    st = os.stat(zippath)
+    if st.st_size != entry['size']:
+        return False
+    if st.st_mtime == entry['mtime']:
+        return True
+    if file_hash(zippath) == entry['sha256']:
+        entry['mtime'] = st.st_mtime
+        return True
+    return False
+
+
+def drop_archive(zippath, entry, out_dir=OUT_DIR):
+    """Remove the Parquet files one archive produced, and its partition if nothing else is in it."""
+    target = os.path.join(out_dir, entry['partition'])
+    clear_parts(target, os.path.basename(zippath)[:-len('.zip')])
+    for d in (target, os.path.dirname(target)):
+        if os.path.isdir(d) and not os.listdir(d):
+            os.rmdir(d)
+
+
+def normalise(chunk):
+    """Cast a CSV chunk to stable types: known columns as declared, other numbers as float, the rest as text."""
+    for col in chunk.columns:
+        if col in COLUMN_TYPES:
+            chunk[col] = chunk[col].astype(COLUMN_TYPES[col])
+        elif pd.api.types.is_numeric_dtype(chunk[col]):
+            chunk[col] = chunk[col].astype('float64')
+        else:
+            chunk[col] = chunk[col].astype('string')
+    return chunk
+
+
+def write_part(df, target, stem, index):
+    """Write one normalised chunk as <target>/<stem>-<index>.parquet, atomically."""
+    table = pa.Table.from_pandas(normalise(df), preserve_index=False)
+    path = os.path.join(target, f"{stem}-{index:05d}.parquet")
+    pq.write_table(table, path + '.tmp', compression='zstd')
+    os.replace(path + '.tmp', path)
+
+
+def clear_parts(target, stem):
+    """Remove earlier output of `stem` from a partition."""
+    for old in glob(os.path.join(target, f"{stem}-*.parquet")):
+        os.remove(old)
+
+
+def clear_archives(target):
+    """Remove the output of every offline archive from a partition; returns the files removed."""
+    old = [f for f in glob(os.path.join(target, '*.parquet'))
+           if not os.path.basename(f).startswith(API_STEM + '_')]
+    for f in old:
+        os.remove(f)
+    return len(old)
+
+
+def has_api_schedule(target):
+    return bool(glob(os.path.join(target, f"{API_STEM}_*.parquet")))
+
+
+def ingest_zip(zippath, out_dir=OUT_DIR, chunk_rows=CHUNK_ROWS):
+    """
+    Stream the CSV inside one archive into its reporter/year partition.
+    Files are named after the archive, and earlier output of the same archive is
+    replaced, so re-ingesting is idempotent. Archives whose partition already
+    holds wits_fetch.py's API schedule write nothing. Returns (zip, reporter,
+    year, rows, files, sha256 of the archive).
+    """
+    digest = file_hash(zippath)
+    reporter, year = parse_zip_name(zippath)
+    stem = os.path.basename(zippath)[:-len('.zip')]
+    target = partition_dir(out_dir, reporter, year)
+    os.makedirs(target, exist_ok=True)
+    clear_parts(target, stem)
+    if has_api_schedule(target):
+        return zippath, reporter, year, 0, 0, digest
+
+    rows = files = 0
+    with zipfile.ZipFile(zippath, 'r') as zf:
+        # find the CSV inside
+        member = next((m for m in zf.namelist() if m.lower().endswith('.csv')), None)
+        if member is None:
+            return zippath, reporter, year, 0, 0, digest
+        with zf.open(member) as f:
+            for chunk in pd.read_csv(f, chunksize=chunk_rows, dtype={'PRODUCT': str}):
+                write_part(chunk, target, stem, files)
+                rows += len(chunk)
+                files += 1
+    return zippath, reporter, year, rows, files, digest
+
 
+def main(full=False):
+    zips = sorted(glob(os.path.join(ZIP_DIR, '*.zip')))
+    os.makedirs(OUT_DIR, exist_ok=True)
+    manifest = load_manifest()
+    if full:
+        # Only archive output: wits_fetch.py writes into the same dataset
+        for zippath, entry in manifest.items():
+            drop_archive(zippath, entry)
+        manifest = {}
+    start = time.time()
 
-def main():
-    os.makedirs(os.path.dirname(OUT_CSV), exist_ok=True)
-    if os.path.exists(OUT_CSV):
-        print(f"⇢ {OUT_CSV} already exists; skipping ingest.")
+    # Archives that disappeared since the last run take their rows with them
+    for zippath in sorted(set(manifest) - set(zips)):
+        drop_archive(zippath, manifest.pop(zippath))
+        print(f"✗ {os.path.basename(zippath)} deleted; dropped its rows from {OUT_DIR}")
+    todo = [z for z in zips if not is_unchanged(z, manifest.get(z))]
+    skipped = len(zips) - len(todo)
+    save_manifest(manifest)
+    if not todo:
+        print(f"⇢ All {skipped} WITS archives already ingested into {OUT_DIR}; nothing to do.")
         return
 
-    all_frames = []
-    for zippath in sorted(glob(os.path.join(ZIP_DIR, '*.zip'))):
-        fname = os.path.basename(zippath)
-        # expect names like AVEMFN_H6_USA_2023_U2.zip
-        parts = fname.replace('.zip', '').split('_')
-        _, nomen, reporter, year, _ = parts
-
-        with zipfile.ZipFile(zippath, 'r') as zf:
-            # find the CSV inside
-            for member in zf.namelist():
-                if member.lower().endswith('.csv'):
-                    with zf.open(member) as f:
-                        df = pd.read_csv(f)
-                        df['reporterISO3'] = reporter
-                        df['year'] = int(year)
-                        all_frames.append(df)
-                    break
-
-    combined = pd.concat(all_frames, ignore_index=True)
-    combined.to_csv(OUT_CSV, index=False)
-    print(f"✓ Combined {len(all_frames)} files → {OUT_CSV}  ({len(combined)} rows)")
+    total = 0
+    with ProcessPoolExecutor(max_workers=min(WORKERS, len(todo))) as pool:
+        futures = [pool.submit(ingest_zip, z) for z in todo]
+        for future in as_completed(futures):
+            zippath, reporter, year, rows, files, digest = future.result()
+            total += rows
+            st = os.stat(zippath)
+            manifest[zippath] = {
+                'size': st.st_size, 'mtime': st.st_mtime, 'sha256': digest,
+                'partition': os.path.relpath(partition_dir(OUT_DIR, reporter, year), OUT_DIR),
+                'rows': rows, 'files': files, 'ingested_at': time.time(),
+            }
+            save_manifest(manifest)  # a crash only re-ingests archives not yet recorded
+            if files or not has_api_schedule(partition_dir(OUT_DIR, reporter, year)):
+                print(f"✓ {os.path.basename(zippath)} → reporter={reporter}/year={year} ({rows} rows, {files} files)")
+            else:
+                print(f"⇢ {os.path.basename(zippath)}: reporter={reporter}/year={year} already has the API "
+                      f"schedule from wits_fetch.py; skipped")
+    print(f"✓ Ingested {len(todo)} archives → {OUT_DIR}  ({total} rows; {skipped} unchanged skipped, "
+          f"{time.time() - start:.1f}s)")
 
 if __name__ == '__main__':
-    main()
\ No newline at end of file
+    parser = argparse.ArgumentParser(description=__doc__, formatter_class=argparse.RawDescriptionHelpFormatter)
+    parser.add_argument('--full', action='store_true', help="ignore the manifest and re-ingest every archive")
+    args = parser.parse_args()
+    main(full=args.full)
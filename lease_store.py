@@ -0,0 +1,171 @@
+"""
+SQLite lease table for sharded Comtrade fetching.
+The (reporter, period) grid is seeded as leases; each worker process (one per
+API key) claims one at a time, keeps it alive with a heartbeat while fetching
+and marks it done. A lease whose holder stops renewing it - a crashed or
+killed worker - expires and is handed to the next worker that asks, which
+resumes from the shared request manifest.
+
+A lease can carry the Comtrade release (lastReleased, checksum) it is to be
+fetched at, so workers of a --refresh run key the raw cache by the new
+release before the coordinator records it in the manifest.
+"""
+import os
+import sqlite3
+import threading
+import time
+from contextlib import contextmanager
+
+# Seconds a claimed lease stays valid without a heartbeat
+LEASE_TTL = int(os.environ.get('COMTRADE_LEASE_TTL', 900))
+
+
+class LeaseLost(Exception):
+    """Raised by a worker's fetch loop once its lease was taken over by another worker."""
+
+
+class LeaseStore:
+    def __init__(self, path, ttl=LEASE_TTL):
+        self.path = path
+        self.ttl = ttl
+        os.makedirs(os.path.dirname(path) or '.', exist_ok=True)
+        self.conn = self._connect()
+        self.conn.execute(
+            """
+            CREATE TABLE IF NOT EXISTS leases (
+                reporter   INTEGER NOT NULL,
+                period     TEXT NOT NULL,
+                priority   REAL NOT NULL DEFAULT 0,
+                status     TEXT NOT NULL DEFAULT 'open',
+                owner      TEXT,
+                expires_at REAL,
+                claims     INTEGER NOT NULL DEFAULT 0,
+                last_released TEXT,
+                checksum   TEXT,
+                PRIMARY KEY (reporter, period)
+            )
+            """
+        )
+        columns = {row[1] for row in self.conn.execute("PRAGMA table_info(leases)")}
+        for column in ('last_released', 'checksum'):
+            if column not in columns:
+                self.conn.execute(f"ALTER TABLE leases ADD COLUMN {column} TEXT")
+        self.conn.commit()
+
+    def _connect(self):
+        # Several processes share the file; wait for each other's write locks
+        conn = sqlite3.connect(self.path, timeout=60, isolation_level=None)
+        conn.execute("PRAGMA journal_mode=WAL")
+        return conn
+
+    def seed(self, slices, releases=None):
+        """
+        Start a new run: replace all leases with (reporter, period, priority)
+        tuples. `releases` ({(reporter, period): (lastReleased, checksum)}) are
+        stored with their leases.
+        """
+        releases = releases or {}
+        self.conn.execute("BEGIN IMMEDIATE")
+        self.conn.execute("DELETE FROM leases")
+        self.conn.executemany(
+            "INSERT INTO leases (reporter, period, priority, last_released, checksum) VALUES (?, ?, ?, ?, ?)",
+            [(int(r), str(p), float(w), *releases.get((int(r), str(p)), (None, None))) for r, p, w in slices],
+        )
+        self.conn.execute("COMMIT")
+
+    def releases(self):
+        """{(reporter, period): (lastReleased, checksum)} for leases seeded with a release."""
+        return {
+            (reporter, period): (last_released, checksum)
+            for reporter, period, last_released, checksum in self.conn.execute(
+                "SELECT reporter, period, last_released, checksum FROM leases WHERE last_released IS NOT NULL"
+            )
+        }
+
+    def claim(self, owner):
+        """
+        Atomically take the highest-priority open or expired lease.
+        Returns (reporter, period), or None if nothing is claimable right now.
+        """
+        now = time.time()
+        self.conn.execute("BEGIN IMMEDIATE")
+        try:
+            row = self.conn.execute(
+                """
+                SELECT reporter, period, owner FROM leases
+                WHERE status = 'open' OR (status = 'claimed' AND expires_at < ?)
+                ORDER BY priority DESC, reporter, period LIMIT 1
+                """,
+                (now,),
+            ).fetchone()
+            if row is None:
+                return None
+            reporter, period, previous = row
+            self.conn.execute(
+                """
+                UPDATE leases SET status = 'claimed', owner = ?, expires_at = ?, claims = claims + 1
+                WHERE reporter = ? AND period = ?
+                """,
+                (owner, now + self.ttl, reporter, period),
+            )
+            if previous and previous != owner:
+                print(f"⇢ Lease {reporter}/{period} held by {previous} expired; re-claimed by {owner}")
+            return reporter, period
+        finally:
+            self.conn.execute("COMMIT")
+
+    def _renew(self, conn, reporter, period, owner):
+        cur = conn.execute(
+            "UPDATE leases SET expires_at = ? WHERE reporter = ? AND period = ? AND owner = ? AND status = 'claimed'",
+            (time.time() + self.ttl, int(reporter), str(period), owner),
+        )
+        return cur.rowcount == 1
+
+    def renew(self, reporter, period, owner):
+        """Extend a held lease; False if it expired and was taken by another worker."""
+        return self._renew(self.conn, reporter, period, owner)
+
+    @contextmanager
+    def held(self, reporter, period, owner):
+        """
+        Renew the lease from a background thread (own connection) while the
+        block runs. Yields an Event that is set if a renewal fails: the lease
+        belongs to another worker now, so the block should stop fetching.
+        """
+        stop = threading.Event()
+        lost = threading.Event()
+
+        def heartbeat():
+            conn = self._connect()
+            try:
+                while not stop.wait(self.ttl / 3):
+                    if not self._renew(conn, reporter, period, owner):
+                        print(f"⚠️ {owner} lost its lease on {reporter}/{period}")
+                        lost.set()
+                        break
+            finally:
+                conn.close()
+
+        thread = threading.Thread(target=heartbeat, daemon=True)
+        thread.start()
+        try:
+            yield lost
+        finally:
+            stop.set()
+            thread.join()
+
+    def complete(self, reporter, period, owner):
+        self.conn.execute(
+            "UPDATE leases SET status = 'done', expires_at = NULL WHERE reporter = ? AND period = ? AND owner = ?",
+            (int(reporter), str(period), owner),
+        )
+
+    def next_expiry(self):
+        """Earliest expiry among leases other workers still hold, or None if none are held."""
+        return self.conn.execute("SELECT MIN(expires_at) FROM leases WHERE status = 'claimed'").fetchone()[0]
+
+    def status_counts(self):
+        return dict(self.conn.execute("SELECT status, COUNT(*) FROM leases GROUP BY status").fetchall())
+
+    def close(self):
+        self.conn.close()
@@ -11,6 +11,7 @@ from dotenv import load_dotenv
 import traceback
 import asyncio
 from letta_client import Letta, MessageCreate, TextContent
+import tariff_sim
 
 # Load environment variables
 load_dotenv()
@@ -114,6 +115,28 @@ async def get_chat_history():
         print(f"Error fetching chat history: {e}")
         raise HTTPException(status_code=500, detail="An error occurred while fetching history")
 
+# --- Tariff Simulation ---
+class TariffScenario(BaseModel):
+    tariffRate: float = 0.0  # 0.25 = 25%, as the ArcMap slider
+    retaliationEnabled: bool = False
+    reporter: str = "USA"
+    year: Optional[int] = None  # latest merged year by default
+
+@app.post("/simulate")
+def simulate_tariffs(scenario: TariffScenario):
+    """Runs a tariff/retaliation scenario on the merged flows and returns per-partner and per-HS deltas"""
+    if scenario.tariffRate < 0:
+        raise HTTPException(status_code=400, detail="tariffRate must be zero or positive")
+    try:
+        return tariff_sim.simulate(scenario.tariffRate, scenario.retaliationEnabled,
+                                   scenario.reporter.upper(), scenario.year)
+    except (FileNotFoundError, LookupError) as e:
+        raise HTTPException(status_code=404, detail=str(e))
+    except Exception as e:
+        print(f"Error running tariff simulation: {e}")
+        traceback.print_exc()
+        raise HTTPException(status_code=500, detail="An error occurred while running the simulation")
+
 # Add this variable near the top of your file, after the manager initialization
 active_requests = {}  # Dictionary to track client requests
 
@@ -1,126 +1,519 @@
 # merge.py
+"""
+Joins Comtrade flows with WITS MFN rates and Kee elasticities.
+The result is a typed Parquet dataset partitioned by year and reporter
+(data/processed/flows_with_mfn/year=2023/reporterISO3=USA/...), with
+low-cardinality text columns dictionary-encoded, so readers can load just the
+columns and partitions they need (see `read_merged`). `--csv` also writes the
+flat flows_with_mfn.csv export for the frontend.
+
+The merge runs out of core, so the all-reporter grid fits in bounded memory:
+  1. tariffs and elasticities are pre-aggregated to HS2, one WITS partition at
+     a time, into small lookups indexed by (reporter, year, hs2) / (reporter, hs2);
+  2. trade_flows.csv is streamed in chunks and split into reporter/year staging
+     partitions;
+  3. worker processes join one flow partition at a time against the lookups
+     and write its output partition.
+Peak memory is about one CSV chunk, or one partition per worker.
+
+Merges are incremental: inputs are fingerprinted per partition (flows and
+WITS rates by reporter-year, elasticities by reporter) in a manifest next to
+the output, and only output partitions whose inputs changed are recomputed.
+`--full` recomputes everything.
+
+Rows are keyed by integer flowKey/timeKey (flow_keys.py); the flowKey →
+flowID dictionary is written alongside to data/processed/flow_keys/, and the
+CSV export carries both. Each partition also gets its slice of the HS rollup
+cube (hs_cube.py, data/processed/hs_cube/): value, trade-weighted and simple
+MFN, and value-weighted tau_mean per partner, flow and HS6/HS4/HS2/total code.
+
+Data-quality checks (flow_checks.py) run on each partition while it is in
+memory; their counts are kept in the manifest and combined into
+flows_with_mfn/_validation.json. The run exits non-zero when a check breaches
+its threshold (`--threshold min_mfn_coverage=0.8`, ...).
+"""
+import argparse
+import hashlib
+import json
+import os
+import shutil
+import time
+from concurrent.futures import ProcessPoolExecutor, as_completed
+from glob import glob
 import pandas as pd
-import pycountry
+import pyarrow as pa
+import pyarrow.parquet as pq
+import flow_checks
+import flow_keys
+from country_codes import to_iso3
+from flow_schema import read_flows
+from hs_cube import CUBE_DIR, build_cube, hs_codes, tariff_levels
+from ingest_wits import file_hash
 
-def num_to_iso3(code):
-    try:
-        return pycountry.countries.get(numeric=str(int(code)).zfill(3)).alpha_3
-    except:
-        return None
+FLOWS_CSV = "data/processed/trade_flows.csv"
+WITS_DIR = "data/processed/wits_mfn_h6"
+ELASTICITIES_CSV = "data/csv/kee_elasticities.csv"
+OUT_DIR = "data/processed/flows_with_mfn"
+OUT_CSV = "data/processed/flows_with_mfn.csv"
+TIME_DIM_CSV = "data/processed/time_dimension.csv"
+STAGING_DIR = "data/processed/_merge_staging"
+# Leading underscore: ignored by Parquet dataset readers
+MANIFEST = os.path.join(OUT_DIR, "_merge_manifest.json")
+MFN_CACHE = os.path.join(OUT_DIR, "_mfn_hs2.parquet")
+VALIDATION_JSON = os.path.join(OUT_DIR, "_validation.json")
+PARTITION_COLS = ["year", "reporterISO3"]
+CHUNK_ROWS = 250_000  # flow rows read from the CSV at a time
+WORKERS = int(os.environ.get("MERGE_WORKERS", os.cpu_count() or 1))
+
+OUT_COLS = [
+    "flowKey","timeKey",
+    # then everything else you need downstream:
+    "typeCode","freqCode","refPeriodId","year","refMonth","period",
+    "reporterCode","reporterISO3","reporterDesc",
+    "flowCode","flowDesc",
+    "partnerCode","partnerISO","partnerDesc",
+    "partner2Code","partner2ISO","partner2Desc",
+    "classificationCode","classificationSearchCode","isOriginalClassification",
+    "cmdCode","cmdDesc","aggrLevel","isLeaf",
+    "customsCode","customsDesc","mosCode","motCode","motDesc",
+    "qtyUnitCode","qtyUnitAbbr","qty","isQtyEstimated",
+    "altQtyUnitCode","altQtyUnitAbbr","altQty","isAltQtyEstimated",
+    "netWgt","isNetWgtEstimated","grossWgt","isGrossWgtEstimated",
+    "cifvalue","fobvalue","primaryValue","legacyEstimationFlag",
+    "isReported","isAggregate","mfnRate","tau_mean"
+]
+# The flat export also carries the human-readable IDs the integer keys stand for
+EXPORT_COLS = ["flowID","timeID"] + OUT_COLS
+FLAG_COLS = [c for c in OUT_COLS if c.startswith("is")]
+# Text columns with many repeats: stored as Parquet dictionaries, read back as categoricals
+DICT_COLS = [
+    "typeCode","freqCode","reporterISO3","reporterDesc","flowCode","flowDesc",
+    "partnerISO","partnerDesc","partner2ISO","partner2Desc","classificationCode",
+    "classificationSearchCode","cmdDesc","customsCode","customsDesc","motDesc",
+    "qtyUnitAbbr","altQtyUnitAbbr",
+]
+# Fixed numeric types, so every partition is written with the same schema
+INT_COLS = [
+    "refPeriodId","year","refMonth","period","reporterCode","partnerCode","partner2Code",
+    "cmdCode","aggrLevel","mosCode","motCode","qtyUnitCode","altQtyUnitCode","legacyEstimationFlag",
+]
+FLOAT_COLS = [
+    "qty","altQty","netWgt","grossWgt","cifvalue","fobvalue","primaryValue","mfnRate","tau_mean",
+]
+
+# Set in each worker process by _init_worker
+_mfn = _tau = None
+
+
+def typed(df):
+    """Output columns with stable types: flags as booleans, repeated text as categoricals."""
+    df = df[OUT_COLS].copy()
+    for col in FLAG_COLS:
+        if df[col].dtype == object:
+            df[col] = df[col].map({"True": True, "False": False, True: True, False: False})
+        df[col] = df[col].astype("boolean")
+    for col in DICT_COLS:
+        df[col] = df[col].astype("string").astype("category")
+    for col in INT_COLS:
+        df[col] = pd.to_numeric(df[col]).astype("Int64")
+    for col in FLOAT_COLS:
+        df[col] = pd.to_numeric(df[col]).astype("float64")
+    df["flowKey"] = df["flowKey"].astype("int64")
+    df["timeKey"] = df["timeKey"].astype("int32")
+    return df
+
+
+def partition_path(out_dir, reporter, year):
+    return os.path.join(out_dir, f"year={year}", f"reporterISO3={reporter}")
+
+
+def read_merged(columns=None, years=None, reporters=None, path=OUT_DIR):
+    """
+    Load the merged dataset, reading only `columns` and the partitions for
+    `years` / `reporters` (ISO3) when given.
+    """
+    filters = []
+    if years is not None:
+        filters.append(("year", "in", [int(y) for y in years]))
+    if reporters is not None:
+        filters.append(("reporterISO3", "in", list(reporters)))
+    return pd.read_parquet(path, columns=columns, filters=filters or None)
+
+
+# ------------------------------------------------------------
+# manifest
+def partition_key(reporter, year):
+    return f"{reporter}/{year}"
+
+
+def split_key(key):
+    reporter, year = key.split("/")
+    return reporter, int(year)
+
+
+def load_manifest(path=MANIFEST):
+    """
+    {'flows_csv': [size, mtime], 'flows': {'USA/2023': {'sha256', 'rows'}},
+     'wits': {'USA/2023': sha256}, 'wits_files': {path: [size, mtime, sha256]},
+     'partitions': {'USA/2023': {'inputs', 'rows', 'merged_at', 'checks', 'timeKeys'}}}
+    """
+    if os.path.exists(path):
+        with open(path) as f:
+            return json.load(f)
+    return {}
+
+
+def save_manifest(manifest, path=MANIFEST):
+    os.makedirs(os.path.dirname(path), exist_ok=True)
+    tmp = path + ".tmp"
+    with open(tmp, "w") as f:
+        json.dump(manifest, f, indent=1, sort_keys=True)
+    os.replace(tmp, path)
+
+
+def frame_hash(df, h=None):
+    """Fold a frame's content (columns and values) into a sha256."""
+    h = h or hashlib.sha256()
+    h.update(",".join(map(str, df.columns)).encode())
+    h.update(pd.util.hash_pandas_object(df, index=False).to_numpy().tobytes())
+    return h
+
+
+# ------------------------------------------------------------
+# lookups
+def wits_fingerprints(previous=None, wits_dir=WITS_DIR):
+    """
+    ({'USA/2023': sha256}, {path: [size, mtime, sha256]}) from the contents of
+    each WITS partition's files: wits_fetch.py rewrites a partition on every
+    run, so mtimes change when the rates have not. Files whose size and mtime
+    match `previous` (the second value of an earlier call) are not re-read.
+    """
+    previous = previous or {}
+    prints, files = {}, {}
+    for part in sorted(glob(os.path.join(wits_dir, "reporter=*", "year=*"))):
+        reporter = os.path.basename(os.path.dirname(part))[len("reporter="):]
+        year = int(os.path.basename(part)[len("year="):])
+        h = hashlib.sha256()
+        for f in sorted(glob(os.path.join(part, "*.parquet"))):
+            st = os.stat(f)
+            known = previous.get(f)
+            digest = known[2] if known and known[:2] == [st.st_size, st.st_mtime] else file_hash(f)
+            files[f] = [st.st_size, st.st_mtime, digest]
+            h.update(f"{os.path.basename(f)}:{digest}\n".encode())
+        prints[partition_key(reporter, year)] = h.hexdigest()
+    return prints, files
+
+
+def mfn_lookup(fingerprints, previous=None, wits_dir=WITS_DIR, cache=MFN_CACHE):
+    """
+    WITS H6 MFN rates averaged to HS2, indexed by (reporterISO3, year, hs2).
+    Aggregated one reporter/year partition at a time; HS2 averages of WITS
+    partitions whose fingerprint matches `previous` are reused from `cache`.
+    """
+    previous = previous or {}
+    keep = {k for k, fp in fingerprints.items() if previous.get(k) == fp}
+    parts = []
+    if keep and os.path.exists(cache):
+        cached = pd.read_parquet(cache)
+        parts.append(cached[cached["partition"].isin(keep)])
+    else:
+        keep = set()
+    for key in sorted(set(fingerprints) - keep):
+        reporter, year = split_key(key)
+        df_wits = pd.read_parquet(os.path.join(wits_dir, f"reporter={reporter}", f"year={year}"),
+                                  columns=["REPORTER","YEAR","PRODUCT","VALUE"])
+        df_wits["reporterISO3"] = to_iso3(df_wits["REPORTER"], "wits")
+        df_wits["year"]         = df_wits["YEAR"].astype(int)
+        df_wits["hs2"]          = df_wits["PRODUCT"].astype(str).str.zfill(6).str[:2].astype(int)
+        df_wits["mfnRate"]      = df_wits["VALUE"].astype(float)
+        df_wits = df_wits.dropna(subset=["reporterISO3","year","hs2","mfnRate"])
+        # average to HS2
+        df_mfn2 = df_wits.groupby(["reporterISO3","year","hs2"], as_index=False).mfnRate.mean()
+        parts.append(df_mfn2.assign(partition=key))
+    columns = ["reporterISO3","year","hs2","mfnRate","partition"]
+    df_mfn2 = pd.concat(parts, ignore_index=True)[columns] if parts else pd.DataFrame(columns=columns)
+    os.makedirs(os.path.dirname(cache), exist_ok=True)
+    df_mfn2.to_parquet(cache + ".tmp", index=False)
+    os.replace(cache + ".tmp", cache)
+    df_mfn2 = df_mfn2.astype({"year": int, "hs2": int, "mfnRate": float})
+    return df_mfn2.set_index(["reporterISO3","year","hs2"]).mfnRate.sort_index()
+
+
+def load_elasticities(path=ELASTICITIES_CSV):
+    df_elas = pd.read_csv(path).rename(columns={"iso3": "reporterISO3", "elasticity": "tau"})
+    df_elas["hs2"] = df_elas["hs2"].astype(int)
+    return df_elas
+
+
+def elasticity_fingerprints(df_elas):
+    """{reporterISO3: sha256} of each reporter's elasticity rows."""
+    return {reporter: frame_hash(group).hexdigest()
+            for reporter, group in df_elas.groupby("reporterISO3", sort=True)}
 
-def main():
-    # ------------------------------------------------------------
-    # 1) load Comtrade flows
-    df_flow = pd.read_csv("data/processed/trade_flows.csv")
 
+def tau_lookup(df_elas):
+    """A single Kee elasticity per reporter & HS2, indexed by (reporterISO3, hs2)."""
+    return df_elas.groupby(["reporterISO3", "hs2"]).tau.mean().rename("tau_mean").sort_index()
+
+
+# ------------------------------------------------------------
+# flows
+def prepare_flows(df_flow):
+    """Year, month, HS2 and reporterISO3 columns on a chunk of trade_flows.csv."""
     # detect + rename 'year'
     if "year" not in df_flow.columns:
         if "refYear" in df_flow.columns:
             df_flow = df_flow.rename(columns={"refYear": "year"})
         elif "period" in df_flow.columns:
-            df_flow["year"] = df_flow["period"].astype(int)
+            period = df_flow["period"].astype(int)
+            df_flow["year"] = period.where(period <= 9999, period // 100)  # YYYY or YYYYMM
         else:
             raise KeyError("No year/refYear/period column found in trade_flows.csv")
     df_flow["year"] = df_flow["year"].astype(int)
 
-    # HS2 is just cmdCode as int
-    df_flow["cmdCode"] = df_flow["cmdCode"].astype(int)
-    df_flow["hs2"]     = df_flow["cmdCode"]
+    # month of monthly (--freq M) periods, 0 for annual ones; part of flowKey and timeKey
+    if "period" in df_flow.columns:
+        period = df_flow["period"].astype(int)
+        df_flow["month"] = period.where(period > 9999, 0) % 100
+    elif "refMonth" in df_flow.columns:
+        month = df_flow["refMonth"].astype(int)  # Comtrade uses 52 for annual data
+        df_flow["month"] = month.where(month.between(1, 12), 0)
+    else:
+        df_flow["month"] = 0
+
+    # HS2 is the chapter of the code at its own level (HS4 8501 → 85); cmdCode
+    # keeps the code itself, which is what flowKey packs
+    code, _ = hs_codes(df_flow["cmdCode"], df_flow["aggrLevel"] if "aggrLevel" in df_flow.columns else None)
+    df_flow["cmdCode"] = code.astype(int)
+    df_flow["hs2"]     = code.str[:2].astype(int)
 
     # rename reporterISO → reporterISO3
-    df_flow = df_flow.rename(columns={"reporterISO": "reporterISO3"})
+    return df_flow.rename(columns={"reporterISO": "reporterISO3"})
 
-    # ------------------------------------------------------------
-    # 2) load offline WITS H6 MFN rates
-    df_wits = pd.read_csv("data/processed/wits_mfn_h6_offline.csv")
-    df_wits["reporterISO3"] = df_wits["REPORTER"].apply(num_to_iso3)
-    df_wits["year"]         = df_wits["YEAR"].astype(int)
-    df_wits["hs6"]          = df_wits["PRODUCT"].astype(str).str.zfill(6)
-    df_wits["hs2"]          = df_wits["hs6"].str[:2].astype(int)
-    df_wits["mfnRate"]      = df_wits["VALUE"].astype(float)
-    df_wits = df_wits.dropna(subset=["reporterISO3","year","hs2","mfnRate"])
-
-    # average to HS2
-    df_mfn2 = (
-        df_wits
-        .groupby(["reporterISO3","year","hs2"], as_index=False)
-        .mfnRate
-        .mean()
-    )
 
+def stage_flows(only=None, flows_csv=FLOWS_CSV, staging_dir=STAGING_DIR, chunk_rows=CHUNK_ROWS):
+    """
+    Stream trade_flows.csv into reporter/year staging partitions (only the
+    'USA/2023' keys in `only`, if given).
+    Returns {'USA/2023': {'sha256': content fingerprint, 'rows': rows}}.
+    """
+    hashes, rows = {}, {}
+    for i, chunk in enumerate(read_flows(flows_csv, chunksize=chunk_rows)):
+        chunk = prepare_flows(chunk)
+        for (reporter, year), group in chunk.groupby(["reporterISO3", "year"], sort=False):
+            key = partition_key(reporter, year)
+            if only is not None and key not in only:
+                continue
+            target = partition_path(staging_dir, reporter, year)
+            os.makedirs(target, exist_ok=True)
+            group.to_parquet(os.path.join(target, f"chunk-{i:05d}.parquet"), index=False)
+            hashes[key] = frame_hash(group, hashes.get(key))
+            rows[key] = rows.get(key, 0) + len(group)
+    return {key: {"sha256": h.hexdigest(), "rows": rows[key]} for key, h in hashes.items()}
+
+
+def join_partition(df_flow, mfn, tau):
+    """Attach mfnRate and tau_mean to one reporter/year of flows and build the keys."""
     # ------------------------------------------------------------
-    # 3) merge MFN into flows
-    # Note: Moved this merging to step 5 below
-    
-    # ------------------------------------------------------------
-    # 4) load Kee elasticities and aggregate to HS2
-    df_elas = pd.read_csv("data/csv/kee_elasticities.csv") \
-        .rename(columns={"iso3": "reporterISO3", "elasticity": "tau"})
-    df_elas["hs2"] = df_elas["hs2"].astype(int)
+    # merge MFN & tau into flows, by index lookup
+    mfn_keys = pd.MultiIndex.from_arrays([df_flow["reporterISO3"], df_flow["year"], df_flow["hs2"]])
+    tau_keys = pd.MultiIndex.from_arrays([df_flow["reporterISO3"], df_flow["hs2"]])
+    merged = df_flow.drop(columns=["hs2"])
+    merged["mfnRate"]  = mfn.reindex(mfn_keys).to_numpy()
+    merged["tau_mean"] = tau.reindex(tau_keys).to_numpy()
 
-    # compute a single elasticity per reporter & HS2  
-    df_tau2 = (
-        df_elas
-        .groupby(["reporterISO3", "hs2"], as_index=False)
-        .tau
-        .mean()
-        .rename(columns={"tau": "tau_mean"})
+    # ------------------------------------------------------------
+    # build primary keys
+    # a) flowKey: unique per flow record, packed from the reporter/partner/HS/flow/period codes
+    merged["flowKey"] = flow_keys.pack(
+        merged["reporterCode"], merged["partnerCode"], merged["cmdCode"], merged["flowCode"], merged["year"],
+        merged["month"],
     )
 
+    # b) timeKey: unique per time object, the year and month (00 when annual)
+    merged["timeKey"] = flow_keys.time_keys(merged["year"], merged["month"])
+    return merged
+
+
+def _init_worker(mfn, tau):
+    global _mfn, _tau
+    _mfn, _tau = mfn, tau
+
+
+def write_partition(df, out_dir, reporter, year):
+    """Write one reporter/year partition file atomically; partition values live in the directory names."""
+    target = partition_path(out_dir, reporter, year)
+    os.makedirs(target, exist_ok=True)
+    table = pa.Table.from_pandas(df.drop(columns=PARTITION_COLS, errors="ignore"), preserve_index=False)
+    path = os.path.join(target, "part-0.parquet")
+    pq.write_table(table, path + ".tmp", compression="zstd")
+    os.replace(path + ".tmp", path)
+
+
+def merge_partition(reporter, year, staging_dir=STAGING_DIR, out_dir=OUT_DIR, cube_dir=CUBE_DIR,
+                    keys_dir=flow_keys.KEYS_DIR):
+    """
+    Join one staged reporter/year partition and write its output, flowID
+    dictionary and HS cube partitions. Returns (reporter, year, rows, check stats,
+    timeKeys).
+    """
+    source = partition_path(staging_dir, reporter, year)
+    df_flow = pd.concat([pd.read_parquet(f) for f in sorted(glob(os.path.join(source, "*.parquet")))],
+                        ignore_index=True)
+    joined = join_partition(df_flow, _mfn, _tau)
+    merged = typed(joined)
+    write_partition(merged, out_dir, reporter, year)
+
+    # dictionary table: flowKey → human-readable flowID
+    ids = pd.DataFrame({"flowKey": merged["flowKey"], "flowID": flow_keys.flow_ids(joined).astype("string")})
+    ids = ids.drop_duplicates()
+    collided = ids["flowKey"].duplicated()
+    if collided.any():
+        raise ValueError(f"{reporter}/{year}: {int(collided.sum())} flowKeys stand for more than one flowID, "
+                         f"e.g. {ids['flowKey'][collided].iloc[0]}")
+    write_partition(ids, keys_dir, reporter, year)
+
+    tariffs = tariff_levels(os.path.join(WITS_DIR, f"reporter={reporter}", f"year={year}"))
+    cube = build_cube(merged, tariffs)
+    write_partition(cube, cube_dir, reporter, year)
+    time_keys = sorted(int(k) for k in merged["timeKey"].unique())
+    return reporter, year, len(merged), flow_checks.partition_stats(merged, cube, reporter), time_keys
+
+
+def drop_stale_partitions(keep, out_dir=OUT_DIR):
+    """Remove output partitions for reporter/years no longer in the flows."""
+    for path in glob(os.path.join(out_dir, "year=*", "reporterISO3=*")):
+        year = int(os.path.basename(os.path.dirname(path))[len("year="):])
+        reporter = os.path.basename(path)[len("reporterISO3="):]
+        if (reporter, year) not in keep:
+            shutil.rmtree(path)
+    for path in glob(os.path.join(out_dir, "year=*")):
+        if not os.listdir(path):
+            os.rmdir(path)
+
+
+def export_csv(partitions, out=OUT_CSV):
+    """Write the flat CSV export one output partition at a time."""
+    with open(out + ".tmp", "w") as f:
+        f.write(",".join(EXPORT_COLS) + "\n")
+        for reporter, year in sorted(partitions, key=lambda p: (p[1], p[0])):
+            df = read_merged(years=[year], reporters=[reporter])
+            df["year"], df["reporterISO3"] = year, reporter
+            df["flowID"] = df["flowKey"].map(flow_keys.read_flow_ids(years=[year], reporters=[reporter]))
+            df["timeID"] = flow_keys.time_ids(df["timeKey"]).to_numpy()
+            df.to_csv(f, columns=EXPORT_COLS, header=False, index=False)
+    os.replace(out + ".tmp", out)
+
+
+def main(csv=False, workers=WORKERS, chunk_rows=CHUNK_ROWS, full=False, thresholds=None):
+    manifest = {} if full else load_manifest()
+    done = manifest.get("partitions", {})
+
     # ------------------------------------------------------------
-    # 5) merge MFN & tau into flows
-    merged = (
-        df_flow
-        .merge(df_mfn2, on=["reporterISO3","year","hs2"], how="left")
-        .merge(df_tau2, on=["reporterISO3","hs2"], how="left")
-        .drop(columns=["hs2"])
-    )
+    # 1) pre-aggregate WITS H6 MFN rates and Kee elasticities to HS2 lookups
+    wits, wits_files = wits_fingerprints(manifest.get("wits_files"))
+    mfn = mfn_lookup(wits, manifest.get("wits"))
+    df_elas = load_elasticities()
+    elasticities = elasticity_fingerprints(df_elas)
+    tau = tau_lookup(df_elas)
+    print(f"✓ Lookups: {len(mfn)} reporter-year-HS2 MFN rates, {len(tau)} reporter-HS2 elasticities")
+
+    # ------------------------------------------------------------
+    # 2) stream Comtrade flows into reporter/year partitions
+    # (fingerprints from the manifest if trade_flows.csv has not changed)
+    st = os.stat(FLOWS_CSV)
+    flows_csv = [st.st_size, st.st_mtime]
+    shutil.rmtree(STAGING_DIR, ignore_errors=True)
+    staged = manifest.get("flows_csv") != flows_csv
+    flows = stage_flows(chunk_rows=chunk_rows) if staged else manifest["flows"]
 
     # ------------------------------------------------------------
-    # 6) build primary keys
-    # a) flowID: unique per flow record
-    merged["flowID"] = (
-        merged["reporterISO3"] + "_" +
-        merged["partnerISO"]     + "_" +
-        merged["cmdCode"].astype(str)   + "_" +
-        merged["flowCode"]      + "_" +
-        merged["year"].astype(str)
+    # 3) recompute the partitions whose inputs changed
+    inputs = {
+        key: {"flows": flow["sha256"], "wits": wits.get(key), "elasticities": elasticities.get(split_key(key)[0])}
+        for key, flow in flows.items()
+    }
+    todo = sorted(
+        key for key in inputs
+        if done.get(key, {}).get("inputs") != inputs[key]
+        or "checks" not in done[key]
+        or "timeKeys" not in done[key]  # merged before flowKey/timeKey carried the month
+        or not all(os.path.exists(os.path.join(partition_path(d, *split_key(key)), "part-0.parquet"))
+                   for d in (OUT_DIR, CUBE_DIR, flow_keys.KEYS_DIR))
     )
+    skipped = sorted(set(inputs) - set(todo))
+    if todo and not staged:
+        stage_flows(only=set(todo), chunk_rows=chunk_rows)
+    print(f"✓ {len(flows)} reporter-year partitions; {len(todo)} to merge, {len(skipped)} unchanged")
 
-    # b) timeID: unique per time object (we’re annual, so just year)
-    merged["timeID"] = "time_" + merged["year"].astype(str)
+    # ------------------------------------------------------------
+    # 4) merge MFN & tau into each changed partition, in parallel
+    manifest.update(flows_csv=None, wits=wits, wits_files=wits_files, partitions=done)
+    total = 0
+    with ProcessPoolExecutor(max_workers=max(1, min(workers, len(todo))),
+                             initializer=_init_worker, initargs=(mfn, tau)) as pool:
+        futures = [pool.submit(merge_partition, *split_key(key)) for key in todo]
+        for future in as_completed(futures):
+            reporter, year, rows, checks, time_keys = future.result()
+            key = partition_key(reporter, year)
+            done[key] = {"inputs": inputs[key], "rows": rows, "merged_at": time.time(), "checks": checks,
+                         "timeKeys": time_keys}
+            save_manifest(manifest)  # a crash only re-merges partitions not yet recorded
+            total += rows
+    stale = sorted(set(done) - set(inputs))
+    for key in stale:
+        del done[key]
+    for out_dir in (OUT_DIR, CUBE_DIR, flow_keys.KEYS_DIR):
+        drop_stale_partitions({split_key(key) for key in inputs}, out_dir)
+    manifest.update(flows_csv=flows_csv, flows=flows)
+    save_manifest(manifest)
+    shutil.rmtree(STAGING_DIR, ignore_errors=True)
+    print(f"✓ Wrote merged → {OUT_DIR}/ and HS cube → {CUBE_DIR}/ ({total} rows in {len(todo)} partitions, "
+          f"partitioned by {'/'.join(PARTITION_COLS)})")
+    if skipped:
+        shown = ", ".join(skipped[:10]) + (f", … (+{len(skipped) - 10})" if len(skipped) > 10 else "")
+        print(f"⇢ Skipped {len(skipped)} unchanged partitions: {shown}")
+    if stale:
+        print(f"✗ Dropped {len(stale)} partitions no longer in {FLOWS_CSV}: {', '.join(stale)}")
 
     # ------------------------------------------------------------
-    # 7) emit time dimension table for your Ontology
-    time_dim = (
-        merged[["timeID","year"]]
-        .drop_duplicates()
-        .sort_values("year")
-    )
-    time_dim.to_csv("data/processed/time_dimension.csv", index=False)
-    print(f"✓ Wrote time dimension → data/processed/time_dimension.csv ({len(time_dim)} rows)")
+    # 5) emit time dimension table for your Ontology
+    keys = sorted({k for key in inputs for k in done[key]["timeKeys"]})
+    time_dim = pd.DataFrame({"timeKey": keys, "timeID": flow_keys.time_ids(keys),
+                             "year": [k // 100 for k in keys], "month": [k % 100 for k in keys]})
+    time_dim.to_csv(TIME_DIM_CSV, index=False)
+    print(f"✓ Wrote time dimension → {TIME_DIM_CSV} ({len(time_dim)} rows)")
+
+    if csv:
+        export_csv([split_key(key) for key in inputs])
+        print(f"✓ Wrote merged → {OUT_CSV} ({sum(f['rows'] for f in flows.values())} rows)")
 
     # ------------------------------------------------------------
-    # 8) write out enriched flows, including both PKs
-    out_cols = [
-        "flowID","timeID",
-        # then everything else you need downstream:
-        "typeCode","freqCode","refPeriodId","year","refMonth","period",
-        "reporterCode","reporterISO3","reporterDesc",
-        "flowCode","flowDesc",
-        "partnerCode","partnerISO","partnerDesc",
-        "partner2Code","partner2ISO","partner2Desc",
-        "classificationCode","classificationSearchCode","isOriginalClassification",
-        "cmdCode","cmdDesc","aggrLevel","isLeaf",
-        "customsCode","customsDesc","mosCode","motCode","motDesc",
-        "qtyUnitCode","qtyUnitAbbr","qty","isQtyEstimated",
-        "altQtyUnitCode","altQtyUnitAbbr","altQty","isAltQtyEstimated",
-        "netWgt","isNetWgtEstimated","grossWgt","isGrossWgtEstimated",
-        "cifvalue","fobvalue","primaryValue","legacyEstimationFlag",
-        "isReported","isAggregate","mfnRate","tau_mean"
-    ]
-    merged.to_csv("data/processed/flows_with_mfn.csv", columns=out_cols, index=False)
-    print(f"✓ Wrote merged → data/processed/flows_with_mfn.csv ({len(merged)} rows)")
+    # 6) data-quality report, from the per-partition check stats
+    if inputs:
+        report = flow_checks.validate({split_key(key): done[key]["checks"] for key in inputs}, thresholds or {})
+        flow_checks.write_report(report, VALIDATION_JSON)
+        print(f"✓ Wrote validation report → {VALIDATION_JSON}")
+        for line in flow_checks.summary(report):
+            print(f"   {line}")
+        if not report["ok"]:
+            raise flow_checks.ValidationFailed(report)
 
 if __name__ == "__main__":
-    main()
+    parser = argparse.ArgumentParser(description=__doc__, formatter_class=argparse.RawDescriptionHelpFormatter)
+    parser.add_argument("--csv", action="store_true", help=f"also export the flat {OUT_CSV}")
+    parser.add_argument("--workers", type=int, default=WORKERS, help="partitions merged in parallel")
+    parser.add_argument("--chunk-rows", type=int, default=CHUNK_ROWS, help="flow rows read from the CSV at a time")
+    parser.add_argument("--full", action="store_true", help="ignore the manifest and recompute every partition")
+    parser.add_argument("--threshold", action="append", metavar="NAME=VALUE",
+                        help=f"override a data-quality threshold ({', '.join(flow_checks.THRESHOLDS)})")
+    args = parser.parse_args()
+    try:
+        thresholds = flow_checks.parse_thresholds(args.threshold)
+    except ValueError as e:
+        parser.error(str(e))
+    try:
+        main(csv=args.csv, workers=args.workers, chunk_rows=args.chunk_rows, full=args.full,
+             thresholds=thresholds)
+    except flow_checks.ValidationFailed as e:
+        raise SystemExit(f"✗ Merge outputs written, but {e} (see {VALIDATION_JSON})")
@@ -0,0 +1,146 @@
+"""
+Compressed raw-response cache shared by the Comtrade and WITS fetchers.
+Each response is stored once under data/raw/cache/<source>/, named by a hash of
+its request parameters and compressed with zstd (if `zstandard` is installed)
+or gzip. The cache is size-capped with least-recently-used eviction, and its
+entries can be replayed to rebuild processed outputs without spending quota.
+"""
+import gzip
+import hashlib
+import json
+import os
+import threading
+import time
+
+try:
+    import zstandard
+except ImportError:  # optional: fall back to gzip
+    zstandard = None
+
+CACHE_DIR = 'data/raw/cache'
+MAX_BYTES = int(os.environ.get('RAW_CACHE_MAX_BYTES', 5 * 1024 ** 3))
+
+
+def request_hash(source, params):
+    """Stable hash of a request: source name plus canonicalised parameters."""
+    canonical = json.dumps({'source': source, 'params': params}, sort_keys=True, default=str)
+    return hashlib.sha256(canonical.encode()).hexdigest()
+
+
+def _compress(data):
+    if zstandard is not None:
+        return zstandard.ZstdCompressor(level=10).compress(data), '.json.zst'
+    return gzip.compress(data, compresslevel=6), '.json.gz'
+
+
+def _decompress(path):
+    with open(path, 'rb') as f:
+        data = f.read()
+    if path.endswith('.zst'):
+        if zstandard is None:
+            raise RuntimeError(f"{path} is zstd-compressed but zstandard is not installed")
+        return zstandard.ZstdDecompressor().decompress(data)
+    return gzip.decompress(data)
+
+
+class RawCache:
+    def __init__(self, root=CACHE_DIR, max_bytes=MAX_BYTES):
+        self.root = root
+        self.max_bytes = max_bytes
+        self.lock = threading.Lock()
+        os.makedirs(root, exist_ok=True)
+        self.total_bytes = sum(os.path.getsize(p) for p in self._all_paths())
+
+    def _all_paths(self, source=None):
+        top = os.path.join(self.root, source) if source else self.root
+        for dirpath, _, files in os.walk(top):
+            for name in files:
+                if name.endswith(('.json.gz', '.json.zst')):
+                    yield os.path.join(dirpath, name)
+
+    def _path(self, source, digest, ext):
+        return os.path.join(self.root, source, digest[:2], digest + ext)
+
+    def _find(self, source, digest):
+        for ext in ('.json.zst', '.json.gz'):
+            path = self._path(source, digest, ext)
+            if os.path.exists(path):
+                return path
+        return None
+
+    def get(self, source, params):
+        """Return the cached payload for this request, or None."""
+        path = self._find(source, request_hash(source, params))
+        if path is None:
+            return None
+        try:
+            entry = json.loads(_decompress(path))
+        except (OSError, ValueError, RuntimeError) as e:
+            print(f"⚠️ Ignoring unreadable cache entry {path}: {e}")
+            return None
+        os.utime(path)  # mark as recently used for LRU eviction
+        return entry['payload']
+
+    def open(self, source, params):
+        """
+        Decompressing binary stream over the cached entry, or None; for
+        incremental parsing of large payloads (the JSON has source, params,
+        fetched_at and payload keys).
+        """
+        path = self._find(source, request_hash(source, params))
+        if path is None:
+            return None
+        os.utime(path)
+        if path.endswith('.zst'):
+            if zstandard is None:
+                raise RuntimeError(f"{path} is zstd-compressed but zstandard is not installed")
+            return zstandard.ZstdDecompressor().stream_reader(open(path, 'rb'), closefd=True)
+        return gzip.open(path, 'rb')
+
+    def put(self, source, params, payload):
+        """Store a JSON-serialisable payload for this request."""
+        entry = {'source': source, 'params': params, 'fetched_at': time.time(), 'payload': payload}
+        self._write(source, params, json.dumps(entry, default=str).encode())
+
+    def put_json_bytes(self, source, params, raw):
+        """Store a response body that is already JSON, verbatim, without parsing it."""
+        head = json.dumps({'source': source, 'params': params, 'fetched_at': time.time()}, default=str)
+        self._write(source, params, head[:-1].encode() + b', "payload": ' + raw + b'}')
+
+    def _write(self, source, params, entry_bytes):
+        digest = request_hash(source, params)
+        data, ext = _compress(entry_bytes)
+        path = self._path(source, digest, ext)
+        os.makedirs(os.path.dirname(path), exist_ok=True)
+        tmp = f"{path}.{threading.get_ident()}.tmp"
+        with open(tmp, 'wb') as f:
+            f.write(data)
+        with self.lock:
+            old = os.path.getsize(path) if os.path.exists(path) else 0
+            os.replace(tmp, path)
+            self.total_bytes += len(data) - old
+            if self.total_bytes > self.max_bytes:
+                self._evict()
+
+    def _evict(self):
+        """Drop least-recently-used entries until the cache is 90% of its cap."""
+        entries = sorted((os.path.getmtime(p), os.path.getsize(p), p) for p in self._all_paths())
+        target = self.max_bytes * 0.9
+        removed = 0
+        for _, size, path in entries:
+            if self.total_bytes <= target:
+                break
+            os.remove(path)
+            self.total_bytes -= size
+            removed += 1
+        print(f"⇢ Raw cache over {self.max_bytes} bytes; evicted {removed} least recently used entries")
+
+    def entries(self, source):
+        """Yield (params, payload) for every cached response of `source`."""
+        for path in sorted(self._all_paths(source)):
+            try:
+                entry = json.loads(_decompress(path))
+            except (OSError, ValueError, RuntimeError) as e:
+                print(f"⚠️ Ignoring unreadable cache entry {path}: {e}")
+                continue
+            yield entry['params'], entry['payload']
@@ -0,0 +1,240 @@
+"""
+Sidecar SQLite manifest of every Comtrade request the fetcher has attempted.
+Keyed by fetch_trade.create_key, it records status, row count and timestamp so
+resuming is an indexed lookup and requests that returned no data are not
+re-fetched on every restart. It also keeps the tree of batches that had to be
+split because they hit the record cap, from which planning hints are derived,
+and the Comtrade release each (reporter, period) slice was pulled at.
+"""
+import json
+import os
+import sqlite3
+import time
+
+# Statuses that mean "do not request again"
+DONE_STATUSES = ('ok', 'empty')
+
+
+class RequestManifest:
+    def __init__(self, path):
+        self.path = path
+        os.makedirs(os.path.dirname(path) or '.', exist_ok=True)
+        # Sharded workers share the manifest, so wait on each other's write locks
+        self.conn = sqlite3.connect(path, timeout=60)
+        self.conn.execute("PRAGMA journal_mode=WAL")
+        self.conn.execute(
+            """
+            CREATE TABLE IF NOT EXISTS requests (
+                key        TEXT PRIMARY KEY,
+                reporter   INTEGER,
+                partner    INTEGER,
+                hs         TEXT,
+                flow       TEXT,
+                period     TEXT,
+                status     TEXT NOT NULL,
+                rows       INTEGER NOT NULL DEFAULT 0,
+                attempts   INTEGER NOT NULL DEFAULT 1,
+                message    TEXT,
+                updated_at REAL NOT NULL
+            )
+            """
+        )
+        columns = {row[1] for row in self.conn.execute("PRAGMA table_info(requests)")}
+        if 'period' not in columns:
+            self.conn.execute("ALTER TABLE requests ADD COLUMN period TEXT")
+        if 'value' not in columns:
+            self.conn.execute("ALTER TABLE requests ADD COLUMN value REAL")
+        self.conn.execute("CREATE INDEX IF NOT EXISTS requests_status ON requests(status)")
+        self.conn.execute("CREATE INDEX IF NOT EXISTS requests_slice ON requests(reporter, period)")
+        self.conn.execute(
+            """
+            CREATE TABLE IF NOT EXISTS releases (
+                reporter      INTEGER NOT NULL,
+                period        TEXT NOT NULL,
+                last_released TEXT,
+                checksum      TEXT,
+                pulled_at     REAL NOT NULL,
+                PRIMARY KEY (reporter, period)
+            )
+            """
+        )
+        # Re-released slices being re-fetched; they move to releases once swapped in
+        self.conn.execute(
+            """
+            CREATE TABLE IF NOT EXISTS refreshing (
+                reporter      INTEGER NOT NULL,
+                period        TEXT NOT NULL,
+                last_released TEXT,
+                checksum      TEXT,
+                started_at    REAL NOT NULL,
+                PRIMARY KEY (reporter, period)
+            )
+            """
+        )
+        self.conn.execute(
+            """
+            CREATE TABLE IF NOT EXISTS splits (
+                parent     TEXT PRIMARY KEY,
+                reporter   INTEGER NOT NULL,
+                reason     TEXT NOT NULL,
+                chapter    TEXT,
+                level      INTEGER,
+                density    REAL,
+                children   TEXT NOT NULL,
+                created_at REAL NOT NULL
+            )
+            """
+        )
+        self.conn.commit()
+
+    def __len__(self):
+        return self.conn.execute("SELECT COUNT(*) FROM requests").fetchone()[0]
+
+    def record_many(self, records):
+        """
+        Upsert (key, reporter, partner, hs, flow, period, status, rows, value, message)
+        tuples and commit. Call only after the matching rows are safely on disk.
+        `value` is the summed primaryValue of the rows, used to prioritise later fetches.
+        """
+        now = time.time()
+        self.conn.executemany(
+            """
+            INSERT INTO requests (key, reporter, partner, hs, flow, period, status, rows, value, message, updated_at)
+            VALUES (?, ?, ?, ?, ?, ?, ?, ?, ?, ?, ?)
+            ON CONFLICT(key) DO UPDATE SET
+                status = excluded.status,
+                rows = excluded.rows,
+                value = excluded.value,
+                message = excluded.message,
+                attempts = requests.attempts + 1,
+                updated_at = excluded.updated_at
+            """,
+            [(*r, now) for r in records],
+        )
+        self.conn.commit()
+
+    def completed_keys(self, reporter=None, period=None):
+        """Set of keys that finished with data or a confirmed empty response, optionally for one slice."""
+        placeholders = ",".join("?" * len(DONE_STATUSES))
+        sql = f"SELECT key FROM requests WHERE status IN ({placeholders})"
+        args = list(DONE_STATUSES)
+        if reporter is not None:
+            sql += " AND reporter = ? AND period = ?"
+            args += [int(reporter), str(period)]
+        return {k for (k,) in self.conn.execute(sql, args)}
+
+    def keys_with_rows(self):
+        """Set of keys that finished with data, i.e. whose rows are in the output CSV."""
+        return {k for (k,) in self.conn.execute("SELECT key FROM requests WHERE status = 'ok' AND rows > 0")}
+
+    def status_counts(self):
+        return dict(self.conn.execute("SELECT status, COUNT(*) FROM requests GROUP BY status").fetchall())
+
+    def value_by(self, column):
+        """{reporter|partner|hs: total fetched trade value} for prioritising the remaining grid."""
+        assert column in ('reporter', 'partner', 'hs')
+        return dict(self.conn.execute(
+            f"SELECT {column}, SUM(value) FROM requests WHERE value > 0 GROUP BY {column}"
+        ).fetchall())
+
+    def rows_per_key(self):
+        """Average rows returned per finished key (empty responses included), or None."""
+        placeholders = ",".join("?" * len(DONE_STATUSES))
+        return self.conn.execute(
+            f"SELECT AVG(rows) FROM requests WHERE status IN ({placeholders})", DONE_STATUSES
+        ).fetchone()[0]
+
+    def migrate_periods(self, period):
+        """Tag keys written before periods were tracked with the period they were fetched for."""
+        cur = self.conn.execute(
+            "UPDATE requests SET period = ?, key = key || '_' || ? WHERE period IS NULL", (period, period)
+        )
+        self.conn.commit()
+        return cur.rowcount
+
+    def releases(self):
+        """{(reporter, period): (last_released, checksum)} as of the last successful pull."""
+        return {
+            (reporter, period): (last_released, checksum)
+            for reporter, period, last_released, checksum in self.conn.execute(
+                "SELECT reporter, period, last_released, checksum FROM releases"
+            )
+        }
+
+    def set_release(self, reporter, period, last_released, checksum):
+        self.conn.execute(
+            "INSERT OR REPLACE INTO releases (reporter, period, last_released, checksum, pulled_at) VALUES (?, ?, ?, ?, ?)",
+            (int(reporter), str(period), last_released, checksum, time.time()),
+        )
+        self.conn.commit()
+
+    def refreshing(self):
+        """{(reporter, period): (last_released, checksum)} of re-released slices still being re-fetched."""
+        return {
+            (reporter, period): (last_released, checksum)
+            for reporter, period, last_released, checksum in self.conn.execute(
+                "SELECT reporter, period, last_released, checksum FROM refreshing"
+            )
+        }
+
+    def start_refresh(self, reporter, period, last_released, checksum):
+        """Forget every request of a re-released slice so it is fetched again at the new release."""
+        args = (int(reporter), str(period))
+        self.conn.execute("DELETE FROM requests WHERE reporter = ? AND period = ?", args)
+        self.conn.execute(
+            "INSERT OR REPLACE INTO refreshing (reporter, period, last_released, checksum, started_at) VALUES (?, ?, ?, ?, ?)",
+            (*args, last_released, checksum, time.time()),
+        )
+        self.conn.commit()
+
+    def finish_refresh(self, reporter, period):
+        """Record the release a refreshed slice was re-fetched at as the one now held."""
+        args = (int(reporter), str(period))
+        self.conn.execute(
+            """
+            INSERT OR REPLACE INTO releases (reporter, period, last_released, checksum, pulled_at)
+            SELECT reporter, period, last_released, checksum, ? FROM refreshing WHERE reporter = ? AND period = ?
+            """,
+            (time.time(), *args),
+        )
+        self.conn.execute("DELETE FROM refreshing WHERE reporter = ? AND period = ?", args)
+        self.conn.commit()
+
+    def record_split(self, batch, children, reason, rows):
+        """
+        Record that `batch` returned `rows` (at the cap) and was split into `children`.
+        HS drill-downs store the digits needed for the chapter; other splits store
+        a rows-per-key density so the planner sizes the reporter's batches smaller.
+        """
+        chapter = level = density = None
+        if reason == 'hs_detail':
+            chapter = batch.hs_codes[0][:2]
+            level = len(children[0].hs_codes[0])
+        else:
+            # The response was cut off, so the true density is at least this
+            density = 2.0 * rows / batch.size()
+        self.conn.execute(
+            """
+            INSERT OR REPLACE INTO splits (parent, reporter, reason, chapter, level, density, children, created_at)
+            VALUES (?, ?, ?, ?, ?, ?, ?, ?)
+            """,
+            (batch.signature(), int(batch.reporter), reason, chapter, level, density,
+             json.dumps([c.signature() for c in children]), time.time()),
+        )
+        self.conn.commit()
+
+    def split_hints(self):
+        """Return ({reporter: rows per key}, {(reporter, chapter): HS digits}) learned from splits."""
+        densities = dict(self.conn.execute(
+            "SELECT reporter, MAX(density) FROM splits WHERE density IS NOT NULL GROUP BY reporter"
+        ).fetchall())
+        levels = {
+            (reporter, chapter): level
+            for reporter, chapter, level in self.conn.execute(
+                "SELECT reporter, chapter, MAX(level) FROM splits WHERE level IS NOT NULL GROUP BY reporter, chapter"
+            )
+        }
+        return densities, levels
+
+    def close(self):
+        self.conn.close()
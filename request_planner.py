@@ -0,0 +1,163 @@
+"""
+Packs the reporter × partner × HS × flow request grid into as few Comtrade
+calls as possible. The API accepts comma-separated partner, cmdCode and flow
+lists, so each call covers a partner/HS/flow block sized to stay under the
+maxRecords cap; results are split back into per-key frames afterwards.
+
+Responses that hit the cap are split recursively (flow, then partner halves,
+then HS halves, then HS4/HS6 sub-codes) and the split is recorded as a hint so
+later runs plan at the right granularity straight away.
+"""
+from collections import namedtuple, defaultdict
+from itertools import product
+import numpy as np
+
+# Expected rows per (reporter, partner, cmdCode, flow) in classic breakdown mode
+RECORDS_PER_KEY = 1.0
+# Fraction of maxRecords a batch may plan to use, leaving room for surprises
+HEADROOM = 0.8
+# Digits of the HS code used in request keys (chapters)
+KEY_DIGITS = 2
+
+
+class Batch(namedtuple('Batch', ['reporter', 'partners', 'hs_codes', 'flows', 'period'])):
+    """
+    One Comtrade call: a reporter and period plus partner, HS and flow code tuples.
+    HS codes may be chapters or finer HS4/HS6 codes; keys are always per chapter.
+    """
+
+    def keys(self):
+        chapters = sorted({hs[:KEY_DIGITS] for hs in self.hs_codes})
+        return [(self.reporter, p, hs, f, self.period)
+                for p, hs, f in product(self.partners, chapters, self.flows)]
+
+    def size(self):
+        return len(self.partners) * len(self.hs_codes) * len(self.flows)
+
+    def signature(self):
+        return (f"{self.reporter}|{','.join(map(str, self.partners))}|"
+                f"{','.join(self.hs_codes)}|{','.join(self.flows)}|{self.period}")
+
+    def describe(self):
+        return (f"{self.reporter}->{len(self.partners)} partners "
+                f"x {len(self.hs_codes)} HS x {'/'.join(self.flows)} {self.period}")
+
+
+def _chunks(seq, size):
+    return [tuple(seq[i:i + size]) for i in range(0, len(seq), size)]
+
+
+def _halves(seq):
+    mid = len(seq) // 2
+    return [tuple(seq[:mid]), tuple(seq[mid:])]
+
+
+def _capacity(max_records, records_per_key):
+    return max(1, int(max_records * HEADROOM / records_per_key))
+
+
+def expand_hs(code, level, children_of):
+    """Descendants of `code` down to `level` digits; codes without children are kept as-is."""
+    codes = [code]
+    while True:
+        expanded, grew = [], False
+        for c in codes:
+            kids = children_of(c) if len(c) < level else []
+            expanded.extend(kids or [c])
+            grew = grew or bool(kids)
+        if not grew:
+            return codes
+        codes = expanded
+
+
+def plan_batches(pending, max_records, records_per_key=RECORDS_PER_KEY,
+                 densities=None, levels=None, children_of=None):
+    """
+    Group pending (reporter, partner, hs, flow, period) keys into Batches.
+
+    Within a reporter and period the batch is a rectangular partner × HS × flow block, so
+    it may also cover keys that are already done; callers ignore those keys.
+    Flows and HS codes are kept whole where possible and the partner list is
+    chunked first, since partners are the longest dimension. Codes keep the
+    order in which they first appear in `pending`, so a value-ordered input
+    puts the most important partners and chapters in the first batches.
+
+    `densities` maps reporter → observed rows per key and `levels` maps
+    (reporter, chapter) → HS digits needed, both learned from earlier splits.
+    """
+    densities = densities or {}
+    levels = levels or {}
+    # dicts rather than sets: ordered and de-duplicated
+    by_slice = defaultdict(lambda: ({}, {}, {}))
+    for reporter, partner, hs, flow, period in pending:
+        partners, hs_codes, flows = by_slice[(reporter, period)]
+        partners[partner] = hs_codes[hs] = flows[flow] = True
+
+    batches = []
+    for (reporter, period), codes in by_slice.items():
+        partners, hs_codes, flows = (list(x) for x in codes)
+        capacity = _capacity(max_records, max(records_per_key, densities.get(reporter, 0)))
+
+        # Chapters known to overflow are planned directly at their finer level
+        groups = defaultdict(list)
+        for hs in hs_codes:
+            level = levels.get((reporter, hs), len(hs))
+            if level > len(hs) and children_of is not None:
+                for code in expand_hs(hs, level, children_of):
+                    groups[len(code)].append(code)
+            else:
+                groups[len(hs)].append(hs)
+
+        for level in sorted(groups):
+            codes = groups[level]
+            hs_per_batch = min(len(codes), max(1, capacity // len(flows)))
+            partners_per_batch = max(1, capacity // (hs_per_batch * len(flows)))
+            for hs_chunk in _chunks(codes, hs_per_batch):
+                for partner_chunk in _chunks(partners, partners_per_batch):
+                    batches.append(Batch(reporter, partner_chunk, hs_chunk, tuple(flows), period))
+    return batches
+
+
+def is_truncated(df, max_records):
+    """A response with maxRecords rows may have been cut off by the API."""
+    return df is not None and len(df) >= max_records
+
+
+def split_batch(batch, children_of=None):
+    """
+    Split a truncated batch into smaller ones.
+    Returns (children, reason); children is empty when the batch is already a
+    single HS6 line and cannot be split further.
+    """
+    if len(batch.flows) > 1:
+        return [batch._replace(flows=(f,)) for f in batch.flows], 'flow'
+    if len(batch.partners) > 1:
+        return [batch._replace(partners=half) for half in _halves(batch.partners)], 'partner'
+    if len(batch.hs_codes) > 1:
+        return [batch._replace(hs_codes=half) for half in _halves(batch.hs_codes)], 'hs'
+    kids = children_of(batch.hs_codes[0]) if children_of is not None else []
+    if not kids:
+        return [], None
+    if len(kids) == 1:
+        return [batch._replace(hs_codes=tuple(kids))], 'hs_detail'
+    return [batch._replace(hs_codes=half) for half in _halves(kids)], 'hs_detail'
+
+
+def split_results(batch, df):
+    """
+    Split a batch response into {key: row positions in df} for every key the batch covers.
+    Keys with no rows map to an empty array so they can be recorded as such.
+    Positions rather than frames: slicing hundreds of tiny frames per call is
+    slower than the call itself, so callers take the rows they keep in one go.
+    """
+    out = dict.fromkeys(batch.keys(), np.empty(0, dtype=np.intp))
+    if df is None or len(df) == 0:
+        return out
+
+    hs = df['cmdCode'].astype(str).str.zfill(KEY_DIGITS).str[:KEY_DIGITS]
+    groups = df.groupby([df['partnerCode'].astype(int), hs, df['flowCode']], sort=False)
+    for (partner, hs_code, flow), positions in groups.indices.items():
+        key = (batch.reporter, partner, hs_code, flow, batch.period)
+        if key in out:
+            out[key] = positions
+    return out
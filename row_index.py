@@ -0,0 +1,178 @@
+"""
+Persistent row-hash index for trade_flows.csv.
+Every stored row is reduced to two 64-bit hashes: one of its record key
+(RECORD_KEY_COLUMNS in fetch_trade.py) and one of its remaining values.
+`admit` checks a batch against the index before it is written, dropping rows
+that are already stored and setting aside conflicting revisions (same key,
+different values) in trade_flows.conflicts.csv; `commit` then appends the
+batch's hashes to a binary log next to the CSV (trade_flows.rowhash). A
+checkpoint therefore costs O(batch · log rows) and never scans the CSV.
+
+The log is only rebuilt from the CSV when its length disagrees with the
+store's row count, i.e. after a crash between writing a segment and its
+hashes, or after rows were dropped or rewritten outside the index.
+"""
+import os
+import threading
+import numpy as np
+import pandas as pd
+
+RECORD = np.dtype([('key', '<u8'), ('value', '<u8')])
+
+
+def _text(df, columns):
+    """Columns as the CSV stores them: strings, with nulls as empty fields."""
+    return pd.DataFrame({c: df[c].astype('string').fillna('') if c in df.columns else '' for c in columns},
+                        index=df.index)
+
+
+def _merge(a, b):
+    """Two key-sorted record arrays as one."""
+    out = np.concatenate([a, b])
+    return out[np.argsort(out['key'], kind='stable')]
+
+
+class RowIndex:
+    def __init__(self, csv_path, key_columns):
+        base = os.path.splitext(csv_path)[0]
+        self.path = base + '.rowhash'
+        self.conflicts_path = base + '.conflicts.csv'
+        self.key_columns = list(key_columns)
+        self.lock = threading.Lock()
+        self.pending = np.empty(0, RECORD)
+        self.duplicates = self.conflicts = 0
+        self._load()
+
+    def _load(self):
+        records = np.empty(0, RECORD)
+        if os.path.exists(self.path):
+            size = os.path.getsize(self.path)
+            if size % RECORD.itemsize:
+                # a torn last record from a crash mid-append
+                with open(self.path, 'r+b') as f:
+                    f.truncate(size - size % RECORD.itemsize)
+            records = np.fromfile(self.path, dtype=RECORD)
+        # Lookups search a large sorted array plus a small one holding recent
+        # commits, which is folded in once it grows (amortised O(n log n))
+        self.main = records[np.argsort(records['key'], kind='stable')]
+        self.recent = np.empty(0, RECORD)
+
+    def __len__(self):
+        return len(self.main) + len(self.recent)
+
+    # ------------------------------------------------------------
+    def hashes(self, df):
+        """(key hashes, value hashes) per row of a stored-layout frame."""
+        values = sorted(c for c in df.columns if c not in self.key_columns)
+        keys = pd.util.hash_pandas_object(_text(df, self.key_columns), index=False).to_numpy()
+        vals = pd.util.hash_pandas_object(_text(df, values), index=False).to_numpy()
+        return keys, vals
+
+    def _lookup(self, keys):
+        """(found mask, stored value hashes) for key hashes."""
+        found = np.zeros(len(keys), dtype=bool)
+        stored = np.zeros(len(keys), dtype=np.uint64)
+        for arr in (self.main, self.recent):
+            if not len(arr):
+                continue
+            pos = np.minimum(np.searchsorted(arr['key'], keys), len(arr) - 1)
+            hit = arr['key'][pos] == keys
+            found |= hit
+            stored[hit] = arr['value'][pos[hit]]
+        return found, stored
+
+    def check(self, df):
+        """
+        Classify the rows of `df` against the index and against earlier rows
+        of `df`. Returns (keep mask, conflict mask, hash records of kept rows).
+        """
+        keys, vals = self.hashes(df)
+        with self.lock:
+            found, stored = self._lookup(keys)
+        # repeats within the batch are compared with the key's first row
+        first = pd.Series(vals).groupby(keys).transform('first').to_numpy()
+        repeat = pd.Series(keys).duplicated().to_numpy()
+        keep = ~found & ~repeat
+        conflict = (found & (stored != vals)) | (repeat & ~found & (first != vals))
+        records = np.empty(int(keep.sum()), RECORD)
+        records['key'], records['value'] = keys[keep], vals[keep]
+        return keep, conflict, records
+
+    def admit(self, df):
+        """
+        Rows of `df` not yet stored, to be written and then `commit`ted.
+        Exact duplicates are dropped; conflicting revisions are kept out too
+        and appended to the conflicts CSV for review.
+        """
+        if df is None or len(df) == 0:
+            return df
+        keep, conflict, records = self.check(df)
+        if conflict.any():
+            header = not os.path.exists(self.conflicts_path)
+            df[conflict].to_csv(self.conflicts_path, mode='a', header=header, index=False)
+        with self.lock:
+            self.pending = np.concatenate([self.pending, records])
+            self.duplicates += int((~keep & ~conflict).sum())
+            self.conflicts += int(conflict.sum())
+        return df[keep]
+
+    def commit(self):
+        """Persist the hashes of rows admitted since the last commit."""
+        with self.lock:
+            if not len(self.pending):
+                return
+            with open(self.path, 'ab') as f:
+                self.pending.tofile(f)
+            self.recent = _merge(self.recent, self.pending)
+            self.pending = np.empty(0, RECORD)
+            if len(self.recent) > max(len(self.main) // 8, 1 << 16):
+                self.main, self.recent = _merge(self.main, self.recent), np.empty(0, RECORD)
+
+    def discard(self):
+        """Forget every hash, e.g. before the CSV is rewritten wholesale."""
+        with self.lock:
+            if os.path.exists(self.path):
+                os.remove(self.path)
+            self.main = self.recent = self.pending = np.empty(0, RECORD)
+
+    def rename(self, csv_path):
+        """Move the log to sit next to `csv_path` (after the CSV itself was moved there)."""
+        base = os.path.splitext(csv_path)[0]
+        with self.lock:
+            for old, new in ((self.path, base + '.rowhash'), (self.conflicts_path, base + '.conflicts.csv')):
+                if os.path.exists(old):
+                    os.replace(old, new)
+            self.path, self.conflicts_path = base + '.rowhash', base + '.conflicts.csv'
+
+    # ------------------------------------------------------------
+    def sync(self, store, chunksize=200000):
+        """
+        Make sure the index covers exactly the rows `store` holds; if not,
+        rebuild it from the store's CSV and segments. Duplicate rows found
+        while rebuilding (written before there was an index) are removed from
+        the CSV. Returns the number of rows removed, or None if the index was
+        already in step.
+        """
+        total = store.total_rows()
+        if len(self) == total:
+            return None
+        print(f"⇢ Row index holds {len(self)} of {total} rows in {store.out_csv} - rebuilding it")
+        self.discard()
+        seen = self.duplicates + self.conflicts
+        for chunk in store.chunks(chunksize):
+            self.admit(chunk)
+            self.commit()
+        repeated = self.duplicates + self.conflicts - seen
+        if repeated:
+            # Stored rows repeat a key: drop all but each key's first row
+            self.discard()
+            store.drop_rows(lambda chunk: ~self._keep_and_commit(chunk), chunksize)
+        print(f"✓ Indexed {len(self)} rows" + (f", removed {repeated} duplicate rows" if repeated else ""))
+        return repeated
+
+    def _keep_and_commit(self, chunk):
+        keep, _, records = self.check(chunk)
+        with self.lock:
+            self.pending = np.concatenate([self.pending, records])
+        self.commit()
+        return pd.Series(keep, index=chunk.index)
@@ -0,0 +1,88 @@
+"""
+Vectorised decoder for WITS SDMX-JSON tariff messages.
+Series keys ("0:3:0:1207:0") are parsed into one integer code matrix in a
+single pass, and each dimension is mapped through its value list with NumPy
+take-indexing into dictionary-encoded (categorical) columns, instead of one
+Python dict per series. `decode_stream` reads large messages incrementally
+with ijson (if installed) so the full JSON tree is never materialised.
+"""
+import json
+import numpy as np
+import pandas as pd
+
+try:
+    import ijson
+except ImportError:  # optional: streaming falls back to json.load
+    ijson = None
+
+
+def _key_codes(keys, n_dims):
+    """['0:1:0:5:0', ...] → int32 array of shape (len(keys), n_dims)."""
+    if not keys:
+        return np.empty((0, n_dims), dtype=np.int32)
+    codes = np.fromstring(':'.join(keys), dtype=np.int64, sep=':')
+    if codes.size != len(keys) * n_dims:
+        raise ValueError(f"series keys do not all have {n_dims} dimensions")
+    return codes.astype(np.int32).reshape(len(keys), n_dims)
+
+
+def _first_value(observations):
+    """Value of the first (and only) time-period observation, or None."""
+    for obs in observations.values():
+        return obs[0] if obs else None
+    return None
+
+
+def _frame(dims, keys, values):
+    """Build the tidy frame from dimension metadata, series keys and their values."""
+    codes = _key_codes(keys, len(dims))
+    columns = {}
+    for i, dim in enumerate(dims):
+        ids = np.array([v['id'] for v in dim['values']], dtype=object)
+        # take-indexing via a categorical: codes index straight into the value list
+        columns[dim['id']] = pd.Categorical.from_codes(codes[:, i], categories=pd.Index(ids).astype(str))
+    frame = pd.DataFrame(columns)
+    # if product dimension absent (i.e. aggregated 'All') fill manually
+    if not any('PRODUCT' in d.upper() for d in frame.columns):
+        frame['PRODUCT'] = 'ALL'
+    frame['VALUE'] = np.asarray(values, dtype=float)
+    return frame
+
+
+def decode_series(msg):
+    """
+    Flatten a parsed SDMX-JSON message into a tidy DataFrame: one column per
+    series dimension (categorical), PRODUCT if there is no product dimension,
+    and VALUE. Same rows and columns as archive/wits_fetch.decode_series.
+    """
+    dims = msg['structure']['dimensions']['series']
+    series = msg['dataSets'][0]['series']
+    values = [_first_value(item.get('observations', {})) for item in series.values()]
+    return _frame(dims, list(series), values)
+
+
+def decode_stream(open_stream, prefix=''):
+    """
+    Decode a message from a binary stream without building the JSON tree.
+    `open_stream()` must return a fresh stream each call: series are read in
+    one pass and the (small) structure in a second, since it may come after
+    the data. `prefix` is the path of the message inside the document, e.g.
+    'payload' for a raw cache entry.
+    """
+    base = f"{prefix}." if prefix else ''
+    if ijson is None:
+        with open_stream() as f:
+            doc = json.load(f)
+        for part in filter(None, prefix.split('.')):
+            doc = doc[part]
+        return decode_series(doc)
+
+    keys, values = [], []
+    with open_stream() as f:
+        # WITS messages carry a single dataset
+        for key, item in ijson.kvitems(f, f"{base}dataSets.item.series", use_float=True):
+            keys.append(key)
+            values.append(_first_value(item.get('observations', {})))
+    with open_stream() as f:
+        dims = next(ijson.items(f, f"{base}structure.dimensions.series", use_float=True))
+    return _frame(dims, keys, values)
@@ -0,0 +1,288 @@
+"""
+Local stand-in for the UN Comtrade and WITS APIs.
+Serves deterministic synthetic responses (or replays recorded ones from the raw
+cache) so fetch_trade.py and the WITS fetcher can be exercised without live keys.
+Faults can be injected: 403 quota errors with "replenished in HH:MM:SS"
+messages, empty 500 responses (which the client sees as None) and latency.
+Quota windows are counted per subscription key, as on the live API, so
+sharded runs with several keys can be benchmarked.
+
+    python standin_server.py --port 8765 --quota 20 --window 5 --none-rate 0.02
+    COMTRADE_BASE_URL=http://127.0.0.1:8765 COMTRADE_KEY=x python fetch_trade.py
+"""
+import argparse
+import hashlib
+import json
+import random
+import threading
+import time
+from http.server import ThreadingHTTPServer, BaseHTTPRequestHandler
+from urllib.parse import urlparse, parse_qs
+from country_codes import build_table
+
+# Reporters the stand-in pretends to have data for (Comtrade numeric codes)
+DEFAULT_REPORTERS = [842, 156, 276, 392, 124]
+RELEASED = '2024-01-01T00:00:00'  # lastReleased of every slice until StandinState.releases says otherwise
+
+
+def _unit(*parts):
+    """Deterministic float in [0, 1) for a tuple of request parts."""
+    digest = hashlib.md5('|'.join(map(str, parts)).encode()).hexdigest()
+    return int(digest[:8], 16) / 0x100000000
+
+
+class StandinState:
+    """Fault settings plus call counters shared by all handler threads."""
+
+    def __init__(self, reporters=None, quota=0, window=60, none_rate=0.0, latency=(0.0, 0.0),
+                 empty_rate=0.3, rows_per_key=1, seed=0, replay=None):
+        self.reporters = reporters or DEFAULT_REPORTERS
+        self.quota = quota  # calls allowed per window and key; 0 = unlimited
+        self.window = window
+        self.none_rate = none_rate
+        self.latency = latency
+        self.empty_rate = empty_rate
+        self.rows_per_key = rows_per_key
+        self.random = random.Random(seed)
+        self.replay = replay  # RawCache to replay recorded Comtrade responses from
+        self.releases = {}  # reporter → lastReleased, for reporters re-released since RELEASED
+        self.lock = threading.Lock()
+        self.windows = {}  # subscription key → [window start, calls in window]
+        self.stats = {'calls': 0, 'ok': 0, 'quota': 0, 'none': 0, 'rows': 0, 'first': None, 'last': None}
+
+    def admit(self, key=None):
+        """Decide the fate of one data call for `key`: 'ok', 'quota' (with seconds left) or 'none'."""
+        with self.lock:
+            now = time.monotonic()
+            self.stats['calls'] += 1
+            self.stats['first'] = self.stats['first'] or time.time()
+            self.stats['last'] = time.time()
+            window = self.windows.setdefault(key, [now, 0])
+            if now - window[0] >= self.window:
+                window[:] = [now, 0]
+            if self.quota and window[1] >= self.quota:
+                self.stats['quota'] += 1
+                return 'quota', self.window - (now - window[0])
+            window[1] += 1
+            if self.random.random() < self.none_rate:
+                self.stats['none'] += 1
+                return 'none', 0
+            self.stats['ok'] += 1
+            return 'ok', 0
+
+    def released(self, reporter):
+        return self.releases.get(int(reporter), RELEASED)
+
+    def count_rows(self, n):
+        with self.lock:
+            self.stats['rows'] += n
+
+
+_iso3 = None
+
+
+def iso3(code):
+    """ISO3 code Comtrade reports for a reporter/partner code ('W00' for the world)."""
+    global _iso3
+    if _iso3 is None:
+        # built in memory: the stand-in must not write the shared code table cache
+        table = build_table()
+        comtrade = table[table['scheme'] == 'comtrade']
+        _iso3 = dict(zip(comtrade['code'], comtrade['iso3']), **{'0': 'W00'})
+    return _iso3.get(str(int(code)), f'X{int(code)}')
+
+
+def comtrade_rows(state, reporter, partners, cmd_codes, flows, period, include_desc=True):
+    """Synthetic Comtrade records: a deterministic subset of keys has data."""
+    rows = []
+    for partner in partners:
+        for cmd in cmd_codes:
+            for flow in flows:
+                u = _unit(reporter, partner, cmd, flow, period)
+                if u < state.empty_rate:
+                    continue
+                released = state.released(reporter)
+                if released != RELEASED:
+                    # a re-release revises the values of the same keys
+                    u = _unit(reporter, partner, cmd, flow, period, released)
+                for mot in range(state.rows_per_key):
+                    row = {
+                        'typeCode': 'C', 'freqCode': 'A' if len(period) == 4 else 'M',
+                        'refPeriodId': int(period + ('0101' if len(period) == 4 else '01')),
+                        'refYear': int(period[:4]), 'refMonth': int(period[4:] or 52),
+                        'period': period, 'reporterCode': int(reporter),
+                        'flowCode': flow, 'partnerCode': int(partner), 'partner2Code': 0,
+                        'classificationCode': 'H6', 'cmdCode': cmd, 'customsCode': 'C00',
+                        'aggrLevel': 0 if cmd == 'TOTAL' else len(cmd),
+                        'mosCode': '0', 'motCode': mot, 'qtyUnitCode': -1, 'qty': 0.0,
+                        'netWgt': 0.0, 'cifvalue': None, 'fobvalue': None,
+                        'primaryValue': round(1e6 + u * 1e10, 2),
+                        'isReported': False, 'isAggregate': True,
+                    }
+                    if include_desc:
+                        row.update({'reporterISO': iso3(reporter), 'reporterDesc': f'Reporter {reporter}',
+                                    'partnerISO': iso3(partner), 'partnerDesc': f'Partner {partner}',
+                                    'flowDesc': 'Import' if flow == 'M' else 'Export',
+                                    'cmdDesc': f'HS {cmd}', 'motDesc': 'TOTAL MOT'})
+                    rows.append(row)
+    return rows
+
+
+def wits_message(reporter, partner, year, n_products=200):
+    """Synthetic SDMX-JSON tariff schedule shaped like the WITS TRN datasource."""
+    products = [f"{(i * 7919) % 990000 + 10000:06d}" for i in range(n_products)]
+    dims = [
+        {'id': 'FREQ', 'values': [{'id': 'A'}]},
+        {'id': 'REPORTER', 'values': [{'id': str(reporter)}]},
+        {'id': 'PARTNER', 'values': [{'id': str(partner)}]},
+        {'id': 'PRODUCTCODE', 'values': [{'id': p} for p in products]},
+        {'id': 'DATATYPE', 'values': [{'id': 'Reported'}]},
+    ]
+    series = {
+        f"0:0:0:{i}:0": {'observations': {'0': [round(_unit(reporter, year, p) * 25, 2)]}}
+        for i, p in enumerate(products)
+    }
+    return {
+        'header': {'id': 'standin', 'prepared': time.strftime('%Y-%m-%dT%H:%M:%S')},
+        'dataSets': [{'series': series}],
+        'structure': {'dimensions': {'series': dims, 'observation': [{'id': 'TIME_PERIOD', 'values': [{'id': str(year)}]}]}},
+    }
+
+
+def make_handler(state):
+    class Handler(BaseHTTPRequestHandler):
+        def log_message(self, *args):
+            pass
+
+        def _send(self, status, body=None, headers=None):
+            data = b'' if body is None else json.dumps(body).encode()
+            self.send_response(status)
+            for name, value in (headers or {}).items():
+                self.send_header(name, value)
+            self.send_header('Content-Type', 'application/json')
+            self.send_header('Content-Length', str(len(data)))
+            self.end_headers()
+            self.wfile.write(data)
+
+        def _faults(self, wits=False):
+            """
+            Apply latency and quota/None injection; returns True if a fault was sent.
+            Comtrade signals quota with a 403 message, WITS with 429 and Retry-After.
+            """
+            lo, hi = state.latency
+            if hi > 0:
+                time.sleep(state.random.uniform(lo, hi))
+            key = self.headers.get('Ocp-Apim-Subscription-Key') or parse_qs(urlparse(self.path).query).get(
+                'subscription-key', [None])[0]
+            outcome, wait = state.admit(key)
+            if outcome == 'quota' and wits:
+                self._send(429, {'message': 'Too many requests'}, {'Retry-After': str(int(wait) + 1)})
+                return True
+            if outcome == 'quota':
+                h, rem = divmod(int(wait) + 1, 3600)
+                m, s = divmod(rem, 60)
+                self._send(403, {'statusCode': 403,
+                                 'message': f"Out of call volume quota. Quota will be replenished in {h:02d}:{m:02d}:{s:02d}."})
+                return True
+            if outcome == 'none':
+                self._send(500)
+                return True
+            return False
+
+        def do_GET(self):
+            url = urlparse(self.path)
+            q = {k: v[0] for k, v in parse_qs(url.query).items()}
+            parts = url.path.strip('/').split('/')
+
+            if url.path == '/_stats':
+                with state.lock:
+                    return self._send(200, dict(state.stats))
+            if url.path.endswith('getReferences/reporters'):
+                return self._send(200, {'data': [{'id': r, 'text': f'Reporter {r}'} for r in state.reporters]})
+            if url.path.endswith('reference/HS.json'):
+                return self._send(200, {'results': []})
+            if parts[:3] == ['public', 'v1', 'preview'] or parts[:3] == ['data', 'v1', 'get']:
+                if self._faults():
+                    return
+                return self._comtrade(parts, q)
+            if parts[:3] == ['public', 'v1', 'getDA'] or parts[:3] == ['data', 'v1', 'getDA']:
+                periods = q.get('period', '').split(',')
+                return self._send(200, {'data': [
+                    {'reporterCode': r, 'period': p, 'classificationSearchCode': 'HS',
+                     'lastReleased': state.released(r),
+                     'datasetChecksum': int(_unit(r, p, state.released(r)) * 1e9)}
+                    for r in state.reporters for p in periods]})
+            if 'datasource' in parts and 'reporter' in parts:
+                if self._faults(wits=True):
+                    return
+                at = {parts[i]: parts[i + 1] for i in range(len(parts) - 1)}
+                return self._send(200, wits_message(at['reporter'], at.get('partner', '000'), at.get('year', '2023')))
+            self._send(404, {'statusCode': 404, 'message': f'unknown path {url.path}'})
+
+        def _comtrade(self, parts, q):
+            reporter = int(q['reporterCode'])
+            if reporter not in state.reporters:
+                return self._send(200, {'count': 0, 'data': [], 'error': ''})
+            partners = q.get('partnerCode', '0').split(',')
+            cmd_codes = q.get('cmdCode', 'TOTAL').split(',')
+            flows = q.get('flowCode', 'M,X').split(',')
+            max_records = int(q.get('maxRecords', 500))
+
+            rows = None
+            if state.replay is not None:
+                # Same parameter dict fetch_trade.batch_params uses as the cache key
+                params = dict(
+                    typeCode=parts[3], freqCode=parts[4], clCode=parts[5], period=q['period'],
+                    reporterCode=q['reporterCode'], partnerCode=q.get('partnerCode'), cmdCode=q.get('cmdCode'),
+                    flowCode=q.get('flowCode'), partner2Code=None, customsCode=None, motCode=None,
+                    maxRecords=max_records, format_output='JSON', aggregateBy=None,
+                    breakdownMode=q.get('breakdownMode', 'classic'), countOnly=None,
+                    includeDesc=q.get('includeDesc', 'True') in ('True', 'true'),
+                )
+                rows = state.replay.get('comtrade', params)
+            if rows is None:
+                rows = comtrade_rows(state, reporter, partners, cmd_codes, flows, q['period'],
+                                     q.get('includeDesc', 'True') in ('True', 'true'))
+            rows = rows[:max_records]
+            state.count_rows(len(rows))
+            self._send(200, {'elapsedTime': '0.01 secs', 'count': len(rows), 'data': rows, 'error': ''})
+
+    return Handler
+
+
+def serve(state, host='127.0.0.1', port=0):
+    """Start the stand-in on a background thread; returns (server, base_url)."""
+    server = ThreadingHTTPServer((host, port), make_handler(state))
+    server.daemon_threads = True
+    threading.Thread(target=server.serve_forever, daemon=True).start()
+    return server, f"http://{host}:{server.server_address[1]}"
+
+
+if __name__ == '__main__':
+    parser = argparse.ArgumentParser(description=__doc__, formatter_class=argparse.RawDescriptionHelpFormatter)
+    parser.add_argument('--port', type=int, default=8765)
+    parser.add_argument('--reporters', default=','.join(map(str, DEFAULT_REPORTERS)))
+    parser.add_argument('--quota', type=int, default=0, help="calls allowed per window and key (0 = unlimited)")
+    parser.add_argument('--window', type=float, default=60, help="quota window in seconds")
+    parser.add_argument('--none-rate', type=float, default=0.0, help="fraction of calls answered with an empty 500")
+    parser.add_argument('--latency', default='0,0', help="min,max seconds of injected latency")
+    parser.add_argument('--rows-per-key', type=int, default=1)
+    parser.add_argument('--replay', action='store_true', help="replay recorded responses from the raw cache first")
+    args = parser.parse_args()
+
+    replay = None
+    if args.replay:
+        from raw_cache import RawCache
+        replay = RawCache()
+    state = StandinState(
+        reporters=[int(r) for r in args.reporters.split(',')], quota=args.quota, window=args.window,
+        none_rate=args.none_rate, latency=tuple(map(float, args.latency.split(','))),
+        rows_per_key=args.rows_per_key, replay=replay,
+    )
+    server, base = serve(state, port=args.port)
+    print(f"✓ Comtrade/WITS stand-in listening on {base}  (Ctrl-C to stop)")
+    try:
+        while True:
+            time.sleep(3600)
+    except KeyboardInterrupt:
+        server.shutdown()
@@ -0,0 +1,179 @@
+"""
+Tariff / retaliation simulator over the merged flows, server side.
+Evaluates the same model as the browser (trade-viz/src/hooks/useTradeData.js),
+but on dense arrays built once per focal reporter and year from merge.py's
+output, so a scenario is a handful of array operations whatever the size of
+the dataset:
+
+  value[partner, hs, flow]  the focal reporter's trade, summed per partner,
+                            HS chapter and flow (X, M)
+  tau[partner, hs, flow]    the same, weighted by |tau_mean| (elasticities)
+
+For a tariff rate t (0.25 = 25%):
+  - the focal reporter's exports to a partner become
+    value · (1+t)^-e · (1 - min(0.15·t, 0.3)), with e the value-weighted
+    |tau_mean| of its exports to that partner;
+  - its imports from a partner become value · (1+t)^-e (e from its imports)
+    when retaliation is on, and are unchanged otherwise;
+  - every other reporter's exports are damped the same way with their own
+    per-flow |tau_mean| (1.5 when missing), as the browser's arcs are;
+  - tradePctChange / gdpPctImpact follow calculateImpact.
+
+Unlike the browser, flows are not filtered by whether both countries have a
+map centroid.
+"""
+import os
+import threading
+import time
+import numpy as np
+import pandas as pd
+from merge import MANIFEST, OUT_DIR, read_merged
+
+FLOWS = ["X", "M"]
+DEFAULT_ELASTICITY = 1.5  # browser fallback when a flow has no tau_mean
+RETALIATION_MULTIPLIER = 1.8
+EXPORTS_TO_GDP = 0.12 * 0.85
+COLUMNS = ["reporterISO3", "partnerISO", "flowCode", "cmdCode", "aggrLevel", "primaryValue", "tau_mean"]
+
+_models = {}
+_lock = threading.Lock()
+
+
+def hs_chapters(cmd_code, aggr_level):
+    """HS2 chapter of each code, from its own level (a 4-digit 8471 → 84)."""
+    code = pd.to_numeric(cmd_code).to_numpy(dtype=float)
+    level = pd.to_numeric(aggr_level).fillna(2).clip(2, 6).to_numpy(dtype=float)
+    return (code // 10 ** (level - 2)).astype(np.int64)
+
+
+def _ratio(num, den):
+    return np.divide(num, den, out=np.zeros_like(num, dtype=float), where=den > 0)
+
+
+class TariffModel:
+    """Dense arrays for one focal reporter and year; `simulate` evaluates a scenario."""
+
+    def __init__(self, df, reporter, year):
+        self.reporter, self.year = reporter, year
+        value = df["primaryValue"].astype(float).fillna(0).to_numpy()
+        tau = df["tau_mean"].astype(float).to_numpy()
+        flow = df["flowCode"].astype("string")
+        focal = (df["reporterISO3"].astype("string") == reporter).fillna(False).to_numpy()
+        traded = flow.isin(FLOWS).fillna(False).to_numpy()
+
+        # focal reporter: partner × HS chapter × flow
+        rows = focal & traded
+        partners = pd.Categorical(df["partnerISO"].astype("string")[rows])
+        chapters, hs = np.unique(hs_chapters(df["cmdCode"][rows], df["aggrLevel"][rows]), return_inverse=True)
+        f = (flow[rows] == "M").to_numpy(dtype=np.int64)
+        shape = (len(partners.categories), len(chapters), len(FLOWS))
+        cell = np.ravel_multi_index((partners.codes, hs, f), shape)
+        # the browser weights by |tau|, counting flows without one as 0
+        weighted = np.abs(np.nan_to_num(tau[rows])) * value[rows]
+        self.partners = np.asarray(partners.categories, dtype=object)
+        self.chapters = np.array([f"{c:02d}" for c in chapters], dtype=object)
+        self.value = np.bincount(cell, value[rows], minlength=np.prod(shape)).reshape(shape)
+        self.tau = np.bincount(cell, weighted, minlength=np.prod(shape)).reshape(shape)
+        # value-weighted |tau| of exports to / imports from each partner
+        self.elasticity = _ratio(self.tau.sum(axis=1), self.value.sum(axis=1))
+
+        # every other reporter's exports, grouped by their (per-flow) elasticity
+        others = ~focal & (flow == "X").fillna(False).to_numpy()
+        e = np.abs(tau[others])
+        e[np.isnan(e) | (e == 0)] = DEFAULT_ELASTICITY
+        groups = pd.Series(value[others]).groupby(e).sum()
+        self.others_value = groups.to_numpy()
+        self.others_elasticity = groups.index.to_numpy(dtype=float)
+
+    def simulate(self, tariff_rate, retaliation=False):
+        """Per-partner and per-HS deltas, totals and impact for one scenario."""
+        start = time.perf_counter()
+        growth = 1.0 + tariff_rate
+        damping = 1.0 - min(0.15 * tariff_rate, 0.3)
+        factor = np.ones((len(self.partners), len(FLOWS)))
+        factor[:, 0] = growth ** -self.elasticity[:, 0] * damping
+        if retaliation:
+            factor[:, 1] = growth ** -self.elasticity[:, 1]
+        sim = self.value * factor[:, None, :]
+        others_sim = float((self.others_value * growth ** -self.others_elasticity).sum() * damping)
+
+        by_partner = self.value.sum(axis=1), sim.sum(axis=1)
+        by_hs = self.value.sum(axis=0), sim.sum(axis=0)
+        standard_base, standard_sim = float(by_partner[0][:, 0].sum()), float(by_partner[1][:, 0].sum())
+        others_base = float(self.others_value.sum())
+        stats = {
+            "baseTotal": float(self.value.sum()) + others_base,
+            "simTotal": float(sim.sum()) + others_sim,
+            "standardBaseTotal": standard_base,
+            "standardSimTotal": standard_sim,
+            "othersBaseTotal": others_base,
+            "othersSimTotal": others_sim,
+        }
+        return {
+            "reporter": self.reporter,
+            "year": self.year,
+            "tariffRate": tariff_rate,
+            "retaliationEnabled": retaliation,
+            "stats": stats,
+            "impact": impact(standard_base, standard_sim, retaliation),
+            "partners": _records("partnerISO", self.partners, *by_partner, elasticity=self.elasticity),
+            "hs": _records("hsCode", self.chapters, *by_hs),
+            "elapsedMs": round((time.perf_counter() - start) * 1000, 3),
+        }
+
+
+def _records(name, labels, base, sim, elasticity=None):
+    """Rows of base/sim exports and imports per label, largest change first."""
+    df = pd.DataFrame({
+        name: labels,
+        "exportsBase": base[:, 0], "exportsSim": sim[:, 0],
+        "importsBase": base[:, 1], "importsSim": sim[:, 1],
+    })
+    if elasticity is not None:
+        df["exportElasticity"], df["importElasticity"] = elasticity[:, 0], elasticity[:, 1]
+    df["delta"] = (sim - base).sum(axis=1)
+    df["pctChange"] = _ratio((sim - base).sum(axis=1), base.sum(axis=1)) * 100
+    return df.iloc[np.argsort(df["delta"].to_numpy(), kind="stable")].to_dict("records")
+
+
+def impact(standard_base, standard_sim, retaliation):
+    """calculateImpact: % change in the focal reporter's exports and the implied GDP impact."""
+    change = (standard_sim - standard_base) / standard_base if standard_base else 0.0
+    if retaliation:
+        change *= RETALIATION_MULTIPLIER
+        if change < 0:
+            # bounded so it cannot exceed -85%
+            change = -0.85 * (1.0 - np.exp(1.65 * change))
+    trade_pct = float(change * 100)
+    return {"tradePctChange": trade_pct, "gdpPctImpact": trade_pct * EXPORTS_TO_GDP}
+
+
+def latest_year(path=OUT_DIR):
+    years = [int(name[len("year="):]) for name in os.listdir(path) if name.startswith("year=")]
+    if not years:
+        raise FileNotFoundError(f"no merged partitions in {path}; run merge.py first")
+    return max(years)
+
+
+def load_model(reporter="USA", year=None, path=OUT_DIR):
+    """
+    The TariffModel for a reporter and year (default: the latest merged
+    year), built once and rebuilt only after merge.py has run again.
+    """
+    year = year or latest_year(path)
+    stamp = os.path.getmtime(MANIFEST) if os.path.exists(MANIFEST) else None
+    key = (reporter, year, path)
+    with _lock:
+        cached = _models.get(key)
+        if cached is not None and cached[0] == stamp:
+            return cached[1]
+        df = read_merged(columns=COLUMNS, years=[year], path=path)
+        if not (df["reporterISO3"].astype("string") == reporter).any():
+            raise LookupError(f"no merged flows for reporter {reporter} in {year}")
+        model = TariffModel(df, reporter, year)
+        _models[key] = (stamp, model)
+        return model
+
+
+def simulate(tariff_rate, retaliation=False, reporter="USA", year=None):
+    return load_model(reporter, year).simulate(tariff_rate, retaliation)
@@ -1,12 +1,12 @@
-import pandas as pd
+from flow_schema import read_flows
 
 def count_countries(file_path):
-    # Read the CSV file
-    df = pd.read_csv(file_path)
-    
     # Assuming there's a column named 'country' or similar
     country_column = 'partnerDesc'  # Change this to match your column name
     
+    # Read just that column (descriptions are restored from the lookup file)
+    df = read_flows(file_path, columns=[country_column])
+    
     # Count unique countries
     unique_countries = df[country_column].nunique()
     
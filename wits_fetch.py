@@ -0,0 +1,178 @@
+# wits_fetch.py
+"""
+Downloads MFN (reported) tariff schedules from the WITS UNCTAD-TRAINS SDMX API
+for every reporter and year, straight into the Parquet dataset merge.py reads
+(data/processed/wits_mfn_h6/reporter=<ISO3>/year=<YYYY>/, the same layout
+ingest_wits.py writes from offline ZIPs).
+
+Requests share one pooled keep-alive session and run a few at a time; transient
+failures (connection errors, 429, 5xx) are retried with exponential backoff
+and full jitter. Every response is kept verbatim in the shared raw cache
+(data/raw/cache/wits/) and decoded by streaming it back from there
+(sdmx_decode.py), so re-runs and rebuilds cost no API calls.
+
+    python wits_fetch.py                       # reporters/years found in trade_flows.csv
+    python wits_fetch.py --reporters 840,156 --years 2019-2023
+"""
+import argparse
+import os
+import random
+import threading
+import time
+import pandas as pd
+import requests
+from concurrent.futures import ThreadPoolExecutor, as_completed
+from requests.adapters import HTTPAdapter
+from country_codes import to_iso3, from_iso3
+from raw_cache import RawCache
+from sdmx_decode import decode_stream
+from code_ranges import parse_codes
+from ingest_wits import API_STEM, OUT_DIR, partition_dir, write_part, clear_parts, clear_archives
+
+# Point at standin_server.py (e.g. http://127.0.0.1:8765) to run without the live API
+BASE = os.environ.get('WITS_BASE_URL', 'https://wits.worldbank.org').rstrip('/') + '/API/V1/SDMX/V21/datasource/TRN'
+TRADE_FLOWS_CSV = 'data/processed/trade_flows.csv'
+REPORTERS = [840, 156]  # ISO numeric; fallback when trade_flows.csv has no reporters yet
+YEARS = [2023]
+PARTNER = '000'  # World: the MFN schedule
+DATATYPE = 'reported'
+CONCURRENCY = int(os.environ.get('WITS_CONCURRENCY', 4))  # Requests kept in flight
+MAX_RETRIES = int(os.environ.get('WITS_MAX_RETRIES', 6))
+BACKOFF_BASE = 2.0  # seconds; retry n waits up to BACKOFF_BASE * 2**n
+BACKOFF_CAP = 120.0
+CACHE_SOURCE = 'wits'
+STEM = API_STEM  # file prefix in the partitions, distinct from offline archive names
+
+raw_cache = RawCache()
+_session = None
+_session_lock = threading.Lock()
+
+
+def session():
+    """The shared keep-alive session, with a connection pool sized for CONCURRENCY."""
+    global _session
+    with _session_lock:
+        if _session is None:
+            _session = requests.Session()
+            adapter = HTTPAdapter(pool_connections=1, pool_maxsize=CONCURRENCY)
+            _session.mount('https://', adapter)
+            _session.mount('http://', adapter)
+        return _session
+
+
+def request_params(reporter, year):
+    return {'reporter': str(reporter), 'partner': PARTNER, 'year': int(year), 'datatype': DATATYPE}
+
+
+def get_with_retry(url):
+    """
+    GET with exponential backoff and full jitter on connection errors, 429 and 5xx.
+    Returns the response (which may be a 404 for reporter-years WITS has no data for).
+    """
+    for attempt in range(MAX_RETRIES + 1):
+        try:
+            r = session().get(url, timeout=120)
+            if r.status_code != 429 and r.status_code < 500:
+                return r
+            problem = f"HTTP {r.status_code}"
+            retry_after = r.headers.get('Retry-After')
+        except (requests.ConnectionError, requests.Timeout) as e:
+            problem, retry_after = type(e).__name__, None
+        if attempt == MAX_RETRIES:
+            raise RuntimeError(f"{url}: {problem} after {MAX_RETRIES} retries")
+        delay = random.uniform(0, min(BACKOFF_CAP, BACKOFF_BASE * 2 ** attempt))
+        if retry_after and retry_after.isdigit():
+            delay = max(delay, float(retry_after))
+        print(f"⚠️ {problem}; retrying in {delay:.1f}s ({attempt + 1}/{MAX_RETRIES})")
+        time.sleep(delay)
+
+
+def fetch_raw(reporter, year):
+    """Make sure the SDMX-JSON schedule is in the raw cache; returns False if WITS has none."""
+    params = request_params(reporter, year)
+    stream = raw_cache.open(CACHE_SOURCE, params)
+    if stream is not None:
+        stream.close()
+        return True
+    url = (f"{BASE}/reporter/{reporter}/partner/{PARTNER}/product/All/"
+           f"year/{year}/datatype/{DATATYPE}?format=JSON")
+    r = get_with_retry(url)
+    if r.status_code == 404 or not r.content.strip():
+        return False
+    r.raise_for_status()
+    raw_cache.put_json_bytes(CACHE_SOURCE, params, r.content)
+    return True
+
+
+def fetch_schedule(reporter, year):
+    """
+    Download (or reuse) one reporter-year schedule and write its partition.
+    Returns (reporter, year, rows); rows is None when WITS has no data.
+    """
+    if not fetch_raw(reporter, year):
+        return reporter, year, None
+    params = request_params(reporter, year)
+    df = decode_stream(lambda: raw_cache.open(CACHE_SOURCE, params), prefix='payload')
+    product = next((c for c in df.columns if 'PRODUCT' in c.upper()), None)
+    out = pd.DataFrame({
+        'REPORTER': int(reporter),
+        'YEAR': int(year),
+        'PRODUCT': df[product].astype(str).str.zfill(6) if product else 'ALL',
+        'VALUE': df['VALUE'],
+    })
+    target = partition_dir(OUT_DIR, to_iso3([reporter], 'wits')[0] or reporter, year)
+    os.makedirs(target, exist_ok=True)
+    stem = f"{STEM}_{reporter}_{year}"
+    clear_parts(target, stem)
+    write_part(out, target, stem, 0)
+    # The API schedule replaces offline-archive output for the same reporter-year
+    dropped = clear_archives(target)
+    if dropped:
+        print(f"⇢ {reporter} {year}: replaced {dropped} offline-archive files with the API schedule")
+    return reporter, year, len(out)
+
+
+def default_reporters_years():
+    """ISO numeric reporters and years present in trade_flows.csv, or the configured defaults."""
+    if not os.path.exists(TRADE_FLOWS_CSV):
+        return REPORTERS, YEARS
+    df = pd.read_csv(TRADE_FLOWS_CSV, usecols=['reporterISO', 'refYear']).drop_duplicates()
+    reporters = sorted({int(c) for c in from_iso3(df['reporterISO'].dropna().unique(), 'wits').dropna()})
+    return reporters or REPORTERS, sorted(df['refYear'].dropna().astype(int).unique()) or YEARS
+
+
+def main(reporters=None, years=None):
+    if reporters is None or years is None:
+        found_reporters, found_years = default_reporters_years()
+        reporters = reporters or found_reporters
+        years = years or found_years
+    tasks = [(r, y) for r in reporters for y in years]
+    print(f"Fetching {len(tasks)} WITS MFN schedules ({CONCURRENCY} in flight)...")
+
+    rows = missing = failed = 0
+    with ThreadPoolExecutor(max_workers=CONCURRENCY) as pool:
+        futures = {pool.submit(fetch_schedule, r, y): (r, y) for r, y in tasks}
+        for future in as_completed(futures):
+            reporter, year = futures[future]
+            try:
+                _, _, n = future.result()
+            except Exception as e:
+                failed += 1
+                print(f"⚠️  {reporter} {year}: {e}")
+                continue
+            if n is None:
+                missing += 1
+                print(f"⇢ {reporter} {year}: no WITS schedule")
+            else:
+                rows += n
+                print(f"✓ {reporter} {year}: {n} tariff lines")
+    print(f"✓ Wrote {rows} tariff lines → {OUT_DIR}  ({missing} without data, {failed} failed)")
+
+
+if __name__ == '__main__':
+    parser = argparse.ArgumentParser(description=__doc__, formatter_class=argparse.RawDescriptionHelpFormatter)
+    parser.add_argument('--reporters', help="ISO numeric reporter codes, e.g. 840,156 (default: from trade_flows.csv)")
+    parser.add_argument('--years', help="e.g. 2023 or 2019-2023 (default: from trade_flows.csv)")
+    args = parser.parse_args()
+    main(reporters=parse_codes(args.reporters) if args.reporters else None,
+         years=parse_codes(args.years) if args.years else None)